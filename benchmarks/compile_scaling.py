@@ -0,0 +1,241 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+# Measures how the MSCCLang compiler scales with the number of ranks and instances on the programs in
+# msccl/programs and the swing and recursive doubling examples. Every case records the time spent tracing
+# the program, lowering it and writing its XML, and the peak memory of the whole compilation.
+# Results can be saved as JSON and compared against a baseline to catch compiler performance regressions.
+# Every case is compiled in a fresh process. Timings depend on the machine, so baselines should be recorded
+# on the machine they are compared on.
+# Usage: python benchmarks/compile_scaling.py [--max-ranks N] [--instances N ...] [--output results.json]
+#        python benchmarks/compile_scaling.py --baseline benchmarks/compile_baseline.json [--tolerance 0.5]
+# benchmarks/compile_baseline.json was recorded with --max-ranks 64 --instances 1 8 --output benchmarks/compile_baseline.json
+
+import argparse
+import contextlib
+from dataclasses import dataclass, asdict
+import json
+import logging
+import os
+import resource
+import runpy
+import subprocess
+import sys
+import time
+
+from msccl.language import *
+from msccl.language.collectives import AllReduce, AllToAll
+from msccl.topologies import fully_connected
+from msccl.programs.allreduce_a100_ring import allreduce_ring
+from msccl.programs.allreduce_allpairs import allreduce_allpairs
+from msccl.programs.alltoall_a100_yifan import alltoall_hierarchical
+from msccl.programs.alltoall_a100_8kp1 import alltoall_three_step
+
+_examples = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples', 'mscclang')
+_powers_of_two = [2**i for i in range(3, 11)] # 8 to 1024
+_policies = {'auto': ThreadblockPolicy.auto, 'manual': ThreadblockPolicy.manual}
+
+
+@dataclass
+class Benchmark:
+    name: str
+    run: object # run(num_ranks, instances, policy) traces the program and writes its XML
+    ranks: list
+    policies: list # Names of the threadblock policies, None for examples that choose their own
+
+
+@dataclass
+class Result:
+    benchmark: str
+    num_ranks: int
+    instances: int
+    policy: str
+    trace: float # Seconds
+    lower: float
+    xml: float
+    peak_memory: int # Bytes
+
+    @property
+    def key(self):
+        return (self.benchmark, self.num_ranks, self.instances, self.policy)
+
+    @property
+    def total(self):
+        return self.trace + self.lower + self.xml
+
+
+def _program(name, collective, trace):
+    def run(num_ranks, instances, policy):
+        with MSCCLProgram(name, fully_connected(num_ranks), collective(num_ranks), instances,
+                threadblock_policy=_policies[policy]):
+            trace(num_ranks)
+            XML()
+    return run
+
+
+# Runs an example script with the number of ranks and instances as its command line
+def _example(script):
+    def run(num_ranks, instances, policy):
+        path = os.path.join(_examples, script)
+        argv = sys.argv
+        sys.argv = [path, str(num_ranks), str(instances)]
+        try:
+            runpy.run_path(path, run_name='__main__')
+        finally:
+            sys.argv = argv
+    return run
+
+
+benchmarks = [
+    Benchmark('allreduce_ring', _program('allreduce_ring', lambda n: AllReduce(n, n, True),
+        lambda n: allreduce_ring(n, 1)), _powers_of_two, ['auto', 'manual']),
+    Benchmark('allreduce_allpairs', _program('allreduce_allpairs', lambda n: AllReduce(n, n * n, True),
+        allreduce_allpairs), _powers_of_two[:3], ['auto', 'manual']), # Cubic in the number of ranks
+    Benchmark('alltoall_hierarchical', _program('alltoall_hierarchical', lambda n: AllToAll(n, 1, False),
+        lambda n: alltoall_hierarchical(n // 8, 8)), _powers_of_two[1:], ['auto']),
+    Benchmark('alltoall_three_step', _program('alltoall_three_step', lambda n: AllToAll(n, 1, False),
+        lambda n: alltoall_three_step(n // 8, 8)), _powers_of_two[1:], ['auto']),
+    Benchmark('allreduce_swing_bandwidth_all_sends', _example('allreduce_swing_bandwidth_all_sends.py'), _powers_of_two, [None]),
+    Benchmark('allreduce_swing_bandwidth_at_once', _example('allreduce_swing_bandwidth_at_once.py'), _powers_of_two, [None]),
+    Benchmark('allreduce_swing_latency_sync', _example('allreduce_swing_latency_sync.py'), _powers_of_two, [None]),
+    Benchmark('allreduce_recursive_doubling_halving', _example('allreduce_recursive_doubling_halving.py'), _powers_of_two, [None]),
+    Benchmark('allgather_recursive_doubling', _example('allgather_recursive_doubling.py'), _powers_of_two, [None]),
+]
+
+
+# Accumulates the time spent in MSCCLProgram.lower and MSCCLProgram.generate_xml into times.
+# generate_xml includes lowering, everything else in a run is tracing.
+@contextlib.contextmanager
+def _phase_timer(times):
+    lower, generate_xml = MSCCLProgram.lower, MSCCLProgram.generate_xml
+
+    def timed_lower(self):
+        start = time.perf_counter()
+        try:
+            return lower(self)
+        finally:
+            times['lower'] += time.perf_counter() - start
+
+    def timed_generate_xml(self, path=None):
+        start = time.perf_counter()
+        try:
+            return generate_xml(self, path)
+        finally:
+            times['generate_xml'] += time.perf_counter() - start
+
+    MSCCLProgram.lower, MSCCLProgram.generate_xml = timed_lower, timed_generate_xml
+    try:
+        yield
+    finally:
+        MSCCLProgram.lower, MSCCLProgram.generate_xml = lower, generate_xml
+
+
+# Runs a case with the XML and the logging of the examples discarded, returns its (trace, lower, xml) times
+def _run(benchmark, num_ranks, instances, policy):
+    times = {'lower': 0.0, 'generate_xml': 0.0}
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), _phase_timer(times):
+        logging.disable(logging.CRITICAL)
+        try:
+            start = time.perf_counter()
+            benchmark.run(num_ranks, instances, policy)
+            total = time.perf_counter() - start
+        finally:
+            logging.disable(logging.NOTSET)
+    return total - times['generate_xml'], times['lower'], times['generate_xml'] - times['lower']
+
+
+# Runs a case in this process and prints its Result as JSON. Times are the fastest of repeats runs,
+# the peak memory is how much the peak resident set size grew over the runs.
+def _measure_here(name, num_ranks, instances, policy, repeats):
+    benchmark = next(b for b in benchmarks if b.name == name)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    runs = [_run(benchmark, num_ranks, instances, policy) for _ in range(repeats)]
+    peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) * 1024 # ru_maxrss is in KiB
+    trace, lower, xml = min(runs, key=sum)
+    print(json.dumps(asdict(Result(name, num_ranks, instances, policy or 'default', trace, lower, xml, peak))))
+
+
+# Measures a case in a fresh process, so cases do not share memory or state left by the examples
+def measure(benchmark, num_ranks, instances, policy, repeats):
+    case = json.dumps([benchmark.name, num_ranks, instances, policy, repeats])
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), '--case', case],
+        stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    return Result(**json.loads(out.splitlines()[-1]))
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump({'results': [asdict(r) for r in results]}, f, indent=2)
+
+
+def load(path):
+    with open(path) as f:
+        return [Result(**r) for r in json.load(f)['results']]
+
+
+# Returns the (result, baseline) pairs whose total time or peak memory grew by more than tolerance.
+# Changes smaller than min_time seconds or min_memory bytes are too noisy to compare.
+def regressions(results, baseline, tolerance, min_time=0.05, min_memory=2**24):
+    baseline = {r.key: r for r in baseline}
+    regressed = []
+    for result in results:
+        base = baseline.get(result.key)
+        if base is None:
+            continue
+        slower = result.total > base.total * (1 + tolerance) and result.total - base.total > min_time
+        larger = result.peak_memory > base.peak_memory * (1 + tolerance) and result.peak_memory - base.peak_memory > min_memory
+        if slower or larger:
+            regressed.append((result, base))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmarks', nargs='+', choices=[b.name for b in benchmarks], help='default: all')
+    parser.add_argument('--ranks', type=int, nargs='+', help='rank counts to compile for, default: 8 to 1024')
+    parser.add_argument('--max-ranks', type=int, default=1024)
+    parser.add_argument('--instances', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--policies', nargs='+', choices=list(_policies), default=list(_policies))
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--output', help='writes the results as JSON')
+    parser.add_argument('--baseline', help='JSON results to compare against, only cases in the baseline are run')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='relative growth reported as a regression')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.case:
+        _measure_here(*json.loads(args.case))
+        return
+
+    baseline = load(args.baseline) if args.baseline else None
+    baseline_keys = None if baseline is None else {r.key for r in baseline}
+    results = []
+    print(f'{"benchmark":40s} {"ranks":>5s} {"inst":>4s} {"policy":>7s} {"trace":>8s} {"lower":>8s} {"xml":>8s} {"memory":>9s}')
+    for benchmark in benchmarks:
+        if args.benchmarks and benchmark.name not in args.benchmarks:
+            continue
+        for num_ranks in args.ranks or benchmark.ranks:
+            if num_ranks > args.max_ranks:
+                continue
+            for instances in args.instances:
+                for policy in benchmark.policies:
+                    if policy is not None and policy not in args.policies:
+                        continue
+                    if baseline_keys is not None and (benchmark.name, num_ranks, instances, policy or 'default') not in baseline_keys:
+                        continue
+                    r = measure(benchmark, num_ranks, instances, policy, args.repeats)
+                    results.append(r)
+                    print(f'{r.benchmark:40s} {r.num_ranks:5d} {r.instances:4d} {r.policy:>7s} {r.trace:7.3f}s {r.lower:7.3f}s {r.xml:7.3f}s {r.peak_memory / 2**20:7.1f}MB', flush=True)
+
+    if args.output:
+        save(results, args.output)
+    if baseline is not None:
+        regressed = regressions(results, baseline, args.tolerance)
+        for r, base in regressed:
+            print(f'Regression: {r.benchmark} with {r.num_ranks} ranks, {r.instances} instances, {r.policy} policy: '
+                  f'{base.total:.3f}s -> {r.total:.3f}s, {base.peak_memory / 2**20:.1f}MB -> {r.peak_memory / 2**20:.1f}MB')
+        if regressed:
+            sys.exit(1)
+        print(f'No regressions in {len(results)} cases')
+
+if __name__ == '__main__':
+    main()
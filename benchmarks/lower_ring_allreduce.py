@@ -0,0 +1,44 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+# Times the InstructionDAG traversal passes on a ring allreduce
+# Usage: python benchmarks/lower_ring_allreduce.py [num_ranks] [repeats]
+
+import argparse
+import time
+
+from msccl.language import *
+from msccl.language.routines import allreduce_ring_inplace
+from msccl.topologies import fully_connected
+from msccl.language.collectives import AllReduce
+
+def trace(num_ranks):
+    prog = MSCCLProgram('allreduce_ring', fully_connected(num_ranks), AllReduce(num_ranks, num_ranks, True), 1)
+    with prog:
+        allreduce_ring_inplace(num_ranks)
+    return prog.instr_dag
+
+def timed(f):
+    start = time.perf_counter()
+    f()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('num_ranks', type=int, nargs='?', default=256)
+    parser.add_argument('repeats', type=int, nargs='?', default=3)
+    args = parser.parse_args()
+
+    passes = ['convert_set_list', 'optimize', 'infer_dependencies']
+    times = {name: [] for name in passes}
+    for _ in range(args.repeats):
+        dag = trace(args.num_ranks)
+        for name in passes:
+            times[name].append(timed(getattr(dag, name)))
+
+    print(f'ring allreduce, {args.num_ranks} ranks, best of {args.repeats}')
+    for name in passes:
+        print(f'{name:20s} {min(times[name]):.3f}s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import fcntl
+import hashlib
+import inspect
+import os
+import tempfile
+import time
+import humanfriendly
+
+# On-disk cache of the XML of compiled MSCCLang programs. Entries are files named by the hash of
+# everything the XML depends on, so concurrent writers of the same key write the same content
+# and an entry never needs to be invalidated.
+# MSCCL_CACHE_DIR sets the directory and MSCCL_CACHE_SIZE its size bound (0 disables the cache). The bound is
+# soft: entries used within the last hour are never evicted, so the cache can exceed it while they are in use.
+
+_default_size = '1GiB'
+# Entries used more recently than this are never evicted, as a plan's XML path is read by
+# NCCL after msccl.init returns
+_min_evict_age = 60 * 60
+# Builders lock one of a fixed number of files chosen by the key, so lock files never accumulate
+_num_key_locks = 64
+
+
+_msccl_digest = None
+
+# Returns a hash of the sources of the msccl package, so that entries built by another version or a modified
+# checkout of the compiler are not reused
+def _msccl_source_digest():
+    global _msccl_digest
+    if _msccl_digest is None:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        digest = hashlib.sha256()
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith('.py'):
+                    path = os.path.join(dirpath, filename)
+                    digest.update(os.path.relpath(path, root).encode('utf-8'))
+                    with open(path, 'rb') as f:
+                        digest.update(hashlib.sha256(f.read()).digest())
+        _msccl_digest = digest.hexdigest()
+    return _msccl_digest
+
+
+# Returns the cache key of an MSCCLang program function with the given parameters or None if its source is unavailable
+def program_key(fun, **params):
+    try:
+        source = inspect.getsource(fun)
+    except (OSError, TypeError):
+        return None
+    desc = repr((source, sorted((name, repr(value)) for name, value in params.items()), _msccl_source_digest()))
+    return hashlib.sha256(desc.encode('utf-8')).hexdigest()
+
+
+class CompileCache:
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.xml')
+
+    # Returns the path of the file locked while building the entry for key, shared with other keys
+    def lock_path(self, key):
+        slot = int(hashlib.sha256(key.encode('utf-8')).hexdigest(), 16) % _num_key_locks
+        return os.path.join(self.directory, f'.lock-{slot}')
+
+    # Returns the path of the cached XML for key or None
+    def get(self, key):
+        path = self.path(key)
+        try:
+            # Mark the entry as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except OSError:
+            # The entry is still valid if its access time cannot be updated, e.g. on a read-only cache
+            if not os.path.exists(path):
+                return None
+        return path
+
+    # Writes an entry with write(f) and returns its path
+    def put(self, key, write):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                write(f)
+            # Readers see either no entry or a complete one
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.evict()
+        return self.path(key)
+
+    # Returns the path of the entry for key, writing it with write(f) if it is missing.
+    # Only one process writes an entry, concurrent callers wait for it and reuse the result.
+    def get_or_put(self, key, write):
+        path = self.get(key)
+        if path is not None:
+            return path
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.lock_path(key), 'a+') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            try:
+                path = self.get(key)
+                if path is None:
+                    path = self.put(key, write)
+                return path
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+
+    # Removes the least recently used entries until the cache fits in max_size
+    def evict(self):
+        with open(os.path.join(self.directory, '.lock'), 'a+') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            try:
+                entries = []
+                now = time.time()
+                for entry in os.scandir(self.directory):
+                    if entry.name.endswith('.xml'):
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                entries.sort()
+                total = sum(size for _, size, _ in entries)
+                for mtime, size, path in entries:
+                    if total <= self.max_size or now - mtime < _min_evict_age:
+                        break
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+
+
+# Returns the cache configured by the environment or None if it is disabled
+def default_cache():
+    directory = os.environ.get('MSCCL_CACHE_DIR')
+    if not directory:
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        directory = os.path.join(cache_home, 'msccl')
+    max_size = humanfriendly.parse_size(os.environ.get('MSCCL_CACHE_SIZE', _default_size))
+    if max_size == 0:
+        return None
+    return CompileCache(directory, max_size)
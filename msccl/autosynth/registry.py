@@ -9,6 +9,7 @@ import atexit
 import humanfriendly
 
 from msccl.language import MSCCLProgram, ir_to_xml
+from msccl.autosynth.cache import default_cache, program_key
 from msccl.language.ir import ThreadblockPolicy
 import msccl.language.collectives as lang_collectives
 from msccl.topologies import distributed_fully_connected
@@ -46,15 +47,25 @@ def register_ef_file(path, collective, machine_type, num_machines, sizes=None, p
                          machine_type, lambda x: x == num_machines, sizes, protocol, priority)
 
 
+# Writes the XML of a plan with write(f) and returns its path. With the compile cache enabled, the XML is
+# only written by one process per key, concurrent processes wait for it and reuse the result.
+def _materialize(key, write):
+    cache = default_cache()
+    if cache is not None and key is not None:
+        return cache.get_or_put(key, write)
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, 'w') as f:
+        write(f)
+    atexit.register(os.remove, path)
+    return path
+
+
 def register_synthesis_plan(collective, machine_type, machines=lambda x: True, sizes=None, protocol='Simple', priority=0):
     def decorator(fun):
         def wrapped(machines):
-            ef = fun(machines)
-            fd, path = tempfile.mkstemp()
-            with os.fdopen(fd, 'w') as f:
-                f.write(ef)
-            atexit.register(os.remove, path)
-            return path
+            def write(f):
+                f.write(fun(machines))
+            return _materialize(program_key(fun, machines=machines), write)
         _register_ef_provider(f'call {fun.__name__}', wrapped, collective,
                              machine_type, machines, sizes, protocol, priority)
         # Return the original function to not break other usage
@@ -81,17 +92,18 @@ def register_msccl_program(local_topology, collective, machine_type, machines=la
                     co = lang_collectives.ReduceScatter(topology.num_nodes(), chunk_factor, inplace)
                 else:
                     raise RuntimeError(f'No collective_obj in msccl.language.collectives known for "{collective}"')
-            prog = MSCCLProgram(name, topology, co, instances, protocol, threadblock_policy=threadblock_policy, 
-                interleaved_replication=interleaved_replication, dependence_nop=dependence_nop)
-            with prog:
-                fun(prog, machines)
-            prog.check()
-            ef = prog.generate_xml()
-            fd, path = tempfile.mkstemp()
-            with os.fdopen(fd, 'w') as f:
-                f.write(ef)
-            atexit.register(os.remove, path)
-            return path
+            def write(f):
+                prog = MSCCLProgram(name, topology, co, instances, protocol, threadblock_policy=threadblock_policy, 
+                    interleaved_replication=interleaved_replication, dependence_nop=dependence_nop)
+                with prog:
+                    fun(prog, machines)
+                prog.check()
+                prog.generate_xml(f)
+            key = program_key(fun, machines=machines, topology=(topology.name, topology.links, topology.switches),
+                collective=(type(co).__name__, vars(co)), instances=instances, protocol=protocol,
+                threadblock_policy=threadblock_policy, interleaved_replication=interleaved_replication,
+                dependence_nop=dependence_nop)
+            return _materialize(key, write)
         _register_ef_provider(f'run {name}', wrapped, collective,
                              machine_type, machines, sizes, protocol, priority)
         # Return the original function to not break other usage
@@ -17,6 +17,7 @@ def make_solvers(cmd_parsers):
 def _make_handle_strategy(cmd_parsers, name, invoke, take_steps = True):
     cmd = cmd_parsers.add_parser(name)
     instance_handler = add_instance(cmd, take_steps=take_steps)
+    cmd.add_argument('--symmetry-breaking', action='store_true', help='exclude solutions that are symmetric under automorphisms of the topology and collective')
     topologies = KnownTopologies(cmd)
     collectives = KnownCollectives(cmd)
     validate_output_args, output_handler = add_output_algorithm(cmd)
@@ -37,17 +38,19 @@ def _make_handle_strategy(cmd_parsers, name, invoke, take_steps = True):
 
 def make_handle_solve_instance(cmd_parsers):
     def invoke(args, topology, collective, instance):
-        return strategies.solve_instance(topology, collective, instance, logging=True)
+        return strategies.solve_instance(topology, collective, instance, logging=True, symmetry_breaking=args.symmetry_breaking)
 
     cmd, handle = _make_handle_strategy(cmd_parsers, 'instance', invoke)
     return handle
 
 def make_handle_solve_least_steps(cmd_parsers):
     def invoke(args, topology, collective, instance):
-        return strategies.solve_least_steps(topology, collective, args.initial_steps, instance, logging=True)
+        return strategies.solve_least_steps(topology, collective, args.initial_steps, instance, logging=True, jobs=args.jobs, seeds=args.seeds, symmetry_breaking=args.symmetry_breaking)
 
     cmd, handle = _make_handle_strategy(cmd_parsers, 'least-steps', invoke, take_steps=False)
     cmd.add_argument('--initial-steps', type=int, default=1, metavar='N')
+    cmd.add_argument('-j', '--jobs', type=int, default=1, help='number of step counts to solve in parallel processes', metavar='N')
+    cmd.add_argument('--seeds', type=int, nargs='+', default=None, help='solve each step count once with each of these Z3 random seeds', metavar='SEED')
     return handle
 
 def make_handle_solve_pareto_optimal(cmd_parsers):
@@ -60,6 +63,8 @@ def make_handle_solve_pareto_optimal(cmd_parsers):
     cmd.add_argument('--max-chunks', type=int, default=None, metavar='N')
     cmd.add_argument('--assume-rpc-bound', default=None, help='assume bandwidth optimality requires at least this many rounds per chunk', metavar='N/N')
     cmd.add_argument('--no-monotonic-feasibility', action='store_true', help='turn off an unproven assumption about monotonic feasibility of instances')
+    cmd.add_argument('-j', '--jobs', type=int, default=1, help='number of instances to solve in parallel processes', metavar='N')
+    cmd.add_argument('--symmetry-breaking', action='store_true', help='exclude solutions that are symmetric under automorphisms of the topology and collective')
     cmd.add_argument('--save-eagerly', action='store_true', help='save algorithms as soon as they are found, without pruning non-Pareto optimal algorithms at the end')
     instance_handler = add_instance(cmd, take_steps=False, take_rounds=False)
 
@@ -77,14 +82,17 @@ def make_handle_solve_pareto_optimal(cmd_parsers):
                 assume_rpc_bound = parse_fraction(args.assume_rpc_bound)
             except ValueError:
                 cmd.error('could not parse --assume-rpc-bound as a fraction')
-        algorithms = []
-        for algorithm in strategies.solve_all_latency_bandwidth_tradeoffs(topology, collective, args.min_chunks, args.max_chunks, assume_rpc_bound, not args.no_monotonic_feasibility, base_instance=instance, logging=True):
-            algorithms.append(algorithm)
+        found = 0
+        frontier = strategies.ParetoFrontier()
+        for algorithm in strategies.solve_all_latency_bandwidth_tradeoffs(topology, collective, args.min_chunks, args.max_chunks, assume_rpc_bound, not args.no_monotonic_feasibility, base_instance=instance, logging=True, jobs=args.jobs, symmetry_breaking=args.symmetry_breaking):
+            found += 1
             if args.save_eagerly:
                 output_handler(args, algorithm, algorithm.name)
+            else:
+                frontier.add(algorithm)
         if not args.save_eagerly:
-            efficient_algorithms = strategies.prune_pareto_optimal(algorithms)
-            print(f'Found {len(efficient_algorithms)} Pareto optimal algorithms. Pruned {len(algorithms) - len(efficient_algorithms)} non-optimal algorithms.')
+            efficient_algorithms = frontier.algorithms
+            print(f'Found {len(efficient_algorithms)} Pareto optimal algorithms. Pruned {found - len(efficient_algorithms)} non-optimal algorithms.')
             for algorithm in efficient_algorithms:
                 output_handler(args, algorithm, algorithm.name)
         return True
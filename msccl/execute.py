@@ -0,0 +1,305 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import io
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+import numpy as np
+
+from msccl.language.ir import Program, Buffer, read_xml, write_xml, xml_to_ir
+from msccl.language.collectives import Collective, AllGather, AllReduce, AllToAll, ReduceScatter
+
+# Reference executor of MSCCL-IR programs on NumPy buffers. Every threadblock runs in its own thread and executes its
+# steps in order as the MSCCL runtime does: it waits on its depid/deps dependency, receives the messages of its
+# (sender rank, receiver rank, channel) connection in FIFO order and reduces by summing. The final output buffers
+# are checked against the collective, so bugs in lowering the program to XML are caught as wrong data.
+
+_send_types = {'s', 'rcs', 'rrs', 'rrcs'}
+_recv_types = {'r', 'rcs', 'rrs', 'rrc', 'rrcs'}
+# Types of steps that read their src and write their dst
+_src_types = {'s', 'rrs', 'rrc', 'rrcs', 'cpy', 're'}
+_dst_types = {'r', 'rcs', 'rrc', 'rrcs', 'cpy', 're'}
+
+_collectives = {
+    'allreduce': AllReduce,
+    'allgather': AllGather,
+    'reduce_scatter': ReduceScatter,
+    'alltoall': AllToAll,
+}
+
+
+@dataclass
+class ExecutionResult:
+    time: float # Wall clock seconds the threadblocks ran for
+    outputs: list # Output buffer of every rank
+    errors: list = field(default_factory=list) # Descriptions of failed steps and incorrect output chunks
+    stuck: list = field(default_factory=list) # (rank, tbid, step) of threadblocks that never finish
+
+    @property
+    def correct(self):
+        return len(self.errors) == 0 and len(self.stuck) == 0
+
+
+@dataclass
+class _Step:
+    type: str
+    src: tuple # (buffer, chunk offset)
+    dst: tuple
+    cnt: int
+    dep: tuple # (tbid, step) of the dependency on the same rank or None
+
+
+@dataclass
+class _Threadblock:
+    rank: int
+    id: int
+    send: int
+    recv: int
+    channel: int
+    steps: list
+
+
+@dataclass
+class _Gpu:
+    rank: int
+    chunks: dict # buffer name -> number of chunks
+
+
+@dataclass
+class _Algo:
+    collective: str
+    ngpus: int
+    inplace: bool
+    gpus: list
+    tbs: list
+
+
+def _parse_algo(program):
+    gpus = []
+    tbs = []
+    for gpu in program.gpus:
+        gpus.append(_Gpu(gpu.rank, {'i': gpu.input_chunks, 'o': gpu.output_chunks, 's': gpu.scratch_size()}))
+        conns = set()
+        for tb in gpu.threadblocks:
+            # The runtime has one connection per peer and channel in each direction
+            for conn in [('send', tb.send, tb.channel), ('recv', tb.recv, tb.channel)]:
+                if conn[1] != -1 and conn in conns:
+                    raise ValueError(f'Rank {gpu.rank} has several threadblocks that {conn[0]} on channel {tb.channel} with rank {conn[1]}')
+                conns.add(conn)
+            steps = []
+            for op in tb.ops:
+                step_type = str(op.inst)
+                if (op.is_send() and tb.send == -1) or (op.is_recv() and tb.recv == -1):
+                    raise ValueError(f'Rank {gpu.rank} threadblock {tb.rbid} step {op.step} has type {step_type} without a peer')
+                for ref, types in [(op.src, _src_types), (op.dst, _dst_types)]:
+                    if step_type in types and (ref is None or ref.buffer is None):
+                        raise ValueError(f'Rank {gpu.rank} threadblock {tb.rbid} step {op.step} has no buffer to access, '
+                                         'only the XML format with srcbuf and dstbuf in every step can be executed')
+                src = (str(op.src.buffer), op.src.index) if op.src is not None else None
+                dst = (str(op.dst.buffer), op.dst.index) if op.dst is not None else None
+                dep = (op.depends[0].tb, op.depends[0].step) if len(op.depends) > 0 else None
+                steps.append(_Step(step_type, src, dst, op.cnt(), dep))
+            tbs.append(_Threadblock(gpu.rank, tb.rbid, tb.send, tb.recv, tb.channel, steps))
+    return _Algo(program.collective, len(program.gpus), program.inplace, gpus, tbs)
+
+
+# Reads the algorithm from a Program returned by MSCCLProgram.lower(), a path to an XML file or a string of XML
+def _load_algo(program):
+    if isinstance(program, Program):
+        out = io.StringIO()
+        write_xml(program, out)
+        program = xml_to_ir(out.getvalue())
+    elif isinstance(program, str) and program.lstrip().startswith('<'):
+        program = xml_to_ir(program)
+    elif isinstance(program, (str, os.PathLike)):
+        program = read_xml(program)
+    else:
+        raise ValueError(f'Cannot execute {program}, expected a Program, an XML string or a path')
+    return _parse_algo(program)
+
+
+# The collective of an algorithm from its name and buffer sizes, with all chunks of an instance in one chunk factor
+def _infer_collective(algo):
+    cls = _collectives.get(algo.collective)
+    if cls is None:
+        return Collective(algo.ngpus, 0, algo.inplace)
+    i_chunks = max(gpu.chunks['i'] for gpu in algo.gpus)
+    o_chunks = max(gpu.chunks['o'] for gpu in algo.gpus)
+    if cls is AllReduce:
+        chunk_factor = i_chunks
+    elif cls is AllGather:
+        # The input of an inplace allgather is part of its output
+        chunk_factor = o_chunks // algo.ngpus if algo.inplace else i_chunks
+    else:
+        chunk_factor = i_chunks // algo.ngpus
+    return cls(algo.ngpus, chunk_factor, algo.inplace)
+
+
+# Input, output and scratch arrays of a rank, where the input and output of an inplace collective alias as in NCCL
+def _rank_buffers(collective, gpu, chunk_size, dtype, rng):
+    in_chunks, out_chunks = collective.buffer_chunks()
+    in_chunks = max(in_chunks, gpu.chunks['i'])
+    out_chunks = max(out_chunks, gpu.chunks['o'])
+    # Uninitialized data is NaN so reading it shows in the output
+    fill = np.nan if np.issubdtype(dtype, np.floating) else 0
+    if collective.inplace:
+        buffer, index = collective.get_buffer_index(gpu.rank, Buffer.input, 0)
+        if buffer == Buffer.output:
+            output = np.full(max(out_chunks, index + in_chunks) * chunk_size, fill, dtype=dtype)
+            input = output[index*chunk_size:(index+in_chunks)*chunk_size]
+        else:
+            buffer, index = collective.get_buffer_index(gpu.rank, Buffer.output, 0)
+            input = np.full(max(in_chunks, index + out_chunks) * chunk_size, fill, dtype=dtype)
+            output = input[index*chunk_size:(index+out_chunks)*chunk_size]
+    else:
+        input = np.full(in_chunks * chunk_size, fill, dtype=dtype)
+        output = np.full(out_chunks * chunk_size, fill, dtype=dtype)
+    input[:] = rng.integers(0, 16, len(input))
+    return {'i': input, 'o': output, 's': np.full(gpu.chunks['s'] * chunk_size, fill, dtype=dtype)}
+
+
+class _Execution:
+    def __init__(self, algo, buffers, chunk_size):
+        self.buffers = buffers
+        self.chunk_size = chunk_size
+        self.cond = threading.Condition()
+        self.progress = {(tb.rank, tb.id): 0 for tb in algo.tbs} # Number of steps each threadblock completed
+        self.messages = defaultdict(deque) # (src, dst, channel) -> messages not received yet
+        self.waiting = {} # (rank, tbid) -> condition its thread waits for
+        self.running = len(algo.tbs)
+        self.stopped = False
+        self.errors = []
+
+    # Stops the execution if every running thread waits on a condition that does not hold. Called with cond held.
+    def check_deadlock(self):
+        if self.running > 0 and len(self.waiting) == self.running and not any(ready() for ready in self.waiting.values()):
+            self.stopped = True
+            self.cond.notify_all()
+
+    # Blocks until ready() holds, returns False if the execution stopped first
+    def wait(self, key, ready):
+        with self.cond:
+            while not ready():
+                if self.stopped:
+                    return False
+                self.waiting[key] = ready
+                self.check_deadlock()
+                if not self.stopped:
+                    self.cond.wait()
+            self.waiting.pop(key, None)
+            return True
+
+    def send(self, conn, data):
+        with self.cond:
+            self.messages[conn].append(data)
+            self.cond.notify_all()
+
+    def recv(self, key, conn):
+        with self.cond:
+            if not self.wait(key, lambda: len(self.messages[conn]) > 0):
+                return None
+            return self.messages[conn].popleft()
+
+    # Executes a step, returns False if the execution stopped before it completed
+    def step(self, tb, s, step):
+        key = (tb.rank, tb.id)
+        size = step.cnt * self.chunk_size
+
+        def view(ref):
+            buffer, index = ref
+            array = self.buffers[tb.rank][buffer]
+            if index < 0 or (index + step.cnt) * self.chunk_size > len(array):
+                raise IndexError(f'step {s} accesses chunks {index} to {index + step.cnt} of buffer {buffer} of {len(array) // self.chunk_size} chunks')
+            return array[index*self.chunk_size:(index+step.cnt)*self.chunk_size]
+
+        if step.dep is not None:
+            dep = (tb.rank, step.dep[0])
+            if dep not in self.progress:
+                raise ValueError(f'step {s} depends on missing threadblock {step.dep[0]}')
+            if not self.wait(key, lambda: self.progress[dep] > step.dep[1]):
+                return False
+        if step.type in _recv_types:
+            data = self.recv(key, (tb.recv, tb.rank, tb.channel))
+            if data is None:
+                return False
+            if len(data) != size:
+                raise ValueError(f'step {s} receives {step.cnt} chunks but rank {tb.recv} sent {len(data) // self.chunk_size}')
+
+        if step.type == 's':
+            data = view(step.src).copy()
+        elif step.type in ('r', 'rcs'):
+            view(step.dst)[:] = data
+        elif step.type == 'rrs':
+            data = data + view(step.src)
+        elif step.type in ('rrc', 'rrcs'):
+            data = data + view(step.src)
+            view(step.dst)[:] = data
+        elif step.type == 'cpy':
+            view(step.dst)[:] = view(step.src)
+        elif step.type == 're':
+            dst = view(step.dst)
+            np.add(dst, view(step.src), out=dst)
+        elif step.type != 'nop':
+            raise ValueError(f'step {s} has unknown type {step.type}')
+        if step.type in _send_types:
+            self.send((tb.rank, tb.send, tb.channel), data)
+
+        with self.cond:
+            self.progress[key] += 1
+            self.cond.notify_all()
+        return True
+
+    def run_threadblock(self, tb):
+        try:
+            for s, step in enumerate(tb.steps):
+                if not self.step(tb, s, step):
+                    return
+        except Exception as e:
+            with self.cond:
+                self.errors.append(f'Rank {tb.rank} threadblock {tb.id}: {e}')
+                self.stopped = True
+                self.cond.notify_all()
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.waiting.pop((tb.rank, tb.id), None)
+                self.check_deadlock()
+
+
+# Runs an algorithm on random integer valued NumPy buffers and checks its outputs against its collective.
+# program is a Program returned by MSCCLProgram.lower(), a path to an XML file or a string of XML.
+# The collective is inferred from the XML unless given as a msccl.language.collectives.Collective.
+# chunk_size is the number of elements of a chunk. Custom collectives are executed but not checked.
+def execute(program, collective=None, chunk_size=4, dtype=np.float32, seed=0):
+    algo = _load_algo(program)
+    if collective is None:
+        collective = _infer_collective(algo)
+    rng = np.random.default_rng(seed)
+    buffers = {gpu.rank: _rank_buffers(collective, gpu, chunk_size, dtype, rng) for gpu in algo.gpus}
+    inputs = [buffers[r]['i'].reshape(-1, chunk_size).copy() for r in range(algo.ngpus)]
+
+    execution = _Execution(algo, buffers, chunk_size)
+    threads = [threading.Thread(target=execution.run_threadblock, args=(tb,), daemon=True) for tb in algo.tbs]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    outputs = [buffers[r]['o'] for r in range(algo.ngpus)]
+    result = ExecutionResult(elapsed, outputs, execution.errors)
+    result.stuck = [(tb.rank, tb.id, execution.progress[(tb.rank, tb.id)]) for tb in algo.tbs
+        if execution.progress[(tb.rank, tb.id)] < len(tb.steps) and len(execution.errors) == 0]
+    if not result.correct:
+        return result
+    expected = collective.reference(inputs)
+    if expected is not None:
+        for r in range(algo.ngpus):
+            output = outputs[r].reshape(-1, chunk_size)
+            for c in np.flatnonzero(~np.all(output[:len(expected[r])] == expected[r], axis=1)):
+                result.errors.append(f'Rank {r} chunk {c} is incorrect should be {expected[r][c]} given {output[c]}')
+    return result
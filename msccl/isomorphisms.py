@@ -3,6 +3,7 @@
 
 from z3 import *
 from dataclasses import dataclass
+from collections import defaultdict
 
 @dataclass
 class Permutation:
@@ -11,6 +12,14 @@ class Permutation:
     def __str__(self):
         return f'Permutation(nodes={self.nodes})'
 
+@dataclass
+class Automorphism:
+    nodes: list
+    chunks: list
+
+    def __str__(self):
+        return f'Automorphism(nodes={self.nodes}, chunks={self.chunks})'
+
 def _pn(node):
     return Int(f'perm_node_{node}')
 
@@ -86,3 +95,115 @@ def find_isomorphisms(topology, target_topology, limit=None, logging=False):
     if logging:
         print(f'{len(isomorphisms)} isomorphisms found.')
     return isomorphisms
+
+# Returns the permutation of chunks that together with the node permutation maps the collective onto itself, or
+# None if there is none. Chunks with the same pre- and postconditions are paired in order.
+def _chunk_permutation(collective, nodes):
+    def signature(chunk, perm):
+        pre = frozenset(perm[rank] for rank in collective.ranks() if collective.precondition(rank, chunk))
+        post = frozenset(perm[rank] for rank in collective.ranks() if collective.postcondition(rank, chunk))
+        return pre, post
+
+    identity = list(collective.ranks())
+    by_signature = defaultdict(list)
+    permuted = defaultdict(list)
+    for chunk in collective.chunks():
+        by_signature[signature(chunk, identity)].append(chunk)
+        permuted[signature(chunk, nodes)].append(chunk)
+    chunks = [None] * collective.num_chunks
+    for sig, sources in permuted.items():
+        targets = by_signature.get(sig, [])
+        if len(targets) != len(sources):
+            return None
+        for chunk, target in zip(sources, targets):
+            chunks[chunk] = target
+
+    # Chunks at the same address have to be mapped to chunks at the same address
+    addresses = {}
+    for chunk in collective.chunks():
+        if addresses.setdefault(collective.address(chunk), collective.address(chunks[chunk])) != collective.address(chunks[chunk]):
+            return None
+    if len(set(addresses.values())) != len(addresses):
+        return None
+
+    for rank in collective.ranks():
+        for chunk in collective.chunks():
+            trigger = collective.trigger(rank, chunk)
+            mapped = collective.trigger(nodes[rank], chunks[chunk])
+            if (trigger == None) != (mapped == None) or (trigger != None and chunks[trigger] != mapped):
+                return None
+    return chunks
+
+def _switches_preserved(topology, nodes):
+    switches = set((frozenset(srcs), frozenset(dsts), bw) for srcs, dsts, bw, _ in topology.switches)
+    for srcs, dsts, bw in switches:
+        if (frozenset(nodes[src] for src in srcs), frozenset(nodes[dst] for dst in dsts), bw) not in switches:
+            return False
+    return True
+
+# Yields the permutations of the nodes that preserve links and only map nodes to nodes of the same color, in
+# lexicographic order. Backtracks over partial permutations, which is much faster than enumerating with Z3.
+def _node_automorphisms(topology, colors):
+    nodes = list(topology.nodes())
+    perm = []
+    used = [False] * len(nodes)
+
+    def extend():
+        node = len(perm)
+        if node == len(nodes):
+            yield list(perm)
+            return
+        for image in nodes:
+            if used[image] or colors[image] != colors[node]:
+                continue
+            if topology.link(node, node) != topology.link(image, image):
+                continue
+            if any(topology.link(node, prev) != topology.link(image, perm[prev]) or
+                   topology.link(prev, node) != topology.link(perm[prev], image) for prev in range(node)):
+                continue
+            perm.append(image)
+            used[image] = True
+            yield from extend()
+            used[image] = False
+            perm.pop()
+
+    yield from extend()
+
+def find_automorphisms(topology, collective, limit=None, logging=False):
+    '''
+    Finds automorphisms of a topology that also map the collective onto itself, i.e. permutations of the nodes
+    and chunks that preserve links, switches, pre- and postconditions, addresses and triggers. The identity is
+    the first one. Returns a list of at most limit automorphisms.
+    '''
+    if limit != None and limit <= 0:
+        raise ValueError('MSCCL error: limit was set improperly.')
+
+    if topology.num_nodes() != collective.num_nodes:
+        raise ValueError('MSCCL error: collective does not match with the given topology.')
+
+    # Nodes can only be mapped to nodes starting and ending with as many chunks
+    def color(rank):
+        pre = sum(1 for chunk in collective.chunks() if collective.precondition(rank, chunk))
+        post = sum(1 for chunk in collective.chunks() if collective.postcondition(rank, chunk))
+        return pre, post
+    colors = [color(node) for node in topology.nodes()]
+
+    automorphisms = []
+    for nodes in _node_automorphisms(topology, colors):
+        if not _switches_preserved(topology, nodes):
+            continue
+        chunks = _chunk_permutation(collective, nodes)
+        if chunks == None:
+            continue
+        automorphism = Automorphism(nodes, chunks)
+        automorphisms.append(automorphism)
+
+        if logging:
+            print(automorphism)
+
+        if limit != None and len(automorphisms) >= limit:
+            break
+
+    if logging:
+        print(f'{len(automorphisms)} automorphisms of {topology.name} and {collective.name} found.')
+    return automorphisms
@@ -4,12 +4,14 @@
 from dataclasses import dataclass
 from enum import Enum
 import functools
+import sys
 from msccl.language.ir import *
 from msccl.language.passes import *
 from msccl.language.tb_assignment import *
 from msccl.language.chunk import *
 from msccl.language.buffer import *
 from msccl.language.rank_dag import *
+from msccl.language.profiling import *
 import msccl.collectives as collectives
 import logging
 # from msccl.language.visualize import *
@@ -26,7 +28,8 @@ def _curr():
 class MSCCLProgram:
     def __init__(self, name, topo, collective, instances, protocol='Simple', \
             threadblock_policy=ThreadblockPolicy.auto, interleaved_replication=True,
-            instr_fusion=True, check_xml=True, dependence_nop=False):
+            instr_fusion=True, check_xml=True, dependence_nop=False, profile=None,
+            schedule_policy=SchedulePolicy.chunk_step, profile_memory=None):
         self.name = name
         self.topo = topo
         self.collective = collective       
@@ -38,17 +41,31 @@ class MSCCLProgram:
         self.instr_fusion = instr_fusion
         self.check_xml = check_xml
         self.dependence_nop = dependence_nop
+        self.schedule_policy = schedule_policy
+        # Records a LoweringProfile of lower() in lowering_profile, True or a path to also append it to as JSON
+        self.profile = default_profile() if profile is None else profile
+        # Profiles the peak memory and DAG size after each pass instead of its time, this also enables profiling
+        self.profile_memory = default_profile_memory() if profile_memory is None else profile_memory
+        self.lowering_profile = None
+        self.lowered = None # Program returned by lower()
         assert protocol == 'Simple' or protocol == 'LL' or protocol == 'LL128', \
             f'Given protocol: {protocol}. Must be either Simple, LL, LL128'
         self.run_opt = True # Runs optimization passes
         # Initialize the input buffers
         # self.chunk_dag = ChunkDAG()
-        self.buffers = collective.init_buffers()
+        self.buffers = self._init_buffers()
         self.instr_dag = InstructionDAG(self.num_ranks, self.buffers)
         for r in range(self.num_ranks):
-            for index, chunk in enumerate(self.buffers[r][Buffer.input]):
+            # One start op for every run of input chunks that are consecutive in the buffer they are in
+            runs = [] # [buffer, index, size]
+            for index in range(len(self.buffers[r][Buffer.input])):
                 buffer, index = self.collective.get_buffer_index(r, Buffer.input, index)
-                ref = self.get_ref(r, buffer, index, 1)
+                if len(runs) > 0 and runs[-1][0] == buffer and runs[-1][1] + runs[-1][2] == index:
+                    runs[-1][2] += 1
+                else:
+                    runs.append([buffer, index, 1])
+            for buffer, index, size in runs:
+                ref = self.get_ref(r, buffer, index, size)
                 # self.chunk_dag.init_chunk(chunk, ref)
                 self.instr_dag.add_start(r, buffer, index, ref)
 
@@ -64,14 +81,26 @@ class MSCCLProgram:
             raise RuntimeError("This program is not currently in context")
         _current_program = None
 
+    # Initializes the buffers of the collective, converting list buffers (e.g. from custom collectives)
+    # into ChunkBuffers. Buffers that are the same list on a rank stay the same ChunkBuffer.
+    def _init_buffers(self):
+        buffers = self.collective.init_buffers()
+        converted = {} # id(list) -> (list, ChunkBuffer)
+        for rank_buffers in buffers:
+            for key, buf in rank_buffers.items():
+                if not isinstance(buf, ChunkBuffer):
+                    if id(buf) not in converted:
+                        converted[id(buf)] = (buf, ChunkBuffer.from_chunks(buf))
+                    rank_buffers[key] = converted[id(buf)][1]
+        return buffers
+
     # Tracks a send operation on the buffers
     def apply_send(self, src, src_buffer, src_index, dst, dst_buffer, dst_index, size):
         src_buffer, src_index = self.collective.get_buffer_index(src, src_buffer, src_index)
         dst_buffer, dst_index = self.collective.get_buffer_index(dst, dst_buffer, dst_index)
         sb = self.buffers[src][src_buffer]
         db = self.buffers[dst][dst_buffer]
-        for i in range(size):
-            db[dst_index + i] = sb[src_index + i]
+        db.copy_from(dst_index, sb, src_index, size)
 
     # Tracks a reduce operation on the buffers
     def apply_reduce(self, src, src_buffer, src_index, dst, dst_buffer, dst_index, size):
@@ -79,10 +108,7 @@ class MSCCLProgram:
         dst_buffer, dst_index = self.collective.get_buffer_index(dst, dst_buffer, dst_index)
         sb = self.buffers[src][src_buffer]
         db = self.buffers[dst][dst_buffer]
-        for i in range(size):
-            reduce_chunk = db[dst_index + i]
-            sent_chunk = sb[src_index + i]
-            db[dst_index + i] = reduce_chunk.reduce(dst, sent_chunk)
+        db.reduce_from(dst, dst_index, sb, src_index, size)
 
     def get_ref(self, rank, buffer, index, size):
         buffer, index = self.collective.get_buffer_index(rank, buffer, index)
@@ -107,32 +133,45 @@ class MSCCLProgram:
         return self.collective.check(self)
 
     # Lower program to XML
+    # The passes rewrite the instruction DAG, so the program is lowered once and later calls return the same Program
     def lower(self):
-        #logger.debug("lowring msccl program")
-        # self.chunk_dag._complete_metadata()
-        # self.chunk_dag.channel_assignment()
-        # self.chunk_dag.lower_instr_dag(self.instr_dag)
-        #logger.debug("Pre-emptively convert sets to lists")
-        self.instr_dag.convert_set_list() # Pre-emptively convert sets to lists
+        if self.lowered is not None:
+            return self.lowered
+        profiler = LoweringProfiler(self, self.profile_memory) if self.profile or self.profile_memory else NullProfiler()
+        with profiler.measure('convert_set_list'):
+            self.instr_dag.convert_set_list() # Pre-emptively convert sets to lists
         if self.instr_fusion:
-            #logger.debug("optimizing dag")
-            self.instr_dag.optimize()
-        self.instr_dag._complete_metadata()
+            with profiler.measure('optimize'):
+                self.instr_dag.optimize()
+        with profiler.measure('complete_metadata'):
+            self.instr_dag._complete_metadata()
         if self.threadblock_policy == ThreadblockPolicy.manual:
-            manual_assign_tbs(self.instr_dag)
+            with profiler.measure('manual_assign_tbs'):
+                manual_assign_tbs(self.instr_dag, self.schedule_policy)
         else:
-            auto_assign_tbs(self.instr_dag)
-        self.instr_dag.lower_pt1(self.instances)
-        gpu_prgms = self.instr_dag.lower_pt2(self.instances, self.interleaved_replication)
+            with profiler.measure('auto_assign_tbs'):
+                auto_assign_tbs(self.instr_dag, self.schedule_policy)
+        with profiler.measure('lower_pt1'):
+            self.instr_dag.lower_pt1(self.instances)
+        with profiler.measure('lower_pt2'):
+            gpu_prgms = self.instr_dag.lower_pt2(self.instances, self.interleaved_replication)
         if self.check_xml:
             # Check generated MSCCL-IR for correctness - no circular dependencies, sends and receives are ordered
-            # For very large programs, turn off check_xml when shipping 
-            check_dependency_cycles(self.instr_dag.tbs)
-            check_threadblock_ordering(self.instr_dag)
-        return Program(self.name, self.collective.name, self.collective.inplace, self.protocol, gpu_prgms)  
-
-    def generate_xml(self):
-        return ir_to_xml(self.lower(), dependence_nop=self.dependence_nop)
+            with profiler.measure('check_dependency_cycles'):
+                check_dependency_cycles(self.instr_dag.tbs)
+            with profiler.measure('check_threadblock_ordering'):
+                check_threadblock_ordering(self.instr_dag)
+        self.lowering_profile = profiler.report
+        if profiler.report is not None and self.profile not in (True, False):
+            profiler.report.dump(self.profile)
+        self.lowered = Program(self.name, self.collective.name, self.collective.inplace, self.protocol, gpu_prgms)
+        return self.lowered
+
+    # Returns the XML of the program, or streams it to path (a path or file-like object) if given
+    def generate_xml(self, path=None):
+        if path is None:
+            return ir_to_xml(self.lower(), dependence_nop=self.dependence_nop)
+        write_xml(self.lower(), path, dependence_nop=self.dependence_nop)
     
     def print_chunk_dag(self):
         visualize_chunk_dag(self.chunk_dag.chunk_paths)
@@ -156,7 +195,8 @@ def create_scratch(rank, name):
     return _curr().create_scratch(rank, name)
 
 def XML():
-    print(_curr().generate_xml())
+    _curr().generate_xml(sys.stdout)
+    print()
 
 def Check():
     return _curr().check()
@@ -259,17 +299,20 @@ class Ref(ChunkRef):
 
         return self
 
+    def _get_field(self, field, index):
+        return self.prog.buffers[self.rank][self.buffer].get_field(field, index)
+
     def get_origin_index(self, index=0):
-        return self._get_chunk(index + self.index).origin_index
+        return self._get_field('origin_index', index + self.index)
 
     def get_origin_rank(self, index=0):
-        return self._get_chunk(index + self.index).origin_rank
+        return self._get_field('origin_rank', index + self.index)
 
     def get_dst_index(self, index=0):
-        return self._get_chunk(index + self.index).dst_index
+        return self._get_field('dst_index', index + self.index)
 
     def get_dst_rank(self, index=0):
-        return self._get_chunk(index + self.index).dst_rank
+        return self._get_field('dst_rank', index + self.index)
 
     def print_chunk_info(self, index=0):
         print(self._get_chunk(index + self.index)) 
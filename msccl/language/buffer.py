@@ -1,13 +1,168 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+import numpy as np
+from msccl.language.chunk import Chunk, ReduceChunk
+
+# Row of each Chunk field in ChunkBuffer.fields
+_chunk_fields = {'origin_rank': 0, 'origin_index': 1, 'dst_rank': 2, 'dst_index': 3}
+
+# Elementwise reduce_chunk.reduce(dst, sent_chunk) over object arrays
+_reduce_chunks = np.frompyfunc(lambda reduce_chunk, dst, sent_chunk: reduce_chunk.reduce(dst, sent_chunk), 3, 1)
+
+# Array-backed buffer of chunks. Slot i holds either nothing, a Chunk stored as column i of
+# fields = [origin_rank, origin_index, dst_rank, dst_index], or a ReduceChunk stored in reduced[i].
+# Indexing materializes the Chunk, copies and reductions of ranges work on whole slices.
+class ChunkBuffer:
+    def __init__(self, size=0, growable=False):
+        self.size = size
+        self.growable = growable
+        self.fields = np.full((4, size), -1, dtype=np.int32) # An origin_rank of -1 marks an empty slot
+        self.reduced = None # Object array of ReduceChunks, allocated on the first reduction
+
+    @property
+    def origin_rank(self):
+        return self.fields[0, :self.size]
+
+    @property
+    def origin_index(self):
+        return self.fields[1, :self.size]
+
+    @property
+    def dst_rank(self):
+        return self.fields[2, :self.size]
+
+    @property
+    def dst_index(self):
+        return self.fields[3, :self.size]
+
+    # Creates a buffer holding the chunks of a list (e.g. returned by Collective.init_buffers)
+    @classmethod
+    def from_chunks(cls, chunks):
+        buf = cls(len(chunks))
+        for index, chunk in enumerate(chunks):
+            if chunk is not None:
+                buf[index] = chunk
+        return buf
+
+    # Creates a buffer with a Chunk in every slot from arrays of the chunk fields
+    @classmethod
+    def from_arrays(cls, origin_rank, origin_index, dst_rank=-1, dst_index=-1):
+        buf = cls(len(origin_index))
+        buf.fields[0] = origin_rank
+        buf.fields[1] = origin_index
+        buf.fields[2] = dst_rank
+        buf.fields[3] = dst_index
+        return buf
+
+    # Returns a buffer covering the range [start, end) with a copy of its chunks
+    def slice(self, start, end):
+        buf = ChunkBuffer(end - start)
+        buf.copy_from(0, self, start, end - start)
+        return buf
+
+    def _reserve(self, end):
+        if end <= self.size:
+            return
+        if not self.growable:
+            raise IndexError(f'Index {end-1} out of range for buffer of size {self.size}')
+        capacity = self.fields.shape[1]
+        if end > capacity:
+            capacity = max(end, 2 * capacity)
+            fields = np.full((4, capacity), -1, dtype=np.int32)
+            fields[:, :self.size] = self.fields[:, :self.size]
+            self.fields = fields
+            if self.reduced is not None:
+                reduced = np.full(capacity, None, dtype=object)
+                reduced[:self.size] = self.reduced[:self.size]
+                self.reduced = reduced
+        self.size = end
+
+    def _reduced(self):
+        if self.reduced is None:
+            self.reduced = np.full(self.fields.shape[1], None, dtype=object)
+        return self.reduced
+
+    def _check_index(self, index):
+        if index < 0:
+            index += self.size
+        if index < 0 or index >= self.size:
+            raise IndexError(f'Index {index} out of range for buffer of size {self.size}')
+        return index
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for index in range(self.size):
+            yield self[index]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.size))]
+        index = self._check_index(index)
+        if self.reduced is not None and self.reduced[index] is not None:
+            return self.reduced[index]
+        if self.fields[0, index] == -1:
+            return None
+        return Chunk(*self.fields[:, index].tolist())
+
+    def __setitem__(self, index, value):
+        self._reserve(index + 1)
+        index = self._check_index(index)
+        if self.reduced is not None:
+            self.reduced[index] = None
+        if type(value) is Chunk:
+            self.fields[:, index] = (value.origin_rank, value.origin_index, value.dst_rank, value.dst_index)
+        else:
+            self.fields[:, index] = -1
+            if value is not None:
+                assert type(value) is ReduceChunk, f'Buffers can only hold chunks, given {value}'
+                self._reduced()[index] = value
+
+    # Returns a field of the Chunk at index without materializing it
+    def get_field(self, field, index):
+        index = self._check_index(index)
+        if self.fields[0, index] == -1:
+            # Empty or reduced slot, fail or succeed the same way the chunk would
+            return getattr(self[index], field)
+        return int(self.fields[_chunk_fields[field], index])
+
+    # Copies size chunks starting at src[src_index] to this buffer starting at index
+    def copy_from(self, index, src, src_index, size):
+        self._reserve(index + size)
+        self.fields[:, index:index+size] = src.fields[:, src_index:src_index+size]
+        if src.reduced is not None:
+            self._reduced()[index:index+size] = src.reduced[src_index:src_index+size]
+        elif self.reduced is not None:
+            self.reduced[index:index+size] = None
+
+    # Returns the chunks in [index, index+size) as an object array
+    def _objects(self, index, size):
+        if self.reduced is None:
+            objs = np.full(size, None, dtype=object)
+        else:
+            objs = self.reduced[index:index+size].copy()
+        # Reduced slots have an origin rank of -1 and keep their ReduceChunk
+        for i, fields in enumerate(zip(*self.fields[:, index:index+size].tolist())):
+            if fields[0] != -1:
+                objs[i] = Chunk(*fields)
+        return objs
+
+    # Reduces size chunks starting at src[src_index] into this buffer starting at index on rank dst
+    def reduce_from(self, dst, index, src, src_index, size):
+        result = _reduce_chunks(self._objects(index, size), dst, src._objects(src_index, size))
+        self.fields[:, index:index+size] = -1
+        self._reduced()[index:index+size] = result
+
+
 # Scratch buffer slice with manual indexing
-class BufferSlice:
+class BufferSlice(ChunkBuffer):
     def __init__(self, buf, name):
+        ChunkBuffer.__init__(self, growable=True)
         self.name = name
         self.buf = buf
         self.offset = -1 # Offset into the global scratch buffer
-        self.chunks = []
 
     # Returns the global index into the scratch buffer
     def get_global_index(self, index):
@@ -18,23 +173,7 @@ class BufferSlice:
         return self.buf
 
     def instance_size(self):
-        return len(self.chunks)
+        return len(self)
 
     def set_offset(self, offset):
         self.offset = offset
-
-    def __getitem__(self, index):
-        return self.chunks[index]
-    
-    def __setitem__(self, index, value):
-        current_size = len(self.chunks)
-        while index > current_size:
-            self.chunks.append(None)
-            current_size = len(self.chunks)
-        if index == current_size:
-            self.chunks.append(value)
-        else:
-            self.chunks[index] = value
-
-    def __len__(self):
-        return len(self.chunks)
\ No newline at end of file
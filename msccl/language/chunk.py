@@ -15,7 +15,7 @@ class Chunk:
     def reduce(self, dst, chunk):
         if type(chunk) is ReduceChunk:
             return chunk.reduce(dst, self)
-        elif type(chunk) is Chunk:  
+        elif type(chunk) is Chunk:
             chunks = [self, chunk]
             return ReduceChunk(dst, chunks)
         else:
@@ -32,30 +32,106 @@ class Chunk:
         return self.origin_rank < other.origin_rank or \
                (self.origin_rank == other.origin_rank and self.origin_index < other.origin_index)
 
-@dataclass
+# Merges two bitsets given as sorted tuples of (origin_index, origin_rank bitmask) containers.
+# Returns the union and the containers of the chunks present in both.
+def _union_bitsets(bitset1, bitset2):
+    # Common case of reducing chunks of the same index
+    if len(bitset1) == 1 and len(bitset2) == 1 and bitset1[0][0] == bitset2[0][0]:
+        index, mask1 = bitset1[0]
+        mask2 = bitset2[0][1]
+        overlap = mask1 & mask2
+        return ((index, mask1 | mask2),), (((index, overlap),) if overlap else ())
+    containers = dict(bitset1)
+    overlap = []
+    for index, mask in bitset2:
+        current = containers.get(index, 0)
+        if current & mask:
+            overlap.append((index, current & mask))
+        containers[index] = current | mask
+    return tuple(sorted(containers.items())), overlap
+
+# Merges two duplicate counts, sorted tuples of ((origin_index, origin_rank), count) for the chunks reduced
+# more than once with the number of times they were reduced beyond the first, and counts the chunks in the
+# overlap containers once more.
+def _add_duplicates(duplicates1, duplicates2, overlap):
+    if not overlap and not duplicates2:
+        return duplicates1
+    if not overlap and not duplicates1:
+        return duplicates2
+    counts = dict(duplicates1)
+    for chunk, count in duplicates2:
+        counts[chunk] = counts.get(chunk, 0) + count
+    for index, mask in overlap:
+        rank = 0
+        while mask:
+            if mask & 1:
+                counts[(index, rank)] = counts.get((index, rank), 0) + 1
+            mask >>= 1
+            rank += 1
+    return tuple(sorted(counts.items()))
+
 class ReduceChunk:
-    creation_rank: int # Rank the Reduce Chunk is created. Necessary since the same ReduceChunk can be created on multiple ranks independently
-    chunks: list # List of chunks reduced
+    __slots__ = ('creation_rank', 'bitset', 'duplicates', '_hash')
+
+    # creation_rank: Rank the Reduce Chunk is created. Necessary since the same ReduceChunk can be created on multiple ranks independently
+    # chunks: List of chunks reduced
+    def __init__(self, creation_rank, chunks):
+        self.creation_rank = creation_rank
+        # The reduced chunks are a bitset of origin ranks per origin index, stored as a
+        # sorted tuple of (origin_index, origin_rank bitmask) containers
+        self.bitset = ()
+        # Chunks that are reduced more than once are counted in duplicates, which is empty otherwise
+        self.duplicates = ()
+        self._hash = None
+        for chunk in chunks:
+            self.bitset, overlap = _union_bitsets(self.bitset, ((chunk.origin_index, 1 << chunk.origin_rank),))
+            self.duplicates = _add_duplicates(self.duplicates, (), overlap)
+
+    @classmethod
+    def _from_bitset(cls, creation_rank, bitset, duplicates):
+        rc = cls.__new__(cls)
+        rc.creation_rank = creation_rank
+        rc.bitset = bitset
+        rc.duplicates = duplicates
+        rc._hash = None
+        return rc
 
     def reduce(self, dst, chunk):
         if type(chunk) is ReduceChunk:
-            chunks = self.chunks + chunk.chunks
-        elif type(chunk) is Chunk:  
-            chunks =self.chunks + [chunk]
+            bitset, overlap = _union_bitsets(self.bitset, chunk.bitset)
+            duplicates = _add_duplicates(self.duplicates, chunk.duplicates, overlap)
+        elif type(chunk) is Chunk:
+            bitset, overlap = _union_bitsets(self.bitset, ((chunk.origin_index, 1 << chunk.origin_rank),))
+            duplicates = _add_duplicates(self.duplicates, (), overlap)
         else:
             assert True, "Trying to reduce with chunk of None"
-        return ReduceChunk(self.creation_rank, chunks)
+        return ReduceChunk._from_bitset(self.creation_rank, bitset, duplicates)
 
-    def sort(self):
-        self.chunks.sort()
+    # Sorted list of the chunks reduced, with a chunk reduced more than once repeated
+    @property
+    def chunks(self):
+        counts = dict(self.duplicates)
+        chunks = []
+        for index, mask in self.bitset:
+            rank = 0
+            while mask:
+                if mask & 1:
+                    chunks.extend(Chunk(rank, index) for _ in range(1 + counts.get((index, rank), 0)))
+                mask >>= 1
+                rank += 1
+        chunks.sort()
+        return chunks
 
     def __hash__(self):
-        self.sort()
-        return hash((self.creation_rank,) + tuple(self.chunks))
+        if self._hash is None:
+            self._hash = hash((self.bitset, self.duplicates))
+        return self._hash
 
-    # Two reduce chunks are equal if they contain the same list of
-    # chunks being reduced
+    # Two reduce chunks are equal if they contain the same chunks being
+    # reduced the same number of times
     def __eq__(self, other):
-        self.sort()
-        other.sort()
-        return self.chunks == other.chunks
+        return type(other) is ReduceChunk and self.duplicates == other.duplicates and \
+            hash(self) == hash(other) and self.bitset == other.bitset
+
+    def __repr__(self):
+        return f'ReduceChunk(creation_rank={self.creation_rank}, chunks={self.chunks})'
@@ -1,4 +1,5 @@
 from dataclasses import dataclass, field
+import numpy as np
 from msccl.language.ir import Buffer
 from msccl.language import *
 
@@ -18,6 +19,15 @@ class Collective():
     def get_buffer_index(self, rank, buffer, index):
         return buffer, index
 
+    # Number of chunks in the input and output buffer of a rank
+    def buffer_chunks(self):
+        return self.chunk_factor, self.chunk_factor
+
+    # Expected output buffer of every rank given the input buffer of every rank as arrays of shape (chunks, elements)
+    # or None if the collective does not define its result
+    def reference(self, inputs):
+        return None
+
 
 class AllToAll(Collective):
 
@@ -27,13 +37,12 @@ class AllToAll(Collective):
 
     def init_buffers(self):
         chunks_per_node = self.num_ranks * self.chunk_factor
+        index = np.arange(chunks_per_node)
         rank_buffers = []
         for r in range(self.num_ranks):
-            input_buffer = [None] * chunks_per_node
-            output_buffer = [None] * chunks_per_node
-            for index in range(chunks_per_node):
-                chunk = Chunk(r, index, index//self.chunk_factor, index % self.chunk_factor + r*self.chunk_factor)
-                input_buffer[index] = chunk
+            # Chunk index starts at rank r and ends on rank index//chunk_factor
+            input_buffer = ChunkBuffer.from_arrays(r, index, index // self.chunk_factor, index % self.chunk_factor + r*self.chunk_factor)
+            output_buffer = ChunkBuffer(chunks_per_node)
             if self.inplace:
                 buffers = {Buffer.input : input_buffer, 
                     Buffer.output : input_buffer}
@@ -46,19 +55,27 @@ class AllToAll(Collective):
     # Expected output buffer for alltoall
     def check(self, prog):
         chunks_per_node = self.num_ranks * self.chunk_factor
+        index = np.arange(chunks_per_node)
+        expected_origin_rank = index // self.chunk_factor
         correct = True
         for r in range(self.num_ranks):
             output = prog.buffers[r][Buffer.output]
-            for i in range(self.num_ranks):
-                for ch in range(self.chunk_factor):
-                    index = ch + i * self.chunk_factor
-                    chunk = output[index]
-                    expected_origin_index = ch + r * self.chunk_factor
-                    if chunk is None or chunk.origin_rank != i or chunk.origin_index != expected_origin_index:
-                        print(f'Rank {r} chunk {index} is incorrect should be chunk({i},{expected_origin_index}) given {chunk}')
-                        correct = False
+            expected_origin_index = index % self.chunk_factor + r * self.chunk_factor
+            # Empty and reduced slots have an origin rank of -1 and never match
+            matches = (output.origin_rank[:chunks_per_node] == expected_origin_rank) & \
+                (output.origin_index[:chunks_per_node] == expected_origin_index)
+            for i in np.flatnonzero(~matches):
+                print(f'Rank {r} chunk {i} is incorrect should be chunk({expected_origin_rank[i]},{expected_origin_index[i]}) given {output[i]}')
+                correct = False
         return correct
 
+    def buffer_chunks(self):
+        return self.num_ranks * self.chunk_factor, self.num_ranks * self.chunk_factor
+
+    def reference(self, inputs):
+        cf = self.chunk_factor
+        return [np.concatenate([inputs[r][dst*cf:(dst+1)*cf] for r in range(self.num_ranks)]) for dst in range(self.num_ranks)]
+
 
 class AllGather(Collective):
     def __init__(self, num_ranks, chunk_factor, inplace):
@@ -68,21 +85,19 @@ class AllGather(Collective):
     # Initializes input buffer for an allgather
     def init_buffers(self):
         rank_buffers = []
+        ch = np.arange(self.chunk_factor)
         if self.inplace:
             # Inplace AllGather only uses the output buffer   
             for r in range(self.num_ranks):
-                output_buffer = [None] * (self.num_ranks * self.chunk_factor)
-                for ch in range(self.chunk_factor):
-                    output_buffer[r*self.chunk_factor+ch] = Chunk(r, ch, -1, r*self.chunk_factor+ch)
-                buffers = {Buffer.input : output_buffer[r*self.chunk_factor:(r+1)*self.chunk_factor],
+                output_buffer = ChunkBuffer(self.num_ranks * self.chunk_factor)
+                output_buffer.copy_from(r*self.chunk_factor, ChunkBuffer.from_arrays(r, ch, -1, r*self.chunk_factor+ch), 0, self.chunk_factor)
+                buffers = {Buffer.input : output_buffer.slice(r*self.chunk_factor, (r+1)*self.chunk_factor),
                            Buffer.output : output_buffer}
                 rank_buffers.append(buffers)
         else:
             for r in range(self.num_ranks):
-                input_buffer = [None] * self.chunk_factor
-                output_buffer = [None] * (self.num_ranks * self.chunk_factor)
-                for ch in range(self.chunk_factor):
-                    input_buffer[ch] = Chunk(r, ch, -1, r*self.chunk_factor+ch)
+                input_buffer = ChunkBuffer.from_arrays(r, ch, -1, r*self.chunk_factor+ch)
+                output_buffer = ChunkBuffer(self.num_ranks * self.chunk_factor)
                 buffers = {Buffer.input : input_buffer, 
                            Buffer.output : output_buffer}
                 rank_buffers.append(buffers)
@@ -92,20 +107,25 @@ class AllGather(Collective):
     def check(self, prog):
         correct = True
         buf = Buffer.output
+        num_chunks = self.num_ranks * self.chunk_factor
+        index = np.arange(num_chunks)
+        expected_origin_rank = index // self.chunk_factor
+        expected_origin_index = index % self.chunk_factor
         for r in range(self.num_ranks):
             output = prog.buffers[r][buf]
-            for i in range(self.num_ranks):
-                for ch in range(self.chunk_factor):
-                    index = i*self.chunk_factor + ch
-                    chunk = output[index]
-                    if chunk is None:
-                        print(f'Rank {r} chunk {index} is incorrect should be ({i}, {ch}) given None')
-                        correct = False
-                    elif chunk.origin_rank != i or chunk.origin_index != ch:
-                        print(f'Rank {r} chunk {index} is incorrect should be ({i}, {ch}) given ({chunk.origin_rank}, {chunk.origin_index})')
-                        correct = False
+            # Empty and reduced slots have an origin rank of -1 and never match
+            matches = (output.origin_rank[:num_chunks] == expected_origin_rank) & \
+                (output.origin_index[:num_chunks] == expected_origin_index)
+            for i in np.flatnonzero(~matches):
+                print(f'Rank {r} chunk {i} is incorrect should be ({expected_origin_rank[i]}, {expected_origin_index[i]}) given {output[i]}')
+                correct = False
         return correct
 
+    def buffer_chunks(self):
+        return self.chunk_factor, self.num_ranks * self.chunk_factor
+
+    def reference(self, inputs):
+        return [np.concatenate(inputs)] * self.num_ranks
     
     def get_buffer_index(self, rank, buffer, index):
         # For inplace AllGathers, the input buffer points into the output buffer
@@ -124,13 +144,12 @@ class AllReduce(Collective):
 
     def init_buffers(self):
         chunks_per_node = self.chunk_factor
+        index = np.arange(chunks_per_node)
         rank_buffers = []
         for r in range(self.num_ranks):
-            input_buffer = []
-            output_buffer = [None] * chunks_per_node
-            for c in range(chunks_per_node):
-                # Chunks start at rank r index c, and ends on all ranks (-1) at index r
-                input_buffer.append(Chunk(r, c, -1, c))
+            # Chunks start at rank r index c, and ends on all ranks (-1) at index r
+            input_buffer = ChunkBuffer.from_arrays(r, index, -1, index)
+            output_buffer = ChunkBuffer(chunks_per_node)
             # Input and output buffer are the same.
             if self.inplace:
                 buffers = {Buffer.input : input_buffer, 
@@ -143,25 +162,23 @@ class AllReduce(Collective):
 
     def check(self, prog):
         chunks_per_node = self.chunk_factor
-        expected_chunks = []
         buf = Buffer.input if self.inplace else Buffer.output
-
-        for c in range(chunks_per_node):
-            chunk = ReduceChunk(-1, [])
-            for r in range(self.num_ranks):
-                chunk = chunk.reduce(-1, Chunk(r, c))
-            expected_chunks.append(chunk)
+        # Chunk c reduced once from every rank
+        all_ranks = (1 << self.num_ranks) - 1
 
         correct = True
         for r in range(self.num_ranks):
             output = prog.buffers[r][buf]
             for c in range(chunks_per_node):
                 chunk = output[c]
-                if chunk is None or chunk != expected_chunks[c]:
+                if type(chunk) is not ReduceChunk or chunk.duplicates or chunk.bitset != ((c, all_ranks),):
                     print(f'Rank {r} chunk {c} is incorrect should be ReduceChunk index {c} from all ranks, given {chunk}')
                     correct = False
         return correct
 
+    def reference(self, inputs):
+        return [sum(inputs)] * self.num_ranks
+
     def get_buffer_index(self, rank, buffer, index):
         if self.inplace and buffer == Buffer.output:
             return Buffer.input, index
@@ -176,33 +193,24 @@ class ReduceScatter(Collective):
 
     def init_buffers(self):
         rank_buffers = []
+        index = np.arange(self.num_ranks * self.chunk_factor)
         for r in range(self.num_ranks):
+            # Chunk index starts on rank r and ends on rank index//chunk_factor
+            input_buffer = ChunkBuffer.from_arrays(r, index, index // self.chunk_factor, index % self.chunk_factor)
             if self.inplace:
-                input_buffer = []
-                for i in range(self.num_ranks):
-                    for c in range(self.chunk_factor):
-                        input_buffer.append(Chunk(r, i*self.chunk_factor + c, i, c))
                 buffers = {Buffer.input : input_buffer}
                 rank_buffers.append(buffers)
             else:
-                input_buffer = []
-                output_buffer = [None] * self.chunk_factor
-                for i in range(self.num_ranks):
-                    for c in range(self.chunk_factor):
-                        input_buffer.append(Chunk(r, i*self.chunk_factor + c, i, c))
+                output_buffer = ChunkBuffer(self.chunk_factor)
                 buffers = {Buffer.input : input_buffer, 
                         Buffer.output : output_buffer}
                 rank_buffers.append(buffers)
         return rank_buffers
 
     def check(self, prog):
-        expected_chunks = []
         buf = Buffer.input if self.inplace else Buffer.output
-        for c in range(self.num_ranks * self.chunk_factor):
-            chunk = ReduceChunk(-1, [])
-            for r in range(self.num_ranks):
-                chunk = chunk.reduce(-1, Chunk(r, c))
-            expected_chunks.append(chunk)
+        # Chunk correct_idx reduced once from every rank
+        all_ranks = (1 << self.num_ranks) - 1
 
         correct = True
         for r in range(self.num_ranks):
@@ -212,11 +220,18 @@ class ReduceScatter(Collective):
                 if self.inplace:
                     c = correct_idx
                 chunk = output[c]
-                if chunk is None or chunk != expected_chunks[correct_idx]:
+                if type(chunk) is not ReduceChunk or chunk.duplicates or chunk.bitset != ((correct_idx, all_ranks),):
                     print(f'Rank {r} chunk {c} is incorrect should be index {correct_idx} from all ranks given {chunk}')
                     correct = False
         return correct
 
+    def buffer_chunks(self):
+        return self.num_ranks * self.chunk_factor, self.chunk_factor
+
+    def reference(self, inputs):
+        total = sum(inputs)
+        return [total[r*self.chunk_factor:(r+1)*self.chunk_factor] for r in range(self.num_ranks)]
+
     def get_buffer_index(self, rank, buffer, index):
         # For inplace ReduceScatter the output buffer is a pointer into the input buffer
         if self.inplace and buffer == Buffer.output:
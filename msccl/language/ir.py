@@ -5,6 +5,9 @@ from lxml import etree as ET
 from dataclasses import dataclass, field
 from enum import Enum
 from collections import defaultdict
+import gc
+import io
+import os
 
 
 @dataclass
@@ -14,6 +17,7 @@ class Program:
     inplace: bool
     protocol: str
     gpus: list = field(default_factory=list)
+    nchunksperloop: int = None # From the XML it was read from, if it has one
 
 
 @dataclass
@@ -66,6 +70,16 @@ class ThreadblockPolicy(Enum):
         return self.value
 
 
+# Orders instructions are scheduled in when assigning them to threadblocks, see topo_sort_instrs
+class SchedulePolicy(Enum):
+    chunk_step = 'chunk_step'
+    critical_path = 'critical_path'
+    link_round_robin = 'link_round_robin'
+
+    def __str__(self):
+        return self.value
+
+
 class Instruction(Enum):
     nop = 'nop'
     send = 's'
@@ -200,6 +214,92 @@ class Op:
         return f'Op({self.inst}, {self.rank}, {self.src}, {self.dst}, step:{self.step}, tb:{self.tb})'
 
 
+# Threadblock of instance `instance` of a replicated program. It has the ops of the base threadblock with the
+# buffer indices of instance instance and depends on the same instance of the threadblocks the base ops depend on.
+# write_xml emits these ops directly from the base threadblock, they are only created when ops is accessed.
+class InstanceThreadblock:
+    def __init__(self, base, instance, channel, replication):
+        self.base = base
+        self.instance = instance
+        self.channel = channel
+        self.send = base.send
+        self.recv = base.recv
+        self.rbid = -1
+        self.replication = replication
+        self._ops = None
+
+    @property
+    def ops(self):
+        if self._ops is None:
+            self.replication.materialize()
+        return self._ops
+
+    @ops.setter
+    def ops(self, ops):
+        self._ops = ops
+
+    def __repr__(self):
+        return f'InstanceThreadblock({self.instance}, channel:{self.channel}, send:{self.send}, recv:{self.recv})'
+
+
+# The instances of a replicated program. The refs of instance 0 of every base op are kept in refs, so that the
+# base ops are left unchanged, and instance i indexes them at index + i * stride where strides has the
+# (src, dst) stride of every base op.
+class Replication:
+    def __init__(self):
+        self.refs = {} # op -> (src, dst) of instance 0
+        self.strides = {} # op -> (src stride, dst stride)
+        self.tbs = [] # rank -> {tbid: InstanceThreadblock}
+
+    # Returns the src and dst of op in instance i
+    def instance_refs(self, op, i):
+        src, dst = self.refs.get(op, (op.src, op.dst))
+        src_stride, dst_stride = self.strides.get(op, (0, 0))
+        src_shift, dst_shift = i * src_stride, i * dst_stride
+        if src is not None and src_shift != 0:
+            src = ChunkRef(src.rank, src.buffer, src.index + src_shift, src.size)
+        if dst is not None and dst_shift != 0:
+            dst = ChunkRef(dst.rank, dst.buffer, dst.index + dst_shift, dst.size)
+        return src, dst
+
+    # Creates the ops of all instance threadblocks
+    def materialize(self):
+        instance_tbs = {} # (base threadblock, instance) -> instance threadblock
+        located = {} # base op -> (base threadblock, step)
+        for rank_tbs in self.tbs:
+            for itb in rank_tbs.values():
+                instance_tbs[(itb.base, itb.instance)] = itb
+                for step, op in enumerate(itb.base.ops):
+                    located[op] = (itb.base, step)
+        for rank_tbs in self.tbs:
+            for itbid, itb in rank_tbs.items():
+                ops = []
+                for op in itb.base.ops:
+                    src, dst = self.instance_refs(op, itb.instance)
+                    # Note: We don't need the fill out the rest of the metadata since replication is the last optimization
+                    ops.append(Op(op.inst, op.rank, src, dst, [], op.step, itbid))
+                itb._ops = ops
+        for itb in instance_tbs.values():
+            for op, iop in zip(itb.base.ops, itb._ops):
+                deps = []
+                for dep in op.depends:
+                    dep_tb, dep_step = located[dep]
+                    deps.append(instance_tbs[(dep_tb, itb.instance)]._ops[dep_step])
+                iop.depends = deps
+
+
+# Returns the base threadblock tb generates its ops from and the instance of tb
+def _base_tb(tb):
+    if isinstance(tb, InstanceThreadblock):
+        return tb.base, tb.instance
+    return tb, 0
+
+# Returns the src and dst in tb of op of the base threadblock of tb
+def _instance_refs(tb, op):
+    if isinstance(tb, InstanceThreadblock):
+        return tb.replication.instance_refs(op, tb.instance)
+    return op.src, op.dst
+
 # Instructions where src is on local GPU
 _local_src_insts = {Instruction.send, Instruction.copy, Instruction.reduce}
 # Instructions where dst is on local GPU
@@ -209,106 +309,144 @@ _local_dst_insts = {Instruction.recv, Instruction.recv_copy_send, Instruction.re
 
 
 def ir_to_xml(program: Program, old_format=True, use_scratch=True, pretty_print=True, dependence_nop=False):
-    # Figure out sizes of buffers based on usage
-    buffer_sizes = defaultdict(lambda: 0)
+    out = io.StringIO()
+    write_xml(program, out, old_format, use_scratch, pretty_print, dependence_nop)
+    return out.getvalue()
+
+# Opening tag of an element without children
+def _open_tag(elem):
+    return ET.tostring(elem, encoding='unicode')[:-2] + '>'
+
+# Writes the XML of a program to file, a path or a file-like object.
+# Only the element of one threadblock is held in memory at a time, the output is the same as ir_to_xml.
+def write_xml(program: Program, file, old_format=True, use_scratch=True, pretty_print=True, dependence_nop=False):
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'w') as f:
+            write_xml(program, f, old_format, use_scratch, pretty_print, dependence_nop)
+        return
+
+    # The ops of the instances of a replicated program are generated from their base threadblock,
+    # so the analysis below is done once on the base threadblocks and applies to every instance
+    base_tbs = [] # (rank, base threadblock) of every base threadblock
+    last_tb = {} # base threadblock -> its threadblock of the last instance
     for gpu in program.gpus:
         for tb in gpu.threadblocks:
-            for op in tb.ops:
-                if op.inst in _local_src_insts:
-                    key = (gpu.rank, op.src.buffer)
-                    buffer_sizes[key] = max(
-                        buffer_sizes[key], op.src.index + op.src.size)
-                if op.inst in _local_dst_insts:
-                    key = (gpu.rank, op.dst.buffer)
-                    buffer_sizes[key] = max(
-                        buffer_sizes[key], op.dst.index + op.dst.size)
-
-    tb_id = {}
+            base, instance = _base_tb(tb)
+            if base not in last_tb:
+                base_tbs.append((gpu.rank, base))
+            if base not in last_tb or instance > _base_tb(last_tb[base])[1]:
+                last_tb[base] = tb
+
+    # Figure out sizes of buffers based on usage, the last instance uses the highest indices
+    buffer_sizes = defaultdict(lambda: 0)
+    for rank, base in base_tbs:
+        for op in base.ops:
+            src, dst = _instance_refs(last_tb[base], op)
+            if op.inst in _local_src_insts:
+                key = (rank, src.buffer)
+                buffer_sizes[key] = max(
+                    buffer_sizes[key], src.index + src.size)
+            if op.inst in _local_dst_insts:
+                key = (rank, dst.buffer)
+                buffer_sizes[key] = max(
+                    buffer_sizes[key], dst.index + dst.size)
+
+    tb_id = {} # (base threadblock, instance) -> id
     # Sort threadblocks in each GPU by peers and then the channel
     # This is important as in NCCL threadblocks using the same NVLink concurrently should be close together
     for gpu in program.gpus:
         gpu.threadblocks = sorted(gpu.threadblocks,
                                   key=lambda tb: (tb.send, tb.recv, tb.channel))
         for i, tb in enumerate(gpu.threadblocks):
-            tb_id[tb] = i
+            tb_id[_base_tb(tb)] = i
+
+    # The ops and dependencies written are kept here, the program is left unchanged so it can be written again
+    tb_ops = {} # base threadblock -> ops written
+    depends = {} # op -> dependencies written
 
     # Filter out dependencies within the same threadblock
-    op_tb_id = {}
-    for gpu in program.gpus:
-        for tb in gpu.threadblocks:
-            for op in tb.ops:
-                op_tb_id[op] = tb_id[tb]
-    for gpu in program.gpus:
-        for tb in gpu.threadblocks:
-            for op in tb.ops:
-                op.depends = list(
-                    filter(lambda dep: op_tb_id[dep] != tb_id[tb], op.depends))
+    op_tb = {} # op -> base threadblock
+    op_step = {}
+    for _, base in base_tbs:
+        for step, op in enumerate(base.ops):
+            op_tb[op] = base
+            op_step[op] = step
+    for _, base in base_tbs:
+        for op in base.ops:
+            depends[op] = list(
+                filter(lambda dep: op_tb[dep] is not base, op.depends))
     # Filter out redundant dependencies
-    # e.g. if op1 and op2 depend on op, and op1 happends before op2 
-    # then op2 does not need to explicitly depend on op
-    for gpu in program.gpus:
-        for tb in gpu.threadblocks:
-            running_depends = []
-            for op in tb.ops:
-                op.depends = list(
-                    filter(lambda dep: dep not in running_depends, op.depends))
-                running_depends = running_depends + op.depends
+    # e.g. if op1 depends on step k of a threadblock and op2 on step j <= k of the same threadblock,
+    # and op1 happens before op2, then op2 does not need to explicitly depend on it
+    for _, base in base_tbs:
+        satisfied = {} # threadblock -> latest step of it already waited on
+        for op in base.ops:
+            # Only keep the latest step of each threadblock that is not satisfied yet
+            latest = {} # threadblock -> dependency on its latest step
+            for dep in depends[op]:
+                dep_tb = op_tb[dep]
+                if op_step[dep] > satisfied.get(dep_tb, -1) and \
+                    (dep_tb not in latest or op_step[dep] > op_step[latest[dep_tb]]):
+                    latest[dep_tb] = dep
+            depends[op] = list(dict.fromkeys(dep for dep in depends[op] if latest.get(op_tb[dep]) is dep))
+            for dep_tb, dep in latest.items():
+                satisfied[dep_tb] = op_step[dep]
 
     # Mark all ops that have a dependence on them
     has_dependence = set()
-    for gpu in program.gpus:
-        for tb in gpu.threadblocks:
-            for op in tb.ops:
-                has_dependence.update(op.depends)
+    for _, base in base_tbs:
+        for op in base.ops:
+            has_dependence.update(depends[op])
 
+    for _, tb in base_tbs:
+        tb_ops[tb] = tb.ops
     if dependence_nop:
-        for gpu in program.gpus:
-            for tb in gpu.threadblocks:
-                pre_ops = []
-                after_ops = []
-                first_re = None
-                first_dep = None
-                for i, op in enumerate(tb.ops):
-                    # Expand extra dependencies into nop operations
-                    num_depends = len(op.depends)
-                    if op.inst is Instruction.reduce:
-                        if num_depends > 0:
-                            for dep in op.depends:
-                                if first_dep is None:
-                                    first_dep = dep
-                                else:    
-                                    pre_ops.append(Op(Instruction.nop, -1, None, None, [dep]))
-                            op.depends = []
-                        if first_re is None:
-                            first_re = op
-
-                    if first_re is not None:
-                        after_ops.append(op)
-                    else:
-                        pre_ops.append(op)
-                if first_dep is not None:
-                    first_re.depends = [first_dep]
-                tb.ops = pre_ops + after_ops
+        for _, tb in base_tbs:
+            pre_ops = []
+            after_ops = []
+            first_re = None
+            first_dep = None
+            for i, op in enumerate(tb.ops):
+                # Expand extra dependencies into nop operations
+                num_depends = len(depends[op])
+                if op.inst is Instruction.reduce:
+                    if num_depends > 0:
+                        for dep in depends[op]:
+                            if first_dep is None:
+                                first_dep = dep
+                            else:    
+                                pre_ops.append(Op(Instruction.nop, -1, None, None, [dep]))
+                                depends[pre_ops[-1]] = [dep]
+                        depends[op] = []
+                    if first_re is None:
+                        first_re = op
+
+                if first_re is not None:
+                    after_ops.append(op)
+                else:
+                    pre_ops.append(op)
+            if first_dep is not None:
+                depends[first_re] = [first_dep]
+            tb_ops[tb] = pre_ops + after_ops
 
     # Do some additional postprocessing of operations:
     # - Expand operations with extra dependencies with no-ops
     # - Mark the index of each operation taking any extra no-ops into account
     op_idx = {}
-    for gpu in program.gpus:
-        for tb in gpu.threadblocks:
-            new_ops = []
-            for op in tb.ops:
-                # Expand extra dependencies into nop operations
-                if len(op.depends) > 1:
-                    extra_deps = op.depends[1:]
-                    op.depends = op.depends[:1]
-                    for i, dep in enumerate(extra_deps):
-                        new_ops.append(Op(Instruction.nop, -1, None, None, [dep]))
-                        op_idx[new_ops[-1]] = len(new_ops) - 1
-                        #op_tb_id[new_ops[-1]] = op_tb_id[op]
-                new_ops.append(op)
-                op_idx[new_ops[-1]] = len(new_ops) - 1
-            tb.ops = new_ops
+    for _, tb in base_tbs:
+        new_ops = []
+        for op in tb_ops[tb]:
+            # Expand extra dependencies into nop operations
+            if len(depends[op]) > 1:
+                extra_deps = depends[op][1:]
+                depends[op] = depends[op][:1]
+                for i, dep in enumerate(extra_deps):
+                    new_ops.append(Op(Instruction.nop, -1, None, None, [dep]))
+                    depends[new_ops[-1]] = [dep]
+                    op_idx[new_ops[-1]] = len(new_ops) - 1
+            new_ops.append(op)
+            op_idx[new_ops[-1]] = len(new_ops) - 1
+        tb_ops[tb] = new_ops
 
     nchannels = 0
     for gpu in program.gpus:
@@ -327,19 +465,36 @@ def ir_to_xml(program: Program, old_format=True, use_scratch=True, pretty_print=
     algo_elem.set('ngpus', str(len(program.gpus)))
     algo_elem.set('coll', program.collective)
     algo_elem.set('inplace', str(1 if program.inplace else 0))
+
+    # Whitespace written before an element at depth level, the same as ET.indent
+    def indent(level):
+        return '\n' + '  ' * level if pretty_print else ''
+
+    if len(program.gpus) == 0:
+        file.write(ET.tostring(algo_elem, encoding='unicode'))
+        return
+    file.write(_open_tag(algo_elem))
     for gpu in program.gpus:
-        gpu_elem = ET.SubElement(algo_elem, 'gpu')
+        file.write(indent(1))
+        gpu_elem = ET.Element('gpu')
         gpu_elem.set('id', str(gpu.rank))
         gpu_elem.set('i_chunks', str(max(buffer_sizes[(gpu.rank, Buffer.input)], gpu.input_chunks)))
         gpu_elem.set('o_chunks', str(max(buffer_sizes[(gpu.rank, Buffer.output)], gpu.output_chunks)))
         gpu_elem.set('s_chunks', str(max(buffer_sizes[(gpu.rank, Buffer.scratch)], gpu.scratch_size())))
+        if len(gpu.threadblocks) == 0:
+            file.write(ET.tostring(gpu_elem, encoding='unicode'))
+            continue
+        file.write(_open_tag(gpu_elem))
         for tb in gpu.threadblocks:
-            tb_elem = ET.SubElement(gpu_elem, 'tb')
-            tb_elem.set('id', str(tb_id[tb]))
+            file.write(indent(2))
+            base, instance = _base_tb(tb)
+            tb_elem = ET.Element('tb')
+            tb_elem.set('id', str(tb_id[(base, instance)]))
             tb_elem.set('send', str(tb.send))
             tb_elem.set('recv', str(tb.recv))
             tb_elem.set('chan', str(tb.channel))
-            for op in tb.ops:
+            for op in tb_ops[base]:
+                src, dst = _instance_refs(tb, op)
                 op_elem = ET.SubElement(
                     tb_elem, 'op' if not old_format else 'step')
                 op_elem.set('step' if not old_format else 's', str(op_idx[op]))
@@ -347,41 +502,39 @@ def ir_to_xml(program: Program, old_format=True, use_scratch=True, pretty_print=
 
                 # The NCCL backend currently wants scratch at the end of output
                 if not use_scratch:
-                    if op.src.buffer == Buffer.scratch:
-                        op.src.buffer = Buffer.output
-                        op.src.index += buffer_sizes[(gpu.rank, Buffer.output)]
-                    if op.dst_buffer == Buffer.scratch:
-                        op.dst.buffer = Buffer.output
-                        op.dst.index += buffer_sizes[(gpu.rank, Buffer.output)]
+                    if src is not None and src.buffer == Buffer.scratch:
+                        src = ChunkRef(src.rank, Buffer.output, src.index + buffer_sizes[(gpu.rank, Buffer.output)], src.size)
+                    if dst is not None and dst.buffer == Buffer.scratch:
+                        dst = ChunkRef(dst.rank, Buffer.output, dst.index + buffer_sizes[(gpu.rank, Buffer.output)], dst.size)
 
                 if old_format:
-                    if op.src is not None:
-                        op_elem.set('srcbuf', str(op.src.buffer))
-                        op_elem.set('srcoff', str(op.src.index))
+                    if src is not None:
+                        op_elem.set('srcbuf', str(src.buffer))
+                        op_elem.set('srcoff', str(src.index))
                     else:
                         op_elem.set('srcbuf', 'i')
                         op_elem.set('srcoff', '-1')
-                    if op.dst is not None:
-                        op_elem.set('dstbuf', str(op.dst.buffer))
-                        op_elem.set('dstoff', str(op.dst.index))
+                    if dst is not None:
+                        op_elem.set('dstbuf', str(dst.buffer))
+                        op_elem.set('dstoff', str(dst.index))
                     else:
                         op_elem.set('dstbuf', 'o')
                         op_elem.set('dstoff', '-1')
                 else:
                     if op.is_send():
-                        if op.src is not None:
-                            op_elem.set('buf', str(op.src.buffer))
-                            op_elem.set('off', str(op.src.index))
+                        if src is not None:
+                            op_elem.set('buf', str(src.buffer))
+                            op_elem.set('off', str(src.index))
                     else:
-                        if op.dst is not None:
-                            op_elem.set('buf', str(op.dst.buffer))
-                            op_elem.set('off', str(op.dst.index))
+                        if dst is not None:
+                            op_elem.set('buf', str(dst.buffer))
+                            op_elem.set('off', str(dst.index))
                 if op.cnt() > 1 or old_format:
                     op_elem.set('cnt', str(op.cnt()))
-                assert len(op.depends) <= 1
-                if len(op.depends) == 1:
-                    op_elem.set('depid', str(op_tb_id[op.depends[0]]))
-                    op_elem.set('deps', str(op_idx[op.depends[0]]))
+                assert len(depends[op]) <= 1
+                if len(depends[op]) == 1:
+                    op_elem.set('depid', str(tb_id[(op_tb[depends[op][0]], instance)]))
+                    op_elem.set('deps', str(op_idx[depends[op][0]]))
                 elif old_format:
                     op_elem.set('depid', '-1')
                     op_elem.set('deps', '-1')
@@ -390,6 +543,118 @@ def ir_to_xml(program: Program, old_format=True, use_scratch=True, pretty_print=
                 elif old_format:
                     op_elem.set('hasdep', '0')
 
-    if pretty_print:
-        ET.indent(algo_elem, space='  ')
-    return ET.tostring(algo_elem, encoding='unicode')
+            if pretty_print:
+                ET.indent(tb_elem, space='  ', level=2)
+            file.write(ET.tostring(tb_elem, encoding='unicode'))
+        file.write(indent(1) + '</gpu>')
+    file.write(indent(0) + '</algo>')
+
+
+def xml_to_ir(xml):
+    return read_xml(io.BytesIO(xml.encode('utf-8')))
+
+_instructions = {str(inst): inst for inst in Instruction}
+_buffers = {str(buffer): buffer for buffer in Buffer}
+_send_insts = {Instruction.send, Instruction.recv_copy_send, Instruction.recv_reduce_send, Instruction.recv_reduce_copy_send}
+_recv_insts = {Instruction.recv, Instruction.recv_copy_send, Instruction.recv_reduce_send, Instruction.recv_reduce_copy,
+               Instruction.recv_reduce_copy_send}
+
+# Reads an op from its step (old format) or op (new format) element
+def _read_op(elem, rank, tb, is_send, is_recv):
+    get = elem.get
+    op = Op(_instructions[get('type')], rank, None, None, step=len(tb.ops), tb=tb.rbid, channel=tb.channel)
+    src_rank = tb.recv if is_recv else rank
+    dst_rank = tb.send if is_send else rank
+    cnt = int(get('cnt', 1))
+    if elem.tag == 'step':
+        # Steps without buffer attributes still keep their count, in ChunkRefs without a buffer
+        if get('srcbuf') is None:
+            op.src = ChunkRef(src_rank, None, -1, cnt)
+        elif int(get('srcoff', -1)) != -1:
+            op.src = ChunkRef(src_rank, _buffers[get('srcbuf')], int(get('srcoff')), cnt)
+        if get('dstbuf') is None:
+            op.dst = ChunkRef(dst_rank, None, -1, cnt)
+        elif int(get('dstoff', -1)) != -1:
+            op.dst = ChunkRef(dst_rank, _buffers[get('dstbuf')], int(get('dstoff')), cnt)
+    elif get('buf') is not None:
+        # The new format only has the buffer of the src of sends and of the dst of other ops
+        local = ChunkRef(src_rank if is_send else dst_rank, _buffers[get('buf')], int(get('off')), cnt)
+        if is_send:
+            op.src, op.dst = local, ChunkRef(dst_rank, None, -1, cnt)
+        else:
+            op.src, op.dst = ChunkRef(src_rank, None, -1, cnt), local
+    return op
+
+# Reads a program from the XML written by write_xml or ncclize in a path or a file-like object.
+# Reads both the old format (step elements with srcbuf and dstbuf) and the new format (op elements with buf and off),
+# where the ChunkRefs missing from the new format, or from steps without srcbuf or dstbuf, have no buffer and index -1.
+# Elements are parsed incrementally and dropped once read, so only the program is held in memory.
+# The depends of ops are resolved and sends are matched with their receives (send_match and recv_match).
+def read_xml(file):
+    if isinstance(file, os.PathLike):
+        file = os.fspath(file)
+    # Every object created while reading is part of the program, so garbage collections only slow it down
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _read_xml(file)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+def _read_xml(file):
+    program = None
+    sends = defaultdict(list) # (src, dst, channel) -> sends in order
+    recvs = defaultdict(list) # (src, dst, channel) -> receives in order
+    for event, elem in ET.iterparse(file, events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            if tag == 'algo':
+                program = Program(elem.get('name'), elem.get('coll'), elem.get('inplace') == '1', elem.get('proto'))
+                if elem.get('nchunksperloop') is not None:
+                    program.nchunksperloop = int(elem.get('nchunksperloop'))
+            elif tag == 'gpu':
+                gpu = Gpu(int(elem.get('id')), input_chunks=int(elem.get('i_chunks')), output_chunks=int(elem.get('o_chunks')))
+                gpu.scratch = {index: index for index in range(int(elem.get('s_chunks')))}
+                tbs = {}
+                depends = [] # (op, (depid, deps)) of the gpu
+            elif tag == 'tb':
+                tb = Threadblock(int(elem.get('chan')), int(elem.get('send')), int(elem.get('recv')), rbid=int(elem.get('id')))
+                tbs[tb.rbid] = tb
+                tb_sends = sends[(gpu.rank, tb.send, tb.channel)]
+                tb_recvs = recvs[(tb.recv, gpu.rank, tb.channel)]
+            continue
+
+        if tag == 'step' or tag == 'op':
+            inst = _instructions[elem.get('type')]
+            is_send = inst in _send_insts
+            is_recv = inst in _recv_insts
+            op = _read_op(elem, gpu.rank, tb, is_send, is_recv)
+            tb.ops.append(op)
+            depid = elem.get('depid')
+            if depid is not None and depid != '-1':
+                depends.append((op, (int(depid), int(elem.get('deps')))))
+            if is_send:
+                tb_sends.append(op)
+            if is_recv:
+                tb_recvs.append(op)
+            continue
+        if tag == 'tb':
+            gpu.threadblocks.append(tb)
+        elif tag == 'gpu':
+            for op, (depid, deps) in depends:
+                if depid not in tbs or deps >= len(tbs[depid].ops):
+                    raise ValueError(f'Rank {gpu.rank} threadblock {op.tb} step {op.step} depends on missing step {deps} of threadblock {depid}')
+                op.depends.append(tbs[depid].ops[deps])
+            program.gpus.append(gpu)
+        # Drop the elements already read, steps are dropped with their threadblock
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+    # Messages on a connection are received in the order they are sent
+    for conn, conn_sends in sends.items():
+        for send, recv in zip(conn_sends, recvs.get(conn, [])):
+            send.recv_match = recv
+            recv.send_match = send
+    return program
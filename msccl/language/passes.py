@@ -1,55 +1,90 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
-import sys
+from collections import deque
 from msccl.language.ir import *
 
-# Check that there are no cyclic dependencies within a Rank
+class DependencyCycleError(Exception):
+    def __init__(self, cycle):
+        self.cycle = cycle # Ops of the cycle, each op waits on the one before it (and the first on the last)
+        ops = '\n'.join(f'  {op}' for op in cycle)
+        super().__init__(f'Cyclic dependency in rank {cycle[0].rank} threadblock {cycle[0].tb} at {cycle[0]}\n{ops}')
+
+class ThreadblockOrderingError(Exception):
+    def __init__(self, first, second):
+        # first is sent before second but received after it
+        self.first = first
+        self.second = second
+        super().__init__(f'Rank {first.rank} sends {first} then {second} but rank {first.recv_match.rank} ' \
+                         f'receives them at steps {first.recv_match.step} and {second.recv_match.step}')
+
+# Ops that must complete before op can execute: explicit dependencies, the
+# previous op of its threadblock and, for receives, the matching send
+def _wait_ops(op, prev_op):
+    waits = list(op.depends)
+    if prev_op is not None:
+        waits.append(prev_op)
+    if op.is_recv() and op.send_match is not None:
+        waits.append(op.send_match)
+    return waits
+
+# Check that there are no cyclic dependencies between the ops of the threadblocks
+# Kahn's algorithm over the threadblock dependency graph, raises a DependencyCycleError if ops are left over
 def check_dependency_cycles(tbs):
-    for rank, rank_tbs in enumerate(tbs):
-        for tbid, tb in rank_tbs.items():
+    waits = {}
+    for rank_tbs in tbs:
+        for tb in rank_tbs.values():
+            prev_op = None
             for op in tb.ops:
-                deps = op.depends
-                chain = [op]
-                # DFS to check for cycles
-                while len(deps) > 0:
-                    dep = deps[0]
-                    if dep in chain:
-                        print(f"Cyclic dependency in rank {rank} threadblock {tbid} at {op}")
-                        for op in chain:
-                            print("  ", op)
-                        sys.exit(1)
-                    next_depends = dep.depends
-                    if len(next_depends) > 0:
-                        chain.append(dep)
-                    else:
-                        chain = [op]
-                    deps = next_depends + deps[1:]
+                waits[op] = _wait_ops(op, prev_op)
+                prev_op = op
+
+    remaining = {}
+    waiting = {op: [] for op in waits}
+    for op, op_waits in waits.items():
+        op_waits = [w for w in op_waits if w in waiting]
+        waits[op] = op_waits
+        remaining[op] = len(op_waits)
+        for w in op_waits:
+            waiting[w].append(op)
+
+    frontier = deque(op for op, count in remaining.items() if count == 0)
+    done = 0
+    while len(frontier) > 0:
+        op = frontier.popleft()
+        done += 1
+        for o in waiting[op]:
+            remaining[o] -= 1
+            if remaining[o] == 0:
+                frontier.append(o)
+    if done == len(waits):
+        return
+
+    # Every op left over waits on another left over op, following them must revisit an op
+    op = next(op for op, count in remaining.items() if count > 0)
+    chain = {}
+    while op not in chain:
+        chain[op] = len(chain)
+        op = next(w for w in waits[op] if remaining[w] > 0)
+    cycle = list(chain)[chain[op]:]
+    cycle.reverse()
+    raise DependencyCycleError(cycle)
 
 
 # Check there are no ordering violations between threadblocks across ranks
 def check_threadblock_ordering(rank_dag):
     for rank in range(rank_dag.num_ranks):
         for tb in rank_dag.tbs[rank].values():
-            prev_steps = {} # tbid -> step of last recv from tbid
+            prev_sends = {} # tbid -> last send to tbid
             # Check that sends and their corresponding receives between two threadblocks
             # happen in the same order.
-            for op_step, op in enumerate(tb.ops):
+            for op in tb.ops:
                 if op.is_send():
                     match = op.recv_match
                     if match.is_recv():
                         assert op.dst.rank == match.rank, f"Bug in MSCCLang: Sends don't match receives"
 
                     other_tbid = match.tb
-                    if other_tbid in prev_steps:
-                        if match.step <= prev_steps[other_tbid].step:
-                            print("Offending Steps", match.step, prev_steps[other_tbid].step)
-                            print("Sending tb")
-                            for op in tb.ops:
-                                print(f'{op.step}: Recv step: {op.recv_match.step if op.is_send() else -1} {op} priority:{(op.chunk_step, op.priority, op.dst.index)}')
-                            print("Receiving tb")
-                            for op in rank_dag.tbs[match.rank][other_tbid].ops:
-                                print(f'{op.step}: {op} priority:{(op.chunk_step, op.priority, op.dst.index)}')
-                            assert match.step >  prev_steps[other_tbid].step, f"Rank {op.rank} sends op1 then op2 but {match.rank} receives op2 then op1"
-                        
-                    prev_steps[other_tbid] = match
+                    if other_tbid in prev_sends and match.step <= prev_sends[other_tbid].recv_match.step:
+                        raise ThreadblockOrderingError(prev_sends[other_tbid], op)
+                    prev_sends[other_tbid] = op
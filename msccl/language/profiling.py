@@ -0,0 +1,137 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field, asdict
+import json
+import os
+import time
+import tracemalloc
+from msccl.language.ir import Instruction, InstanceThreadblock
+from msccl.language.traversal import bfs_ops
+
+# Opt-in instrumentation of the passes of MSCCLProgram.lower. MSCCL_PROFILE=1 enables it for every
+# program, any other value (except 0) is a path the JSON report of each lowering is appended to, one per line.
+# Passes are timed by default. Tracing memory allocations slows the passes down unevenly and counting the DAG
+# walks all of it, so MSCCL_PROFILE_MEMORY=1 (or profile_memory=True) records the peak memory and DAG size
+# after each pass instead of its time.
+
+
+@dataclass
+class PassProfile:
+    name: str
+    time: float = None # Wall time in seconds
+    nodes: int = None # Instructions of the DAG after the pass, when profiling memory
+    edges: int = None # Dependencies between them
+    peak_memory: int = None # Peak bytes allocated during the pass on top of what was allocated before it
+
+
+@dataclass
+class LoweringProfile:
+    program: str
+    num_ranks: int
+    instances: int
+    passes: list = field(default_factory=list)
+
+    # Total time of the passes, None when profiling memory
+    @property
+    def time(self):
+        if any(p.time is None for p in self.passes):
+            return None
+        return sum(p.time for p in self.passes)
+
+    def pass_profile(self, name):
+        return next(p for p in self.passes if p.name == name)
+
+    def to_dict(self):
+        return {**asdict(self), 'time': self.time}
+
+    # Writes the report as a line of JSON to path (a path or file-like object). A path is appended to, so
+    # that the reports of successive lowerings are all kept.
+    def dump(self, path):
+        if isinstance(path, (str, os.PathLike)):
+            with open(path, 'a') as f:
+                self.dump(f)
+        else:
+            path.write(json.dumps(self.to_dict()) + '\n')
+
+
+# Returns the number of instructions and dependencies of the instruction DAG. Until replication these are
+# the ops reachable from the start ops and their next and send to receive edges, afterwards the
+# replicated threadblock ops and their explicit and in-threadblock dependencies.
+def dag_size(instr_dag):
+    nodes = edges = 0
+    instanced_tbs = getattr(instr_dag, 'instanced_tbs', None)
+    if instanced_tbs is not None:
+        for rank_tbs in instanced_tbs:
+            for tb in rank_tbs.values():
+                # Instances have the ops of their base threadblock, counting them does not create them
+                ops = tb.base.ops if isinstance(tb, InstanceThreadblock) else tb.ops
+                nodes += len(ops)
+                edges += max(len(ops) - 1, 0) + sum(len(op.depends) for op in ops)
+        return nodes, edges
+
+    def successors(op):
+        if op.is_send() and op.recv_match is not None:
+            return [*op.next, op.recv_match]
+        return op.next
+
+    starts = [op for op in instr_dag.operations.values() if op.inst == Instruction.start]
+    for op in bfs_ops(starts, successors):
+        if op.inst != Instruction.start:
+            nodes += 1
+            edges += len(successors(op))
+    return nodes, edges
+
+
+class LoweringProfiler:
+    def __init__(self, program, memory=False):
+        self.instr_dag = program.instr_dag
+        self.memory = memory
+        self.report = LoweringProfile(program.name, program.num_ranks, program.instances)
+
+    @contextmanager
+    def measure(self, name):
+        if not self.memory:
+            start = time.perf_counter()
+            yield
+            self.report.passes.append(PassProfile(name, time=time.perf_counter() - start))
+            return
+
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        try:
+            yield
+        finally:
+            _, peak = tracemalloc.get_traced_memory()
+            if started:
+                tracemalloc.stop()
+        nodes, edges = dag_size(self.instr_dag)
+        self.report.passes.append(PassProfile(name, nodes=nodes, edges=edges, peak_memory=max(peak - before, 0)))
+
+
+# Stands in for LoweringProfiler when profiling is disabled
+class NullProfiler:
+    report = None
+
+    @contextmanager
+    def measure(self, name):
+        yield
+
+
+# Returns the profiling setting of the environment: False, True or the path to append reports to
+def default_profile():
+    value = os.environ.get('MSCCL_PROFILE', '')
+    if value in ('', '0'):
+        return False
+    if value == '1':
+        return True
+    return value
+
+# Returns if the environment profiles memory instead of time
+def default_profile_memory():
+    return os.environ.get('MSCCL_PROFILE_MEMORY', '') not in ('', '0')
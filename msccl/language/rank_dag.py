@@ -5,9 +5,11 @@ from dataclasses import dataclass
 from enum import Enum
 import heapq
 import functools
+import random
 
 from msccl.language.ir import *
 from msccl.language.passes import *
+from msccl.language.traversal import *
 import logging
 
 #logger = logging.getLogger(__name__)
@@ -30,45 +32,263 @@ def same_count(op1, op2):
 def same_buf_dst(op1, op2):
     return op1.dst.buffer == op2.dst.buffer and op1.dst.index == op2.dst.index
 
+# Last writing op and list of last reading ops of a range of slots
+# Split segments share their readers list until one of them adds a reader
+class SlotState:
+    __slots__ = ('writer', 'readers', 'shared')
+
+    def __init__(self, writer, readers=None, shared=False):
+        self.writer = writer
+        self.readers = [] if readers is None else readers
+        self.shared = shared
+
+    def copy(self):
+        self.shared = True
+        return SlotState(self.writer, self.readers, shared=True)
+
+    def add_reader(self, op):
+        if self.shared:
+            self.readers = list(self.readers)
+            self.shared = False
+        self.readers.append(op)
+
+# Segment [start, end) of a SlotIntervalMap and node of its treap, ordered by start and heap ordered by priority
+class _Segment:
+    __slots__ = ('start', 'end', 'state', 'priority', 'left', 'right')
+
+    def __init__(self, start, end, state):
+        self.start = start
+        self.end = end
+        self.state = state
+        self.priority = _priorities.random()
+        self.left = None
+        self.right = None
+
+# Treap priorities, kept apart from the global random state
+_priorities = random.Random(0)
+
+# Splits a treap into the segments starting before index and the others
+def _split(node, index):
+    if node is None:
+        return None, None
+    if node.start < index:
+        node.right, right = _split(node.right, index)
+        return node, right
+    left, node.left = _split(node.left, index)
+    return left, node
+
+# Joins two treaps, where every segment of left is before every segment of right
+def _merge(left, right):
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        return left
+    right.left = _merge(left, right.left)
+    return right
+
+# Returns the segments of a treap in order
+def _in_order(node):
+    segments = []
+    stack = []
+    while stack or node is not None:
+        while node is not None:
+            stack.append(node)
+            node = node.left
+        node = stack.pop()
+        segments.append(node)
+        node = node.right
+    return segments
+
+# Returns if the segments cover every index in [lo, hi)
+def _covers(segments, lo, hi):
+    if len(segments) == 0:
+        return lo == hi
+    if segments[0].start != lo or segments[-1].end != hi:
+        return False
+    if len(segments) == 1:
+        return True
+    end = lo
+    for segment in segments:
+        if segment.start != end:
+            return False
+        end = segment.end
+    return True
+
+# Yields the [lo, hi) ranges that are not covered by the segments
+def _gaps(segments, lo, hi):
+    current = lo
+    for segment in segments:
+        if current < segment.start:
+            yield current, segment.start
+        current = segment.end
+    if current < hi:
+        yield current, hi
+
+# Tracks the SlotState of every index of a (rank, buffer) as disjoint [start, end) segments in a treap, so that a
+# multi-count ref is handled in logarithmic time plus the number of segments it overlaps instead of per index
+class SlotIntervalMap:
+    def __init__(self):
+        self.root = None
+        self.end = 0 # End of the last segment
+
+    # Returns the segment containing index or None
+    def _find(self, index):
+        node = self.root
+        found = None
+        while node is not None:
+            if index < node.start:
+                node = node.left
+            else:
+                found = node
+                node = node.right
+        if found is not None and index < found.end:
+            return found
+        return None
+
+    # Adds a segment that does not overlap any other
+    def _insert(self, segment):
+        parent = None
+        node = self.root
+        while node is not None and node.priority > segment.priority:
+            parent = node
+            node = node.left if segment.start < node.start else node.right
+        segment.left, segment.right = _split(node, segment.start)
+        if parent is None:
+            self.root = segment
+        elif segment.start < parent.start:
+            parent.left = segment
+        else:
+            parent.right = segment
+
+    # Makes index a segment boundary, the pieces of the segment containing it share their readers
+    def _cut(self, index):
+        segment = self._find(index)
+        if segment is not None and segment.start < index:
+            self._insert(_Segment(index, segment.end, segment.state.copy()))
+            segment.end = index
+
+    # Returns the segments starting in [lo, hi) in order
+    def _range(self, lo, hi):
+        segments = []
+        stack = []
+        node = self.root
+        while True:
+            while node is not None:
+                if node.start < lo:
+                    node = node.right
+                else:
+                    stack.append(node)
+                    node = node.left
+            if len(stack) == 0:
+                return segments
+            node = stack.pop()
+            if node.start >= hi:
+                return segments
+            segments.append(node)
+            node = node.right
+
+    # Returns the segments in [lo, hi), cut so that none of them extends out of the range
+    def read(self, lo, hi):
+        segment = self._find(lo)
+        # Common case when a ref is within one previous write, often exactly
+        if segment is not None and segment.end >= hi:
+            end = segment.end
+            if segment.start < lo:
+                segment.end = lo
+                segment = _Segment(lo, end, segment.state.copy())
+                self._insert(segment)
+            if hi < end:
+                segment.end = hi
+                self._insert(_Segment(hi, end, segment.state.copy()))
+            return [segment]
+        if lo >= self.end:
+            return []
+        self._cut(lo)
+        self._cut(hi)
+        return self._range(lo, hi)
+
+    # Replaces the segments in [lo, hi) with a single segment of state and returns the segments replaced
+    def write(self, lo, hi, state):
+        # Common case when building buffers front to back - the range is after all segments
+        if lo >= self.end:
+            self.root = _merge(self.root, _Segment(lo, hi, state))
+            self.end = hi
+            return []
+        segment = self._find(lo)
+        # Common case when the range is within one previous write, e.g. a single chunk of a start
+        if segment is not None and segment.end >= hi:
+            replaced = _Segment(lo, hi, segment.state)
+            end = segment.end
+            if segment.start == lo:
+                segment.end = hi
+                segment.state = state
+                if hi < end:
+                    self._insert(_Segment(hi, end, replaced.state))
+            else:
+                segment.end = lo
+                self._insert(_Segment(lo, hi, state))
+                if hi < end:
+                    self._insert(_Segment(hi, end, replaced.state.copy()))
+            return [replaced]
+        # Replace the segments of the range with a new one
+        self._cut(lo)
+        self._cut(hi)
+        left, rest = _split(self.root, lo)
+        middle, right = _split(rest, hi)
+        self.root = _merge(_merge(left, _Segment(lo, hi, state)), right)
+        self.end = max(self.end, hi)
+        return _in_order(middle)
+
 class InstructionDAG:
     def __init__(self, num_ranks, buffers):
         self.num_ranks = num_ranks
         self.buffers = buffers
         # State for the actual instruction DAG
         self.operations = {} # slot -> operations
-        self.last_writer = {} # slot -> last writing op
-        self.last_readers = defaultdict(list) # slot -> list of last reading ops
+        self.slot_maps = {} # (rank, buffer) -> SlotIntervalMap of last writing op and last reading ops
         # State for the MSCCL-IR
         self.tbs = [] 
         for _ in range(num_ranks):
             self.tbs.append({}) 
         self.tb_mapping = {}
         self.num_channels = [1] * num_ranks
+        self.pair_channels = {} # (sender, receiver) -> number of channels, set by auto threadblock assignment
+
 
+    # Returns the interval map tracking the last writer/readers of every index in (rank, buffer)
+    def _slot_map(self, rank, buffer):
+        key = (rank, buffer)
+        slot_map = self.slot_maps.get(key)
+        if slot_map is None:
+            slot_map = self.slot_maps[key] = SlotIntervalMap()
+        return slot_map
 
     # InstructionDAG helper - identifies the dependencies for a write-type operation (recv, copy, rrc, reduce)
     def _write(self, rank, buffer, index, size, op, read=False):
         prev_ops = set()
-        for i in range(index, index+size):
-            slot = (rank, buffer, i)
-            if read:
-                assert slot in self.last_writer, f"Destination slot has never been written before a reduce {op}"
-
-            # First write to this slot
-            if slot not in self.operations:
-                self.operations[slot] = op
-
-            # If there are active readers - these are the previous operations
-            # Else the previous operation is the last write (if there is one)
-            readers = self.last_readers[slot]
-            if len(readers) > 0:
-                prev_ops.update(readers)
-            elif slot in self.last_writer:
-                prev_ops.add(self.last_writer[slot])
-  
-            # Set the last_writer to this op, and clear all readers
-            self.last_writer[slot] = op
-            self.last_readers[slot] = []
+        slot_map = self._slot_map(rank, buffer)
+        # Set the last_writer to this op, and clear all readers
+        segments = slot_map.write(index, index+size, SlotState(op))
+        covered = _covers(segments, index, index+size)
+        if read:
+            assert covered, f"Destination slot has never been written before a reduce {op}"
+
+        # First write to these slots, the op is found from the first slot of every range
+        if not covered:
+            for lo, hi in _gaps(segments, index, index+size):
+                self.operations[(rank, buffer, lo)] = op
+
+        # If there are active readers - these are the previous operations
+        # Else the previous operation is the last write (if there is one)
+        for segment in segments:
+            state = segment.state
+            if len(state.readers) > 0:
+                prev_ops.update(state.readers)
+            else:
+                prev_ops.add(state.writer)
 
         # Update the next pointer of the previous ops
         for prev_op in prev_ops:
@@ -78,25 +298,25 @@ class InstructionDAG:
     # InstructionDAG helper - identifies the dependencies for read-type operations (send, copy, reduce)
     def _read(self, rank, buffer, index, size, op):
         prev_ops = set()
-        for i in range(index, index+size):
-            slot = (rank, buffer, i)
-            assert slot in self.last_writer, f"Slot has never been written before a read-type {op}"
+        slot_map = self._slot_map(rank, buffer)
+        segments = slot_map.read(index, index+size)
+        assert _covers(segments, index, index+size), f"Slot has never been written before a read-type {op}"
+        for segment in segments:
             # The previous operation for a reader is the last write to the slot
-            writer = self.last_writer[slot]
-            prev_ops.add(writer)
-            self.last_readers[slot].append(op)
-            
+            prev_ops.add(segment.state.writer)
+            segment.state.add_reader(op)
+
         # Update the next pointer of the previous ops
         for prev_op in prev_ops:
             prev_op.next.add(op)
             op.prev.add(prev_op)
 
-    # InstructionDAG - builds the roots of the DAG
+    # InstructionDAG - builds the roots of the DAG, one start op for the ref.size slots of ref
     def add_start(self, rank, buffer, index, ref):
         slot = (rank, buffer, index)
         op = Op(Instruction.start, rank, ref, ref, next=set(), prev=set(), chunk_step=-1)
         self.operations[slot] = op
-        self.last_writer[slot] = op
+        self._slot_map(rank, buffer).write(index, index+ref.size, SlotState(op))
 
     # InstructionDAG - adds a copy node
     def add_copy(self, rank, send_ref, recv_ref, tb, ch):
@@ -158,69 +378,45 @@ class InstructionDAG:
 
     def convert_set_list(self):
         ops = []
-        #logger.debug("Initialized empty ops list")
-
         for slot, op in self.operations.items():
-            #logger.debug(f"Processing operation in slot {slot}: {op}")
-            
             if op.inst == Instruction.start:
-                #logger.info(f"Operation {op} is a start instruction.")
                 op.next = list(op.next)
-                #logger.debug(f"Converted op.next to list: {op.next}")
-                for o in op.next:
-                    #logger.debug(f"Appending to ops: {o}")
-                    ops.append(o)
+                ops.extend(op.next)
             elif op.inst != Instruction.copy:
-                #logger.debug(f"Appending non-copy operation: {op}")
                 ops.append(op)
 
-        visited = set()
-        #logger.debug("Initialized empty visited set")
-
-        while len(ops) > 0:
-            op = ops[0]
-            #logger.debug(f"Processing op: {op}")
+        for op in bfs_ops(ops):
+            op.next = list(op.next)
 
-            if op not in visited:
-                #logger.info(f"Visiting new operation: {op}")
-                visited.add(op)
-                op.next = list(op.next)
-                #logger.debug(f"Converted op.next to list: {op.next}")
-                ops = ops[1:] + op.next
-                #logger.debug(f"Updated ops list: {ops}")
-            else:
-                #logger.debug(f"Operation already visited: {op}")
-                ops = ops[1:]
-
-        #logger.debug("Finished processing operations")
-                    
     def optimize(self):
         self._optimize_rrcs_rrs()
         self._optimize_rcs()
 
     # Completes metadata for chunk_steps (number of steps from a start op) and priority (number of steps to the last op)
+    # Both are longest paths over next and send to recv edges, computed by a forward and a backward sweep in topological order
     def _complete_metadata(self):
-        def dfs(op, cs):
-            op.chunk_step = max(op.chunk_step, cs+1)
+        def successors(op):
+            if op.is_send():
+                return [*op.next, op.recv_match]
+            return op.next
+
+        starts = [op for op in self.operations.values() if op.inst == Instruction.start]
+        order = list(topo_ops(starts, successors))
 
+        for op in starts:
+            op.chunk_step = max(op.chunk_step, -1) # Start instructions should start at -1
+        for op in order:
+            for o in successors(op):
+                o.chunk_step = max(o.chunk_step, op.chunk_step+1)
+
+        for op in reversed(order):
             if len(op.next) == 0 and op.recv_match is None:
                 op.priority = 0
             else:
-                for o in op.next:
-                    dfs(o, op.chunk_step)
                 # Priority = +1 of the highest priority child
-                if len(op.next) > 0:
-                    highest_next_priority = max([x.priority+1 for x in op.next])
-                    op.priority = max(highest_next_priority, op.priority)
-                if op.is_send():
-                    dfs(op.recv_match, op.chunk_step)
-                    op.priority = max(op.priority, op.recv_match.priority+1)
-
-        for chunk, op in self.operations.items():
-            if op.inst == Instruction.start:
-                dfs(op,-2) # Start instructions should start at -1
-            
-        
+                for o in successors(op):
+                    op.priority = max(op.priority, o.priority+1)
+
     # Given the set of operations that operate over a particular slot (rank, buffer, idx) fixed
     # Try and replace operations with pipelined ops like receive copy send (rcs)
     # or receive reduce send (rrs) and receive reduce copy send (rrcs)
@@ -228,10 +424,9 @@ class InstructionDAG:
     # recv-copy-send 
     # recv(src, sbuf, si, _, _, _ ) send(_, _, _, dst, dbuf, di) -> recv_copy_send(src, sbuf, si, dst, dbuf, di)
     def _optimize_rcs(self):
+        visited = set()
         for slot, ops in self.operations.items():
-            frontier = [ops]
-            while len(frontier) > 0:
-                op = frontier[0]
+            for op in bfs_ops([ops], visited=visited):
                 for next_op in op.next:
                     if op.inst == Instruction.recv and next_op.inst == Instruction.send and same_tb(op, next_op) and same_count(op, next_op) and same_buf_dst(op, next_op):
                         # recv -> rcs, remove send
@@ -241,19 +436,15 @@ class InstructionDAG:
                         op.recv_match = next_op.recv_match
                         remove_op(next_op)
                         break
-                frontier = frontier[1:] + op.next
     # recv-reduce-send - A rrc followed by a send that gets overwritten
     # rrc(src, sbuf, si, ...) send(_, _, _, dst, dbuf, di) recv(_, _, _, dst, dbuf, di) 
     # recv-reduce-copy-send - A rrc followed by a send that does not get overwritten
     # rrc(src, sbuf, si, ...) send(_, _, _, dst, dbuf, di)
     def _optimize_rrcs_rrs(self):
         # RRC/S -> RRS
-        #logger.debug("_optimize_rrcs_rrs")
+        visited = set()
         for slot, ops in self.operations.items():
-            frontier = [ops]
-            #logger.debug(f"frontier: {frontier}")
-            while len(frontier) > 0:
-                op = frontier[0]
+            for op in bfs_ops([ops], visited=visited):
                 if len(op.next) == 1:
                     next_op = op.next[0]
                     if len(next_op.next) == 1:
@@ -271,7 +462,6 @@ class InstructionDAG:
                         next_op.recv_match.send_match = op
                         op.recv_match = next_op.recv_match
                         remove_op(next_op)
-                frontier = frontier[1:] + op.next
 
     def lower_pt1(self, instances):
         self.infer_dependencies()
@@ -283,10 +473,9 @@ class InstructionDAG:
 
 
     def infer_dependencies(self):
+        visited = set()
         for slot, ops in self.operations.items():
-            frontier = [ops]
-            while len(frontier) > 0:
-                op = frontier[0]
+            for op in bfs_ops([ops], visited=visited):
                 # Dependencies for every op is the same as the ops that are stored in prev
                 # Filter out dependencies that are satisified by tbs executing ops sequentially
                 # If multiple dependent ops from the same tb keep the one that happens last
@@ -297,7 +486,6 @@ class InstructionDAG:
                         if tb not in depends or dep_op.step > depends[tb].step:
                             depends[tb] = dep_op
                 op.depends = list(depends.values())
-                frontier = frontier[1:] + op.next
 
     # Convert local scratch buffers to index into one global scratch buffer
     def lower_chunk(self, chunk):
@@ -317,17 +505,12 @@ class InstructionDAG:
                     offset += buf.instance_size() * instances
 
     # Preprocess the threadblocks for lowering into xml
+    # The ops of replicated threadblocks are generated from the instance 0 refs of the base ops, so only those are lowered
     def lower_tbs(self):
-        gpus = []
-        for rank, rank_tbs in enumerate(self.instanced_tbs):
-            lowered_tbs = {}
-            for tbid, tb in rank_tbs.items():
-                for op in tb.ops:
-                    op.src = self.lower_chunk(op.src)
-                    op.dst = self.lower_chunk(op.dst)
-                lowered_tbs[tbid] = tb
-            gpus.append(Gpu(rank, list(lowered_tbs.values())))
-        return gpus
+        refs = self.replication.refs
+        for op, (src, dst) in refs.items():
+            refs[op] = (self.lower_chunk(src), self.lower_chunk(dst))
+        return [Gpu(rank, list(rank_tbs.values())) for rank, rank_tbs in enumerate(self.instanced_tbs)]
 
 
     # Automatically replicates the algorithm instance number of times
@@ -338,65 +521,41 @@ class InstructionDAG:
     # only interleaved replication will be correct
     # Interleaved policy only supports single count sends/receives from the input/output buffer
     # (multicount ops are fine between scratch)
+    # Instances are not copied: every threadblock of instance i is an InstanceThreadblock view of the base threadblock,
+    # whose refs of instance 0 index instance i at index + i * stride. The base ops are not changed, so a program
+    # can be lowered again.
     def replicate(self, instances, interleaved):
-        if instances == 1:
-            self.instanced_tbs = self.tbs
-            return 
-
-        self.instanced_tbs = []
-        for _ in range(self.num_ranks):
-            self.instanced_tbs.append({})
-
         def is_scratch(buffer):
             return buffer != Buffer.input and buffer != Buffer.output
 
-        def get_new_index(rank, buffer, index, size, i):
+        # Returns the ref of instance 0 and the stride between instances
+        def get_instance_ref(ref):
             # Scratch buffers always use batched
-            if is_scratch(buffer):
-                buf_instance_len = self.buffers[rank][buffer].instance_size()
-                return buf_instance_len * i + index
+            if is_scratch(ref.buffer):
+                return ref, self.buffers[ref.rank][ref.buffer].instance_size()
             # If this is operating on the input/output buffer then replication strategy can be either interleaved or batched
             # This is to fit with the semantics of certain collectives
             elif interleaved:
-                return  index * instances + i * size
+                return ChunkRef(ref.rank, ref.buffer, ref.index * instances, ref.size), ref.size
             else:
-                return  len(self.buffers[rank][buffer]) * i + index
+                return ref, len(self.buffers[ref.rank][ref.buffer])
 
-        def get_instance_ref(ref):
-            iindex = get_new_index(ref.rank, ref.buffer, ref.index, ref.size, i)
-            iref = ChunkRef(ref.rank, ref.buffer, iindex, ref.size)
-            return iref
+        replication = Replication()
+        for rank_tbs in self.tbs:
+            for tb in rank_tbs.values():
+                for op in tb.ops:
+                    src, src_stride = get_instance_ref(op.src)
+                    dst, dst_stride = get_instance_ref(op.dst)
+                    replication.refs[op] = (src, dst)
+                    replication.strides[op] = (src_stride, dst_stride)
 
         max_channels = max(self.num_channels)
+        self.instanced_tbs = [{} for _ in range(self.num_ranks)]
         for i in range(instances):
-            # Generate all the threadblocks and ops
             for rank, rank_tbs in enumerate(self.tbs):
-                # rank_channels = self.num_channels[rank]
                 for tbid, tb in rank_tbs.items():
-                    instance_channel = max_channels * i + tb.channel
-                    itb = Threadblock(instance_channel, tb.send, tb.recv)
-                    itbid = tbid * instances + i
-                    itb.ops = [None] * len(tb.ops)
-                    for s, op in enumerate(tb.ops):
-                        isrc = get_instance_ref(op.src)
-                        idst = get_instance_ref(op.dst)
-                        idepends = [] 
-                        # Note: We don't need the fill out the rest of the metadata since replication is the last optimization
-                        iop = Op(op.inst, op.rank, isrc, idst, idepends, op.step, itbid) 
-                        itb.ops[s] = iop
-                    self.instanced_tbs[op.rank][itbid] = itb
-        
-        # Redo dependency analysis
-        for rank, rank_tbs in enumerate(self.tbs):
-            for tbid, tb in rank_tbs.items():
-                for i in range(instances):
                     itbid = tbid * instances + i
-                    itb = self.instanced_tbs[rank][itbid]
-                    for op, iop in zip(tb.ops, itb.ops):
-                        iop.depends = [None] * len(op.depends)
-                        for s, dep in enumerate(op.depends):
-                            dep_tbid = dep.tb
-                            dep_itbid = dep_tbid * instances + i
-                            dep_step = dep.step
-                            iop.depends[s] = self.instanced_tbs[op.rank][dep_itbid].ops[dep_step] 
+                    self.instanced_tbs[rank][itbid] = InstanceThreadblock(tb, i, max_channels * i + tb.channel, replication)
+        replication.tbs = self.instanced_tbs
+        self.replication = replication
 
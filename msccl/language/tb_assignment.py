@@ -3,7 +3,9 @@
 
 from dataclasses import dataclass
 from enum import Enum
+from collections import defaultdict, deque
 import heapq
+import itertools
 
 from msccl.language.ir import *
 from msccl.language.rank_dag import *
@@ -19,8 +21,8 @@ def _verify_tb_op_compatible(tb, op):
     return sends_ok and recvs_ok and channel_ok
 
 # Manual threadblock, channel assignment
-def manual_assign_tbs(rank_dag):
-    instrs = topo_sort_instrs(rank_dag)
+def manual_assign_tbs(rank_dag, schedule=SchedulePolicy.chunk_step):
+    instrs = topo_sort_instrs(rank_dag, schedule)
     for op in instrs:
         
         rank = op.rank
@@ -40,46 +42,64 @@ def manual_assign_tbs(rank_dag):
                 f"Threadblock {tbid} send:{tb.send} recv:{tb.recv} channel:{tb.channel}\n" \
                 f"Operation send:{op.dst.rank if op.is_send() else -1} recv:{op.dst.rank if op.is_recv() else -1} channel:{op.channel}")
 
-def _get_tb_options(mapping, send, recv, channel, num_tbs):
-    options = []
-    for tbid, tb in mapping.items():
-        tb_s = tb.send
-        tb_r = tb.recv
-        tb_c = tb.channel
-        sender_ok = send == -1 or tb_s == send
-        receiver_ok = recv == -1 or tb_r == recv
-        channel_ok = channel == -1 or channel == tb_c
-        # For correctness - if one of the peer's channels is already allocated we must use it.
-        if channel_ok and ((tb_s == send and send != -1) or (tb_r == recv and recv != -1)):
-            return [tbid]
-        if sender_ok and receiver_ok and channel_ok:
-             options.append(tbid)
-    return options
-
-def auto_assign_tbs(rank_dag):
-    instrs = topo_sort_instrs(rank_dag)
+# Index of the threadblocks of a rank for auto_assign_tbs
+# Threadblocks are indexed by (send peer, channel) and (recv peer, channel), and the threadblocks of each
+# channel are in a heap by the chunk step of their last op (stale entries are dropped when they reach the top)
+class _TbIndex:
+    def __init__(self):
+        self.by_send = {} # (send, channel) -> lowest tbid sending to send on channel
+        self.by_recv = {} # (recv, channel) -> lowest tbid receiving from recv on channel
+        self.steps = {} # tbid -> chunk step of its last op
+        self.heaps = defaultdict(list) # channel -> heap of (chunk step, tbid)
+
+    # For correctness - if one of the peer's channels is already allocated we must use it.
+    # Returns the lowest tbid using the send or recv peer on channel, or None
+    def peer_tb(self, send, recv, channel):
+        tbids = []
+        if send != -1 and (send, channel) in self.by_send:
+            tbids.append(self.by_send[(send, channel)])
+        if recv != -1 and (recv, channel) in self.by_recv:
+            tbids.append(self.by_recv[(recv, channel)])
+        return min(tbids, default=None)
+
+    # Returns the threadblock of channel whose last op has the lowest chunk step (the lowest tbid on ties), or None
+    def least_loaded(self, channel):
+        heap = self.heaps[channel]
+        while len(heap) > 0 and self.steps[heap[0][1]] != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0][1] if len(heap) > 0 else None
+
+    # Records that op was added to threadblock tbid
+    def add(self, tbid, tb, op):
+        self.steps[tbid] = op.chunk_step
+        heapq.heappush(self.heaps[tb.channel], (op.chunk_step, tbid))
+        if tb.send != -1:
+            self.by_send[(tb.send, tb.channel)] = min(self.by_send.get((tb.send, tb.channel), tbid), tbid)
+        if tb.recv != -1:
+            self.by_recv[(tb.recv, tb.channel)] = min(self.by_recv.get((tb.recv, tb.channel), tbid), tbid)
+
+def auto_assign_tbs(rank_dag, schedule=SchedulePolicy.chunk_step):
+    instrs = topo_sort_instrs(rank_dag, schedule)
     channel_assignment(instrs, rank_dag)
     rank_tbids = [0] * rank_dag.num_ranks
-    current_tb_step = []
-    for rank_tbs in rank_dag.tbs:
-        current_tb_step.append({})
+    indices = [_TbIndex() for _ in range(rank_dag.num_ranks)]
 
     for op in instrs:
         rank = op.rank
         s = op.send_peer()
         r = op.recv_peer()
         channel = 0 if op.channel == -1 else op.channel
-        # Get all possible TBs this can be mapped to
-        tb_options = _get_tb_options(rank_dag.tbs[rank], s, r, channel, rank_tbids[rank])
-        if len(tb_options) == 0: # If there are no options, create a new threadblock
+        index = indices[rank]
+        # Sends and receives must use the threadblock already using their peer on the channel, other
+        # ops use the threadblock of the channel that is least far along. If there is none, create a new threadblock.
+        if s != -1 or r != -1:
+            tbid = index.peer_tb(s, r, channel)
+        else:
+            tbid = index.least_loaded(channel)
+        if tbid is None:
             tbid = rank_tbids[rank]
             rank_dag.tbs[rank][tbid] = Threadblock(send=s, recv=r, channel=channel)
             rank_tbids[rank] += 1
-        else: 
-            tbid = tb_options[0]
-            for tbid_opt in tb_options:
-                if current_tb_step[rank][tbid_opt] < current_tb_step[rank][tbid] and _verify_tb_op_compatible(rank_dag.tbs[rank][tbid], op):
-                    tbid = tbid_opt
         
         tb = rank_dag.tbs[rank][tbid]
         assert _verify_tb_op_compatible(tb, op), f"Failing: Operations uses channel {op.channel}, send:{s} recv:{r} {op}\n" \
@@ -93,38 +113,127 @@ def auto_assign_tbs(rank_dag):
         
         op.step = len(tb.ops)-1
         op.tb = tbid
-        current_tb_step[rank][tbid] = op.chunk_step
+        index.add(tbid, tb, op)
 
-# Topologically orders instructions so that (1): Sends occur before their receives
-# (2): Dependent instructions occur before 
-def topo_sort_instrs(rank_dag):
+# Scheduling priorities for topo_sort_instrs with the policies other than SchedulePolicy.chunk_step, ready ops
+# with a lower priority are ordered first. Each takes the InstructionDAG and returns the priority function of its
+# ops, which is called once per op when it becomes ready.
+
+# Longest path to the end of the program first
+def critical_path_priority(rank_dag):
+    def priority(op):
+        return (-op.priority, op.chunk_step, op.dst.index, op.src.index)
+    return priority
+
+# Alternates between links: the n-th send on a (sender, receiver) link is ordered with the n-th sends of
+# the other links. Receives take the round of their send, local ops alternate between ranks.
+def link_round_robin_priority(rank_dag):
+    rounds = defaultdict(int) # link -> ops given a round on it
+    send_round = {}
     def priority(op):
-        return ((op.chunk_step, -op.priority, op.dst.index))
+        if op.is_send():
+            link = (op.rank, op.dst.rank)
+        elif op.is_recv():
+            return (send_round[id(op.send_match)], op.chunk_step, -op.priority, op.dst.index, op.src.index)
+        else:
+            link = (op.rank, op.rank)
+        step = rounds[link]
+        rounds[link] += 1
+        send_round[id(op)] = step
+        return (step, op.chunk_step, -op.priority, op.dst.index, op.src.index)
+    return priority
+
+schedule_priorities = {
+    SchedulePolicy.critical_path: critical_path_priority,
+    SchedulePolicy.link_round_robin: link_round_robin_priority,
+}
+
+# The order of SchedulePolicy.chunk_step: earliest chunk step first, then the op with the longest path to the
+# end of the program, ties broken by Op.__lt__. Only sends and copies without predecessors start the order, and
+# a receive is ready once the ops before it on its rank are ordered, checked when they or its send are ordered.
+def _chunk_step_order(rank_dag):
+    def priority(op):
+        return (op.chunk_step, -op.priority, op.dst.index)
+
+    def ready(op):
+        return all(x.inst == Instruction.start or id(x) in visited for x in op.prev)
 
     visited = set()
+    remaining = {} # Number of predecessors of an op that are not ordered yet, counted when it is first reached
     ops = []
-    ordered = []
     for slot, op in rank_dag.operations.items():
         if op.inst == Instruction.start:
-            visited.add(op)
             for o in op.next:
                 if o.inst == Instruction.send or o.inst == Instruction.copy:
                     heapq.heappush(ops, (priority(o), o))
 
+    ordered = []
     while len(ops) > 0:
         _, op = heapq.heappop(ops)
-        if op not in visited:
-            rmatch = op.recv_match
-            ordered.append(op)
-            visited.add(op)
-            
-            # Add a matching receive if one exists and its dependencies are satisfied
-            if rmatch is not None and all([x in visited for x in rmatch.prev]): 
-                heapq.heappush(ops, (priority(rmatch), rmatch))
-            # Add other operation that have dependencies satisfied
+        if id(op) in visited:
+            continue
+        ordered.append(op)
+        visited.add(id(op))
+        # Add a matching receive if one exists and its dependencies are satisfied
+        rmatch = op.recv_match
+        if rmatch is not None and ready(rmatch):
+            heapq.heappush(ops, (priority(rmatch), rmatch))
+        # Add other operation that have dependencies satisfied
+        for o in op.next:
+            count = remaining.get(id(o))
+            if count is None:
+                count = sum(1 for x in o.prev if x.inst != Instruction.start and id(x) not in visited)
+            else:
+                count -= 1
+            remaining[id(o)] = count
+            if count == 0:
+                heapq.heappush(ops, (priority(o), o))
+    return ordered
+
+# Topologically orders instructions so that (1): Sends occur before their receives
+# (2): Dependent instructions occur before 
+# priority is a SchedulePolicy or a function of the InstructionDAG returning the priority function of its ops.
+# SchedulePolicy.chunk_step keeps the order threadblocks have always been assigned in. With the other policies,
+# every op whose predecessors (and send, for a receive) are all ordered is ready, the ready op with the lowest
+# priority goes first and ops of equal priority are ordered in the order they became ready.
+def topo_sort_instrs(rank_dag, priority=SchedulePolicy.chunk_step):
+    if priority == SchedulePolicy.chunk_step:
+        return _chunk_step_order(rank_dag)
+    priority = schedule_priorities.get(priority, priority)(rank_dag)
+
+    # A receive is considered before the other successors of its send
+    def successors(op):
+        if op.is_send() and op.recv_match is not None:
+            return [op.recv_match, *op.next]
+        return op.next
+
+    # Number of predecessors of an op that are not ordered yet, a receive also waits for its send.
+    # Counted when a predecessor of the op is first ordered.
+    remaining = {}
+    def unordered_preds(op):
+        return sum(1 for x in op.prev if x.inst != Instruction.start) + (1 if op.is_recv() else 0)
+
+    ops = []
+    pushed = itertools.count() # Ops of equal priority are ordered in the order they became ready
+    for slot, op in rank_dag.operations.items():
+        if op.inst == Instruction.start:
             for o in op.next:
-                if all([x in visited for x in o.prev]):
-                    heapq.heappush(ops, (priority(o), o))
+                if id(o) not in remaining:
+                    remaining[id(o)] = unordered_preds(o)
+                    if remaining[id(o)] == 0:
+                        heapq.heappush(ops, (priority(o), next(pushed), o))
+
+    ordered = []
+    while len(ops) > 0:
+        _, _, op = heapq.heappop(ops)
+        ordered.append(op)
+        for o in successors(op):
+            count = remaining.get(id(o))
+            if count is None:
+                count = unordered_preds(o)
+            remaining[id(o)] = count - 1
+            if count == 1:
+                heapq.heappush(ops, (priority(o), next(pushed), o))
     return ordered
 
 def channel_assignment(instrs, rank_dag):
@@ -142,53 +251,52 @@ def channel_assignment(instrs, rank_dag):
 
     # Returns a channel this flow can be scheduled on, else -1 
     def is_matching_flow(flow):
-        if flow in flows:
-            return flow_channels[flows.index(flow)]
-        return -1
+        return flow_channels.get(flow, -1)
 
     def reserve_channel(sender, receiver, ch):
         if ch in rank2sendch[sender][receiver]:
             rank2sendch[sender][receiver].remove(ch)
         if ch in rank2recvch[receiver][sender]:
             rank2recvch[receiver][sender].remove(ch)
-    flows = []
-    flow_channels = []
+    flow_channels = {} # flow -> channel of the first flow with the same (sender, receiver) hops
 
     def create_flow(f):
-        flow = set()
+        return frozenset((f[i-1], f[i]) for i in range(1, len(f)))
+
+    # Channels free on every hop of the flow through ranks f
+    def available_channels(f):
+        channels = all_channels()
         for i in range(1, len(f)):
-            flow.add((f[i-1], f[i]))
-        return flow
-        
-    def dfs(op, channels, f):
+            channels &= rank2sendch[f[i-1]][f[i]] & rank2recvch[f[i]][f[i-1]]
+        return channels
+
+    def dfs(op, f):
         if op.is_local():
             op.channel = 0
         elif op.is_send():
             match = op.recv_match
             sender = op.rank
             receiver = match.rank
-            # Available channels
-            channels = rank2sendch[sender][receiver].intersection(rank2recvch[receiver][sender]).intersection(channels)
             f.append(op.rank)
             # If not a fused op use the first possible channel (send, recv/rrc)
             if not match.is_fused():
                 f.append(match.rank)
-                flow = create_flow(f)
                 # If the user has already manually scheduled this onto a channel, respect it
                 if op.channel != -1:
                     ch = op.channel
                 else:
+                    flow = create_flow(f)
                     ch = is_matching_flow(flow)
                     if ch == -1: # No flow matched - use the smallest available channel
-                        ch = min(channels)
-                        flows.append(flow)
-                        flow_channels.append(ch)
+                        # Channels are only reserved once the whole flow is assigned, so they can be checked here
+                        ch = min(available_channels(f))
+                        flow_channels[flow] = ch
 
                 op.channel = ch
                 match.channel = ch
                 reserve_channel(sender, receiver, ch)
             else:
-                dfs(match, channels, f)
+                dfs(match, f)
                 ch = match.channel
                 op.channel = ch
                 reserve_channel(sender, receiver, ch)
@@ -196,31 +304,73 @@ def channel_assignment(instrs, rank_dag):
     # Assign channels to flows
     for op in instrs:
         if op.inst == Instruction.send and op.recv_match.is_fused():
-            dfs(op, all_channels(), [])
+            dfs(op, [])
 
     # Iterate through and make certain the sends and receives between a pair of GPUs is consistent
     # Shift a (s,r) pair to another channel if the ordering isn't consistent
-    repeat = True
-    while repeat:
-        repeat = False
-        pending_recv = defaultdict(list)  # (sender, receiver, ch) -> pending receive
-        for op in instrs:
-            rank = op.rank
-            channel = 0 if op.channel == -1 else op.channel
-            if op.is_send():
-                dst = op.dst.rank
-                pending_recv[(rank, dst, channel)].append(op.recv_match)
-            
-            if op.is_recv():
-                src = op.src.rank
-                pr = pending_recv[(src, rank, channel)]
-                if op in pr:
-                    if pr[0] is op:
-                        del pr[0]
-                    else:
-                        repeat = True
-                        op.channel += 1
-                        op.send_match.channel += 1
-                        pr.remove(op)
+    # Every pass checks each (sender, receiver, channel) connection on its own, so after the first pass only
+    # the connections that gained or lost an op are checked again.
+    links = [] # (sender, receiver, sends) of the connections each op sends and receives on, the channel is the op's
+    for op in instrs:
+        op_links = []
+        if op.is_send():
+            op_links.append((op.rank, op.dst.rank, True))
+        if op.is_recv():
+            op_links.append((op.src.rank, op.rank, False))
+        links.append(op_links)
+    position = {id(op): i for i, op in enumerate(instrs)}
+
+    # Adds the ops at positions to the connections of their current channel, returns the connections
+    def add_ops(positions, conn_ops):
+        for i in positions:
+            channel = 0 if instrs[i].channel == -1 else instrs[i].channel
+            for sender, receiver, sends in links[i]:
+                conn_ops[(sender, receiver, channel)].append((i, sends))
+        return conn_ops
+
+    conn_ops = add_ops(range(len(instrs)), defaultdict(list)) # (sender, receiver, ch) -> [(position, sends)] in order
+
+    # Returns the receives of conn that happen before a receive posted earlier on it
+    def out_of_order(conn):
+        pending = deque() # Receives in the order of their sends
+        posted = set()
+        shifted = []
+        for i, sends in conn_ops[conn]:
+            op = instrs[i]
+            if sends:
+                pending.append(op.recv_match)
+                posted.add(id(op.recv_match))
+            elif id(op) in posted:
+                posted.remove(id(op))
+                # Receives shifted away earlier are only removed from the queue once they reach its front
+                while pending[0] is not op and id(pending[0]) not in posted:
+                    pending.popleft()
+                if pending[0] is op:
+                    pending.popleft()
+                else:
+                    shifted.append(op)
+        return shifted
 
+    changed = list(conn_ops)
+    while changed:
+        shifted = [op for conn in changed for op in out_of_order(conn)]
+        moved = sorted({position[id(op)] for recv in shifted for op in (recv, recv.send_match)})
+        left = add_ops(moved, defaultdict(list))
+        moved = set(moved)
+        for conn in left:
+            conn_ops[conn] = [entry for entry in conn_ops[conn] if entry[0] not in moved]
+        for op in shifted:
+            op.channel += 1
+            op.send_match.channel += 1
+        joined = add_ops(sorted(moved), defaultdict(list))
+        for conn, entries in joined.items():
+            conn_ops[conn] = list(heapq.merge(conn_ops[conn], entries))
+        changed = left.keys() | joined.keys()
 
+    # Report how many channels each (sender, receiver) pair ended up using
+    pair_channels = defaultdict(set)
+    for sender, receiver, ch in conn_ops:
+        if conn_ops[sender, receiver, ch]:
+            pair_channels[(sender, receiver)].add(ch)
+    rank_dag.pair_channels = {pair: len(chs) for pair, chs in sorted(pair_channels.items())}
+    return rank_dag.pair_channels
@@ -0,0 +1,46 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from collections import defaultdict, deque
+
+# Worklist traversals over the operations of an InstructionDAG.
+# Every op is yielded at most once and the cost is linear in the number of ops and edges reached.
+
+def _next_ops(op):
+    return op.next
+
+# Yields the ops reachable from roots in breadth-first order.
+# The successors of an op are read after the op is yielded, so a pass can
+# rewrite op.next (e.g. when fusing instructions) before the traversal continues.
+# Ops already in visited are skipped, sharing it across calls visits every op once overall.
+def bfs_ops(roots, successors=_next_ops, visited=None):
+    if visited is None:
+        visited = set()
+    frontier = deque(roots)
+    while len(frontier) > 0:
+        op = frontier.popleft()
+        if op in visited:
+            continue
+        visited.add(op)
+        yield op
+        frontier.extend(successors(op))
+
+# Yields the ops reachable from roots in topological order: an op is yielded
+# after all of its predecessors that are reachable from roots.
+# The successors of an op must not change during this traversal.
+def topo_ops(roots, successors=_next_ops):
+    roots = list(dict.fromkeys(roots))
+    # Count the edges into every reachable op
+    remaining = defaultdict(int)
+    for op in bfs_ops(roots, successors):
+        for o in successors(op):
+            remaining[o] += 1
+
+    frontier = deque(op for op in roots if remaining[op] == 0)
+    while len(frontier) > 0:
+        op = frontier.popleft()
+        yield op
+        for o in successors(op):
+            remaining[o] -= 1
+            if remaining[o] == 0:
+                frontier.append(o)
@@ -3,6 +3,7 @@
 
 from msccl.algorithm import *
 from msccl.ncd_reduction import wrap_try_ncd_reduction
+from msccl.isomorphisms import find_automorphisms
 from z3 import *
 
 from collections import defaultdict
@@ -23,6 +24,16 @@ def _sent_in(chunk, src, dst, step):
     # Constructs a Z3 term that is true iff a chunk is sent from src to dst in step
     return And(_send(chunk, src, dst), _start(chunk, dst) == step + 1)
 
+def _addr_send(addr, src, dst):
+    return Bool(f'addr_send_{addr}_from_{src}_to_{dst}')
+
+def _addr_send_start(addr, src, dst):
+    # The start on dst of the chunks at addr sent from src
+    return Int(f'addr_send_start_{addr}_from_{src}_to_{dst}')
+
+def _equal_prefix(automorphism, position):
+    return Bool(f'sym_{automorphism}_equal_{position}')
+
 def _idx(addr, rank):
     return Int(f'idx_{addr}_at_{rank}')
 
@@ -33,20 +44,19 @@ def _addr_end(addr, rank):
     return Int(f'addr_end_{addr}_at_{rank}')
 
 class PathEncodingBase(object):
-    def __init__(self, topology, collective):
+    # Most automorphisms used for symmetry breaking, groups like those of fully connected topologies are huge
+    symmetry_limit = 64
+    symmetry_chunks = 2
+
+    def __init__(self, topology, collective, symmetry_breaking = False):
         self.topology = topology
         self.collective = collective
+        self.symmetry_breaking = symmetry_breaking
+        self._solvers = {} # _static_key(instance) -> (chunked collective, Solver)
 
-    def _encode(self, s, instance, collective):
-        # Calculate how much iterations of the algorithm overlap if pipelining is specified
-        if instance.pipeline != None:
-            # TODO: move this check into Instance
-            if instance.pipeline <= 0:
-                raise ValueError('instance.pipeline must be strictly positive.')
-            overlap = max(instance.steps - instance.pipeline, 0)
-        else:
-            overlap = 0
-
+    # Encodes the constraints that do not depend on the number of steps, rounds, pipelining or the amount of
+    # extra memory, i.e. that are shared by all instances with the same key in _static_key
+    def _encode_static(self, s, instance, collective):
         # Correctness
         for chunk in collective.chunks():
             for rank in collective.ranks():
@@ -54,27 +64,12 @@ class PathEncodingBase(object):
                     # Have chunks start on their starting ranks before the first step
                     # This is not required for the encoding, but makes debugging the models produced more intuitive
                     s.add(_start(chunk, rank) == 0)
-                else:
-                    # Any rank that gets a chunk (and doesn't start with it) must have a unique source for it
-                    sent_once = PbEq([(_send(chunk, src, rank), 1) for src in self.topology.sources(rank)], 1)
-                    s.add(Implies(_start(chunk, rank) <= instance.steps, sent_once))
-                # If the postcondition requires the chunk on the rank then it must start being there before the end
-                if collective.postcondition(rank, chunk):
-                    s.add(_start(chunk, rank) <= instance.steps)
                 for src in self.topology.sources(rank):
                     # If a rank send a chunk then it needs to have it before sending it
                     s.add(Implies(_send(chunk, src, rank), _start(chunk, src) < _start(chunk, rank)))
                     if instance.extra_memory != None:
                         # Also to send a chunk it needs to not have been deleted before sending it
                         s.add(Implies(_send(chunk, src, rank), _end(chunk, src) >= _start(chunk, rank) - 1))
-                    # Handle chunks at the same address getting reduced in combining collectives
-                    if collective.is_combining:
-                        for other in collective.chunks():
-                            if other != chunk and collective.address(other) == collective.address(chunk):
-                                # If you send and another chunk at the same address is available (i.e. reduced) then you have to send that too at the same time
-                                s.add(Implies(And(_send(chunk, src, rank), _start(other, src) < _start(chunk, rank)),
-                                                And(_send(other, src, rank), (_start(other, rank) == _start(chunk, rank)))))
-
                     # Handle the triggers used in subproblem based synthesizers
                     if collective.trigger(rank, chunk) != None:
                         # When receiving a chunk with a trigger, the triggering chunk must be sent at the same time
@@ -87,62 +82,39 @@ class PathEncodingBase(object):
                         s.add(Implies(_send(chunk, src, rank),
                             And(_send(trigger, rank, src), _start(trigger, src) == _start(chunk, rank))))
 
-        # Rounds
-        # Each step must use at least one round of bandwidth
-        s.add(*[_rounds(step) >= 1 for step in range(instance.steps)])
-        # Total number of rounds used by all steps must not exceed the limits given
-        s.add(sum([_rounds(step) for step in range(instance.steps)]) <= instance.rounds())
-        # Overlapping steps in pipelined algorithms must use the same number of rounds
-        for step in range(instance.steps - overlap):
-            for overlapping_step in range(step, instance.steps, instance.steps - overlap):
-                if overlapping_step != step:
-                    s.add(_rounds(step) == _rounds(overlapping_step))
-
-        # Bandwidth
-        # Each bandwidth group (e.g. a link or a switch) generates a separate set of constraints
-        for srcs, dsts, bw, _ in self.topology.bandwidth_constraints():
-            # overlap is subtracted here because overlapping steps are considered together
-            for step in range(instance.steps - overlap):
-                pb_sends = []
-                for src in srcs:
-                    for dst in dsts:
-                        # Generate terms for all sends on this step and group them by address and edge
-                        sends_by_addr = defaultdict(list)
-                        for chunk in collective.chunks():
-                            # Consider all pipelined steps that overlap with this step
-                            for overlapping_step in range(step, instance.steps, instance.steps - overlap):
-                                sends_by_addr[(collective.address(chunk))].append(_sent_in(chunk, src, dst, overlapping_step))
-                        # Count sends happening on an address only once and give each of these weight 1
-                        pb_sends.extend([(Or(sends),1) for sends in sends_by_addr.values()])
-                # For each number of rounds this step could have impose a pseudo-boolean
-                # constraint limiting sends on this step to the available bandwidth
-                for i in range(1, instance.extra_rounds + 2):
-                    s.add(Implies(_rounds(step) == i, PbLe(pb_sends, bw * i)))
+        # Handle chunks at the same address getting reduced in combining collectives
+        if collective.is_combining:
+            chunks_at = defaultdict(list)
+            for chunk in collective.chunks():
+                chunks_at[collective.address(chunk)].append(chunk)
+            for addr, chunks in chunks_at.items():
+                if len(chunks) < 2:
+                    continue
+                for rank in collective.ranks():
+                    for src in self.topology.sources(rank):
+                        # Chunks at the same address sent over a link are all sent at the same time, which is only
+                        # encoded once per address instead of for every pair of chunks
+                        sent = _addr_send(addr, src, rank)
+                        start = _addr_send_start(addr, src, rank)
+                        s.add(sent == Or([_send(chunk, src, rank) for chunk in chunks]))
+                        for chunk in chunks:
+                            s.add(Implies(_send(chunk, src, rank), _start(chunk, rank) == start))
+                            # If the address is sent and a chunk at it is available (i.e. reduced) then it has to be sent too
+                            s.add(Implies(And(sent, _start(chunk, src) < start), _send(chunk, src, rank)))
 
         # Memory
         if instance.extra_memory != None:
             # Choose the last step a chunk is present on a rank
             for chunk in collective.chunks():
                 for rank in collective.ranks():
-                    if collective.postcondition(rank, chunk):
-                        # In the postcondition the chunk can not stop being on the rank before the end of the algorithm
-                        s.add(_end(chunk, rank) > instance.steps)
-                    else:
-                        # On other ranks the chunk can stop being on the rank any time after its start
+                    if not collective.postcondition(rank, chunk):
+                        # On ranks not in the postcondition the chunk can stop being on the rank any time after its start
                         s.add(_end(chunk, rank) >= _start(chunk, rank))
 
             for rank in collective.ranks():
-                # Figure out all addresses plus which ones weill be in the input and output buffers
-                addresses = set()
-                input_addresses = set()
-                output_addresses = set()
+                addresses, input_addresses, output_addresses = self._addresses(collective, rank)
                 for chunk in collective.chunks():
                     addr = collective.address(chunk)
-                    addresses.add(addr)
-                    if collective.precondition(rank, chunk):
-                        input_addresses.add(addr)
-                    if collective.postcondition(rank, chunk):
-                        output_addresses.add(addr)
                     # Enforce the address start-end intervals to contain all the chunk start-end intervals
                     s.add(_addr_start(addr, rank) <= _start(chunk, rank))
                     s.add(_addr_end(addr, rank) >= _end(chunk, rank))
@@ -173,50 +145,180 @@ class PathEncodingBase(object):
                         e2 = e2 + 1
                     # There is a conflict if the intervals overlap
                     return And(s1 < e2, s2 < e1)
-                
-                # Count how many addresses will be in the input and output buffers
-                input_size = len(input_addresses)
-                output_size = len(output_addresses)
-                idx_end = input_size + output_size + instance.extra_memory
-                
+
                 # Add constraints for allocating indices for all the addresses just passing through the rank
                 for addr in (addresses - input_addresses) - output_addresses:
                     for other in addresses:
                         if other != addr:
                             # If two addresses have the same index they have to have non-conflicting liveness intervals
                             s.add(Implies(_idx(addr, rank) == _idx(other, rank), Not(conflict(addr, other))))
+
+    # The starts of the first symmetry_chunks chunks at all ranks, with chunks and ranks renamed by the permutations,
+    # in the order they are compared in by the symmetry breaking constraints. Comparing the starts of all chunks or
+    # the sends too makes the constraints more expensive than the symmetric search they prune.
+    def _symmetric_terms(self, collective, nodes, chunks):
+        first_chunks = range(min(self.symmetry_chunks, collective.num_chunks))
+        return [_start(chunks[chunk], nodes[rank]) for chunk in first_chunks for rank in collective.ranks()]
+
+    # Requires solutions to be lexicographically at most their images under the automorphisms of the topology and
+    # collective. Of any solutions that are permutations of each other the least one remains, so satisfiability is
+    # unchanged but the solver does not have to refute every permutation of a partial solution separately.
+    def _encode_symmetry_breaking(self, s, collective):
+        identity = list(collective.ranks()), list(collective.chunks())
+        terms = self._symmetric_terms(collective, *identity)
+        for i, automorphism in enumerate(find_automorphisms(self.topology, collective, limit=self.symmetry_limit)):
+            if (automorphism.nodes, automorphism.chunks) == identity:
+                continue
+            equal = BoolVal(True)
+            for j, (term, permuted) in enumerate(zip(terms, self._symmetric_terms(collective, automorphism.nodes, automorphism.chunks))):
+                if term.eq(permuted):
+                    continue
+                # Terms can only be larger than their image if all previous ones are equal to theirs
+                s.add(Implies(equal, term <= permuted))
+                s.add(_equal_prefix(i, j) == And(equal, term == permuted))
+                equal = _equal_prefix(i, j)
+
+    # Encodes the constraints that depend on the number of steps, rounds, pipelining or the amount of extra memory
+    def _encode_steps(self, s, instance, collective):
+        # Calculate how much iterations of the algorithm overlap if pipelining is specified
+        if instance.pipeline != None:
+            # TODO: move this check into Instance
+            if instance.pipeline <= 0:
+                raise ValueError('instance.pipeline must be strictly positive.')
+            overlap = max(instance.steps - instance.pipeline, 0)
+        else:
+            overlap = 0
+
+        # Correctness
+        for chunk in collective.chunks():
+            for rank in collective.ranks():
+                if not collective.precondition(rank, chunk):
+                    # Any rank that gets a chunk (and doesn't start with it) must have a unique source for it
+                    sent_once = PbEq([(_send(chunk, src, rank), 1) for src in self.topology.sources(rank)], 1)
+                    s.add(Implies(_start(chunk, rank) <= instance.steps, sent_once))
+                # If the postcondition requires the chunk on the rank then it must start being there before the end
+                if collective.postcondition(rank, chunk):
+                    s.add(_start(chunk, rank) <= instance.steps)
+
+        # Rounds
+        # Each step must use at least one round of bandwidth
+        s.add(*[_rounds(step) >= 1 for step in range(instance.steps)])
+        # Total number of rounds used by all steps must not exceed the limits given
+        s.add(sum([_rounds(step) for step in range(instance.steps)]) <= instance.rounds())
+        # Overlapping steps in pipelined algorithms must use the same number of rounds
+        for step in range(instance.steps - overlap):
+            for overlapping_step in range(step, instance.steps, instance.steps - overlap):
+                if overlapping_step != step:
+                    s.add(_rounds(step) == _rounds(overlapping_step))
+
+        # Bandwidth
+        # Each bandwidth group (e.g. a link or a switch) generates a separate set of constraints
+        for srcs, dsts, bw, _ in self.topology.bandwidth_constraints():
+            # overlap is subtracted here because overlapping steps are considered together
+            for step in range(instance.steps - overlap):
+                pb_sends = []
+                for src in srcs:
+                    for dst in dsts:
+                        # Generate terms for all sends on this step and group them by address and edge
+                        sends_by_addr = defaultdict(list)
+                        for chunk in collective.chunks():
+                            # Consider all pipelined steps that overlap with this step
+                            for overlapping_step in range(step, instance.steps, instance.steps - overlap):
+                                sends_by_addr[(collective.address(chunk))].append(_sent_in(chunk, src, dst, overlapping_step))
+                        # Count sends happening on an address only once and give each of these weight 1
+                        pb_sends.extend([(Or(sends),1) for sends in sends_by_addr.values()])
+                # For each number of rounds this step could have impose a pseudo-boolean
+                # constraint limiting sends on this step to the available bandwidth
+                for i in range(1, instance.extra_rounds + 2):
+                    s.add(Implies(_rounds(step) == i, PbLe(pb_sends, bw * i)))
+
+        # Memory
+        if instance.extra_memory != None:
+            for chunk in collective.chunks():
+                for rank in collective.ranks():
+                    if collective.postcondition(rank, chunk):
+                        # In the postcondition the chunk can not stop being on the rank before the end of the algorithm
+                        s.add(_end(chunk, rank) > instance.steps)
+
+            for rank in collective.ranks():
+                addresses, input_addresses, output_addresses = self._addresses(collective, rank)
+                # Count how many addresses will be in the input and output buffers
+                input_size = len(input_addresses)
+                output_size = len(output_addresses)
+                idx_end = input_size + output_size + instance.extra_memory
+
+                for addr in (addresses - input_addresses) - output_addresses:
                     # If the address is ever live on this rank require it to be inside the memory limits
                     in_memory = And(0 <= _idx(addr, rank), _idx(addr, rank) < idx_end)
                     s.add(Implies(_addr_start(addr, rank) <= instance.steps, in_memory))
 
+    # Returns all addresses on rank and the ones that will be in its input and output buffers
+    def _addresses(self, collective, rank):
+        addresses = set()
+        input_addresses = set()
+        output_addresses = set()
+        for chunk in collective.chunks():
+            addr = collective.address(chunk)
+            addresses.add(addr)
+            if collective.precondition(rank, chunk):
+                input_addresses.add(addr)
+            if collective.postcondition(rank, chunk):
+                output_addresses.add(addr)
+        return addresses, input_addresses, output_addresses
+
+    def _encode(self, s, instance, collective):
+        self._encode_static(s, instance, collective)
+        self._encode_steps(s, instance, collective)
+
+    # Instances with the same key share the constraints of _encode_static
+    def _static_key(self, instance):
+        return (instance.chunks, instance.extra_memory != None, instance.allow_exchange)
+
+    # Returns the chunked collective and the solver holding its static constraints for instance. The solver is
+    # kept across instances, so each solve only adds its step dependent constraints in a scope of the solver and
+    # what Z3 learns from the static constraints carries over to the next solve.
+    def _incremental_solver(self, instance):
+        key = self._static_key(instance)
+        if key not in self._solvers:
+            chunked = self.collective.chunk_up(instance.chunks)
+            solver = Solver()
+            self._encode_static(solver, instance, chunked)
+            if self.symmetry_breaking:
+                self._encode_symmetry_breaking(solver, chunked)
+            self._solvers[key] = (chunked, solver)
+        return self._solvers[key]
+
     def solve(self, instance):
-        chunked = self.collective.chunk_up(instance.chunks)
-
-        solver = Solver()
-        self._encode(solver, instance, chunked)
-        if solver.check() == sat:
-            model = solver.model()
-
-            # Decode sends from the model
-            send_sets = [set() for step in range(instance.steps)]
-            for chunk in chunked.chunks():
-                addr = chunked.address(chunk)
-                for dst in chunked.ranks():
-                    for src in self.topology.sources(dst):
-                        # Check if the send of chunk from src to dst happens
-                        if is_true(model.eval(_send(chunk, src, dst))):
-                            # Find which step it happens on (the step before it starts on the destination)
-                            step = model.eval(_start(chunk, dst)).as_long() - 1
-                            # Filter out "phantom" sends that happen outside the algorithm
-                            if 0 <= step and step < instance.steps:
-                                send_sets[step].add((addr, src, dst))
-
-            # Store the sends for each step and number of rounds used
-            steps = [Step(model.eval(_rounds(i)).as_long(), list(send_sets[i])) for i in range(instance.steps)]
-
-            return Algorithm.make_implementation(self.collective, self.topology, instance, steps)
-        else:
-            return None
+        chunked, solver = self._incremental_solver(instance)
+        solver.push()
+        try:
+            self._encode_steps(solver, instance, chunked)
+            if solver.check() == sat:
+                return self._decode(solver.model(), instance, chunked)
+            else:
+                return None
+        finally:
+            solver.pop()
+
+    def _decode(self, model, instance, chunked):
+        # Decode sends from the model
+        send_sets = [set() for step in range(instance.steps)]
+        for chunk in chunked.chunks():
+            addr = chunked.address(chunk)
+            for dst in chunked.ranks():
+                for src in self.topology.sources(dst):
+                    # Check if the send of chunk from src to dst happens
+                    if is_true(model.eval(_send(chunk, src, dst))):
+                        # Find which step it happens on (the step before it starts on the destination)
+                        step = model.eval(_start(chunk, dst)).as_long() - 1
+                        # Filter out "phantom" sends that happen outside the algorithm
+                        if 0 <= step and step < instance.steps:
+                            send_sets[step].add((addr, src, dst))
+
+        # Store the sends for each step and number of rounds used
+        steps = [Step(model.eval(_rounds(i)).as_long(), list(send_sets[i])) for i in range(instance.steps)]
+
+        return Algorithm.make_implementation(self.collective, self.topology, instance, steps)
 
 # Prefer using the non-combining dual reduction
 PathEncoding = wrap_try_ncd_reduction(PathEncodingBase)
@@ -0,0 +1,342 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import heapq
+import io
+import math
+import os
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+
+from msccl.language.ir import Program, read_xml, write_xml, xml_to_ir
+
+# Discrete-event performance model of MSCCL-IR programs. Threadblocks execute their steps in order, wait
+# on their depid/deps dependency and on the messages they receive, and sends are serialized on the
+# bandwidth constraints (links and switches) of the topology they cross.
+
+@dataclass
+class ProtocolModel:
+    latency: float # Seconds added to every transfer
+    efficiency: float # Fraction of the bytes on the wire that are payload
+
+# Per hop latencies of the NCCL protocols over NVLink and their payload efficiencies
+protocol_models = {
+    'Simple': ProtocolModel(latency=4e-6, efficiency=1.0),
+    'LL': ProtocolModel(latency=0.6e-6, efficiency=0.5),
+    'LL128': ProtocolModel(latency=1.25e-6, efficiency=120/128),
+}
+
+_send_types = {'s', 'rcs', 'rrs', 'rrcs'}
+_recv_types = {'r', 'rcs', 'rrs', 'rrc', 'rrcs'}
+_local_types = {'r', 'rrc', 'rrcs', 'rrs', 'cpy', 're'}
+
+
+# Alpha-beta cost model: a transfer of b bytes over constraints of bandwidths bw_1..bw_k in topology
+# units takes alpha + protocol latency + b * beta / min(bw_i) seconds. Local copies and reductions
+# take b * local_beta seconds. Without a topology every pair of ranks has its own link of bandwidth 1.
+class CostModel:
+    def __init__(self, topology=None, alpha=1e-6, beta=1/25e9, local_beta=1/500e9, protocols=protocol_models):
+        self.topology = topology
+        self.alpha = alpha
+        self.beta = beta
+        self.local_beta = local_beta
+        self.protocols = protocols
+        self._constraints = {}
+        if topology is not None:
+            self._all_constraints = list(topology.bandwidth_constraints())
+
+    # Returns the (name, bandwidth) of the constraints a transfer from src to dst is subject to
+    def constraints(self, src, dst):
+        key = (src, dst)
+        if key not in self._constraints:
+            if self.topology is None:
+                self._constraints[key] = [(f'{src}→{dst}', 1)]
+            else:
+                constraints = [(name, bw) for srcs, dsts, bw, name in self._all_constraints if src in srcs and dst in dsts]
+                if len(constraints) == 0:
+                    raise ValueError(f'No link from rank {src} to rank {dst} in topology {self.topology.name}')
+                self._constraints[key] = constraints
+        return self._constraints[key]
+
+    def transfer_time(self, src, dst, size, protocol):
+        proto = self.protocols[protocol]
+        bw = min(bw for _, bw in self.constraints(src, dst))
+        return self.alpha + proto.latency + size / proto.efficiency * self.beta / bw
+
+    def local_time(self, size):
+        return size * self.local_beta
+
+
+@dataclass
+class SimulationResult:
+    protocol: str
+    size: int # Bytes of the largest of the input and output buffers
+    time: float # Predicted completion time in seconds, infinite if the program deadlocks
+    algbw: float # size / time in bytes per second
+    busbw: float # algbw scaled by the collective's bus bandwidth factor as in nccl-tests
+    stuck: list = field(default_factory=list) # (rank, tbid, step) of threadblocks that never finish
+
+
+@dataclass
+class _Step:
+    type: str
+    cnt: int
+    dep: tuple # (tbid, step) of the dependency on the same rank or None
+
+
+@dataclass
+class _Threadblock:
+    rank: int
+    id: int
+    send: int
+    recv: int
+    channel: int
+    steps: list
+
+
+@dataclass
+class _Algo:
+    name: str
+    collective: str
+    ngpus: int
+    nchunksperloop: int
+    tbs: list
+
+
+def _parse_algo(program):
+    tbs = []
+    for gpu in program.gpus:
+        for tb in gpu.threadblocks:
+            steps = [_Step(str(op.inst), op.cnt(), (op.depends[0].tb, op.depends[0].step) if len(op.depends) > 0 else None) for op in tb.ops]
+            tbs.append(_Threadblock(gpu.rank, tb.rbid, tb.send, tb.recv, tb.channel, steps))
+    nchunksperloop = program.nchunksperloop
+    if nchunksperloop is None:
+        nchunksperloop = max((max(gpu.input_chunks, gpu.output_chunks) for gpu in program.gpus), default=1)
+    return _Algo(program.name, program.collective, len(program.gpus), nchunksperloop, tbs)
+
+
+# Reads the algorithm from a Program returned by MSCCLProgram.lower(), a path to an XML file or a string of XML
+def _load_algo(program):
+    if isinstance(program, Program):
+        out = io.StringIO()
+        write_xml(program, out)
+        program = xml_to_ir(out.getvalue())
+    elif isinstance(program, str) and program.lstrip().startswith('<'):
+        program = xml_to_ir(program)
+    elif isinstance(program, (str, os.PathLike)):
+        program = read_xml(program)
+    else:
+        raise ValueError(f'Cannot simulate {program}, expected a Program, an XML string or a path')
+    return _parse_algo(program)
+
+
+def _busbw_factor(collective, ngpus):
+    if collective == 'allreduce':
+        return 2 * (ngpus - 1) / ngpus
+    if collective in ('allgather', 'reduce_scatter', 'alltoall'):
+        return (ngpus - 1) / ngpus
+    return 1
+
+
+# Bounded FIFO of slots between the sending and receiving threadblock of each (sender rank, receiver rank, channel).
+# A message takes one slot per slot_sizes[protocol] bytes of payload. The runtime splits buffers into loop iterations
+# whose chunks fit in a slot, so a message of cnt chunks takes at most cnt slots (and at most all slots of its
+# connection). A sender stalls while its message does not fit in the free slots.
+# slots is either the number of slots of every connection or a dict from (sender rank, receiver rank, channel) to it,
+# with default_slots for the connections it does not list.
+class ConnectionModel:
+    def __init__(self, slots=8, slot_sizes=None, default_slots=8):
+        self.slots = slots
+        self.default_slots = default_slots
+        # Payload of a slot with the default buffer sizes of NCCL, split in 8 steps
+        self.slot_sizes = slot_sizes if slot_sizes is not None else {'Simple': 512 * 1024, 'LL': 32 * 1024, 'LL128': 576000}
+
+    def depth(self, conn):
+        if isinstance(self.slots, dict):
+            return self.slots.get(conn, self.default_slots)
+        return self.slots
+
+    def message_slots(self, cnt, chunk_size, protocol):
+        slot_size = self.slot_sizes[protocol]
+        return max(1, math.ceil(cnt * min(chunk_size, slot_size) / slot_size))
+
+
+@dataclass
+class ThreadblockStats:
+    busy: float = 0.0 # Seconds spent executing steps
+    idle: float = 0.0 # Seconds until the end of the program not spent executing steps
+    stalled: float = 0.0 # Seconds senders waited for free slots
+    stalls: int = 0 # Number of sends that waited for free slots
+
+
+@dataclass
+class ConnectionReport:
+    protocol: str
+    size: int
+    time: float # Completion time in seconds, infinite if the program deadlocks
+    stuck: dict # (rank, tbid, step) -> 'dependency', 'recv' or 'send' for threadblocks that never finish
+    tbs: dict # (rank, tbid) -> ThreadblockStats
+
+    @property
+    def deadlocked(self):
+        return len(self.stuck) > 0
+
+    @property
+    def stalled(self):
+        return [key for key, stats in self.tbs.items() if stats.stalls > 0]
+
+
+@dataclass
+class _Message:
+    arrival: float
+    slots: int
+
+
+class _Simulation:
+    def __init__(self, algo, model, chunk_size, protocol, connections=None):
+        self.algo = algo
+        self.model = model
+        self.chunk_size = chunk_size
+        self.protocol = protocol
+        self.connections = connections
+        self.tbs = {(tb.rank, tb.id): tb for tb in algo.tbs}
+        self.pc = {key: 0 for key in self.tbs} # Next step of each threadblock
+        self.free = {key: 0.0 for key in self.tbs} # When each threadblock finished its last step
+        self.done = {} # (rank, tbid, step) -> completion time
+        self.waiting = defaultdict(list) # (rank, tbid, step) or connection -> threadblocks waiting on it
+        self.blocked = {} # (rank, tbid) -> what its next step waits on
+        self.messages = defaultdict(deque) # (src, dst, channel) -> messages not received yet
+        self.used_slots = defaultdict(int) # (src, dst, channel) -> slots taken by messages not received yet
+        self.busy_until = defaultdict(float) # constraint name -> when it is free
+        self.stats = {key: ThreadblockStats() for key in self.tbs}
+        self.stall_start = {} # (rank, tbid) -> when its send started waiting for slots
+        self.events = []
+        self.seq = 0
+
+    def push(self, time, key):
+        heapq.heappush(self.events, (time, self.seq, key))
+        self.seq += 1
+
+    def wake(self, waited, time):
+        for key in self.waiting.pop(waited, []):
+            self.push(time, key)
+
+    def wait(self, key, waited, reason):
+        self.waiting[waited].append(key)
+        self.blocked[key] = reason
+
+    # Sends size bytes from src to dst at time start, returns the arrival time
+    def transfer(self, src, dst, size, start):
+        constraints = self.model.constraints(src, dst)
+        start = max([start] + [self.busy_until[name] for name, _ in constraints])
+        end = start + self.model.transfer_time(src, dst, size, self.protocol)
+        for name, _ in constraints:
+            self.busy_until[name] = end
+        return end
+
+    def finish(self, key, s, start, end):
+        self.done[key + (s,)] = end
+        self.pc[key] = s + 1
+        self.free[key] = end
+        self.stats[key].busy += end - start
+        self.wake(key + (s,), end)
+        self.push(end, key)
+
+    # Tries to execute the next step of a threadblock at time now
+    def step(self, key, now):
+        tb = self.tbs[key]
+        s = self.pc[key]
+        if s == len(tb.steps) or now < self.free[key]:
+            return
+        step = tb.steps[s]
+        if step.dep is not None:
+            dep = (tb.rank,) + step.dep
+            if dep not in self.done:
+                self.wait(key, dep, 'dependency')
+                return
+            if self.done[dep] > now:
+                self.push(self.done[dep], key)
+                return
+        size = step.cnt * self.chunk_size
+        if step.type in _send_types:
+            send_conn = (tb.rank, tb.send, tb.channel)
+            slots = 0
+            if self.connections is not None:
+                depth = self.connections.depth(send_conn)
+                slots = min(self.connections.message_slots(step.cnt, self.chunk_size, self.protocol), depth)
+                if self.used_slots[send_conn] + slots > depth:
+                    self.stall_start.setdefault(key, now)
+                    self.wait(key, ('slots',) + send_conn, 'send')
+                    return
+        if step.type in _recv_types:
+            conn = (tb.recv, tb.rank, tb.channel)
+            if len(self.messages[conn]) == 0:
+                self.wait(key, conn, 'recv')
+                return
+            if self.messages[conn][0].arrival > now:
+                self.push(self.messages[conn][0].arrival, key)
+                return
+            message = self.messages[conn].popleft()
+            self.used_slots[conn] -= message.slots
+            self.wake(('slots',) + conn, now)
+        self.blocked.pop(key, None)
+        if key in self.stall_start:
+            self.stats[key].stalled += now - self.stall_start.pop(key)
+            self.stats[key].stalls += 1
+        end = now
+        if step.type in _local_types:
+            end += self.model.local_time(size)
+        if step.type in _send_types:
+            end = self.transfer(tb.rank, tb.send, size, end)
+            self.used_slots[send_conn] += slots
+            self.messages[send_conn].append(_Message(end, slots))
+            self.wake(send_conn, end)
+        self.finish(key, s, now, end)
+
+    def run(self):
+        for key in self.tbs:
+            self.push(0.0, key)
+        while len(self.events) > 0:
+            now, _, key = heapq.heappop(self.events)
+            self.step(key, now)
+        stuck = {key + (self.pc[key],): self.blocked.get(key, 'dependency') for key, tb in self.tbs.items() if self.pc[key] < len(tb.steps)}
+        if len(stuck) > 0:
+            return math.inf, stuck
+        time = max(self.free[key] for key in self.tbs) if len(self.tbs) > 0 else 0.0
+        for stats in self.stats.values():
+            stats.idle = time - stats.busy
+        return time, stuck
+
+
+# Predicts the completion time and bus bandwidth of an algorithm for each message size and protocol.
+# program is a Program returned by MSCCLProgram.lower(), a path to an XML file or a string of XML.
+# sizes are in bytes of the largest of the input and output buffers, as reported by nccl-tests.
+# With a ConnectionModel, senders are limited by the slots of their connections.
+def simulate(program, topology=None, sizes=None, protocols=('Simple', 'LL', 'LL128'), model=None, connections=None):
+    algo = _load_algo(program)
+    if model is None:
+        model = CostModel(topology)
+    if sizes is None:
+        sizes = [2**i for i in range(10, 31, 2)] # 1KiB to 1GiB
+    factor = _busbw_factor(algo.collective, algo.ngpus)
+    results = []
+    for protocol in protocols:
+        for size in sizes:
+            time, stuck = _Simulation(algo, model, size / algo.nchunksperloop, protocol, connections).run()
+            algbw = size / time if time > 0 else math.inf
+            results.append(SimulationResult(protocol, size, time, algbw, algbw * factor, list(stuck)))
+    return results
+
+
+# Replays an algorithm against bounded connections and reports the threadblocks that stall or deadlock
+# and how long each threadblock is idle. slots is the number of slots of every connection or a dict from
+# (sender rank, receiver rank, channel) to it.
+def analyze_connections(program, slots=8, size=2**20, protocol='Simple', topology=None, model=None, connections=None):
+    algo = _load_algo(program)
+    if model is None:
+        model = CostModel(topology)
+    if connections is None:
+        connections = ConnectionModel(slots)
+    sim = _Simulation(algo, model, size / algo.nchunksperloop, protocol, connections)
+    time, stuck = sim.run()
+    return ConnectionReport(protocol, size, time, stuck, sim.stats)
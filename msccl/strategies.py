@@ -10,7 +10,10 @@ import time
 import math
 from fractions import Fraction
 import itertools
+import multiprocessing
+from multiprocessing.connection import wait
 from collections import defaultdict
+import z3
 
 def _solve_and_log(encoding, instance, logging):
     if logging:
@@ -28,15 +31,121 @@ def _solve_and_log(encoding, instance, logging):
 
     return result
 
-def solve_instance(topology, collective, instance, logging = False):
-    encoding = PathEncoding(topology, collective)
+def solve_instance(topology, collective, instance, logging = False, symmetry_breaking = False):
+    encoding = PathEncoding(topology, collective, symmetry_breaking)
     return _solve_and_log(encoding, instance, logging)
 
-def solve_least_steps(topology, collective, initial_steps = 1, base_instance = Instance(None), logging = False):
+# Solves an instance in a worker process of a _Portfolio and sends the result and duration back on conn
+def _solve_in_worker(conn, topology, collective, instance, seed, symmetry_breaking):
+    if seed != None:
+        z3.set_param('smt.random_seed', seed, 'sat.random_seed', seed)
+    start_time = time.time()
+    result = PathEncoding(topology, collective, symmetry_breaking).solve(instance)
+    conn.send((result, time.time() - start_time))
+    conn.close()
+
+# Solves instances in parallel worker processes, each instance optionally with its own Z3 random seed.
+# Solves that are no longer needed can be cancelled, which terminates their process.
+class _Portfolio(object):
+    def __init__(self, topology, collective, logging, symmetry_breaking = False):
+        self.topology = topology
+        self.collective = collective
+        self.logging = logging
+        self.symmetry_breaking = symmetry_breaking
+        self.context = multiprocessing.get_context()
+        self.running = {} # (instance, seed) -> (process, connection)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for key in list(self.running):
+            self.cancel(key, logging=False)
+
+    def _describe(self, key):
+        instance, seed = key
+        return f'instance {instance}' if seed == None else f'instance {instance} (seed {seed})'
+
+    def submit(self, instance, seed = None):
+        key = (instance, seed)
+        reader, writer = self.context.Pipe(duplex=False)
+        process = self.context.Process(target=_solve_in_worker, args=(writer, self.topology, self.collective, instance, seed, self.symmetry_breaking), daemon=True)
+        process.start()
+        writer.close()
+        self.running[key] = (process, reader)
+        if self.logging:
+            print(f'Solving {self._describe(key)}...', flush=True)
+
+    def cancel(self, key, logging = True):
+        process, reader = self.running.pop(key)
+        process.terminate()
+        process.join()
+        reader.close()
+        if logging and self.logging:
+            print(f'Cancelled {self._describe(key)}.')
+
+    # Cancels the running solves for which should_cancel(instance) is true
+    def cancel_if(self, should_cancel):
+        for key in [key for key in self.running if should_cancel(key[0])]:
+            self.cancel(key)
+
+    # Waits for a running solve to finish and returns its (instance, seed, result)
+    def next_result(self):
+        readers = {reader: key for key, (process, reader) in self.running.items()}
+        reader = wait(list(readers))[0]
+        key = readers[reader]
+        process, _ = self.running.pop(key)
+        try:
+            result, duration = reader.recv()
+        except EOFError:
+            raise RuntimeError(f'Solver process for {self._describe(key)} exited with code {process.exitcode}')
+        finally:
+            process.join()
+            reader.close()
+        if self.logging:
+            outcome = 'synthesized!' if result != None else 'unsatisfiable.'
+            print(f'Solved {self._describe(key)}: {outcome} ({duration:.1f}s)')
+        instance, seed = key
+        return instance, seed, result
+
+# Searches for the least number of steps with up to jobs instances solved in parallel, each number of steps with
+# every seed in seeds. Assumes that feasibility is monotonic in the number of steps: a solution for some number
+# of steps cancels the solves of more steps, a proof of unsatisfiability cancels the solves of fewer steps.
+def _solve_least_steps_portfolio(topology, collective, num_steps, steps_lb, base_instance, jobs, seeds, logging, symmetry_breaking):
+    unsat_steps = steps_lb - 1 # This and fewer steps are unsatisfiable
+    best = None
+    submitted = set()
+    with _Portfolio(topology, collective, logging, symmetry_breaking) as portfolio:
+        while best == None or best.instance.steps > unsat_steps + 1:
+            # Try more steps until a solution is found, then fewer steps than the best solution
+            if best == None:
+                candidates = itertools.count(num_steps)
+            else:
+                candidates = range(best.instance.steps - 1, unsat_steps, -1)
+            for steps, seed in ((steps, seed) for steps in candidates for seed in seeds):
+                if len(portfolio.running) >= jobs:
+                    break
+                if (steps, seed) not in submitted:
+                    submitted.add((steps, seed))
+                    portfolio.submit(base_instance.set(steps=steps), seed)
+
+            instance, seed, result = portfolio.next_result()
+            if result != None:
+                if best == None or instance.steps < best.instance.steps:
+                    best = result
+                portfolio.cancel_if(lambda other: other.steps >= instance.steps)
+            else:
+                unsat_steps = max(unsat_steps, instance.steps)
+                portfolio.cancel_if(lambda other: other.steps <= instance.steps)
+    return best
+
+def solve_least_steps(topology, collective, initial_steps = 1, base_instance = Instance(None), logging = False, jobs = 1, seeds = None, symmetry_breaking = False):
     if initial_steps < 1:
         raise ValueError('initial_steps must be strictly positive')
+    if jobs < 1:
+        raise ValueError('jobs must be strictly positive')
 
-    encoding = PathEncoding(topology, collective)
+    encoding = PathEncoding(topology, collective, symmetry_breaking)
 
     # Lower bound the number of steps required
     steps_lb = lower_bound_steps(topology, collective)
@@ -47,6 +156,8 @@ def solve_least_steps(topology, collective, initial_steps = 1, base_instance = I
         print(f'Algorithms need at least {steps_lb} steps.')
 
     num_steps = max(initial_steps, steps_lb)
+    if jobs > 1 or seeds != None:
+        return _solve_least_steps_portfolio(topology, collective, num_steps, steps_lb, base_instance, jobs, seeds or [None], logging, symmetry_breaking)
     if num_steps > steps_lb:
         result = _solve_and_log(encoding, base_instance.set(steps=num_steps), logging)
         if result != None:
@@ -70,13 +181,152 @@ def solve_least_steps(topology, collective, initial_steps = 1, base_instance = I
         else:
             num_steps += 1
 
-def solve_all_latency_bandwidth_tradeoffs(topology, collective, min_chunks = 1, max_chunks = None, assume_rounds_per_chunk_lb = None, assume_monotonic_feasibility = False, base_instance = Instance(None), logging = False):
+# The (rounds, steps) pairs solve_all_latency_bandwidth_tradeoffs tries for a number of chunks, in order
+def _tradeoff_candidates(chunks, rounds_lb, steps_lb):
+    for rounds in itertools.count(rounds_lb):
+        # Skip this fraction if a lower number of chunks will have already considered it
+        if math.gcd(chunks, rounds) != 1:
+            continue
+        for steps in range(steps_lb, rounds+1):
+            yield rounds, steps
+
+# The search of _solve_all_tradeoffs_parallel for one number of chunks. Candidates are submitted in order and
+# the first satisfiable one is the result once every candidate before it has been ruled out.
+class _TradeoffSearch(object):
+    def __init__(self, chunks, rounds_lb, steps_lb):
+        self.chunks = chunks
+        self.candidates = _tradeoff_candidates(chunks, rounds_lb, steps_lb)
+        self.order = [] # (rounds, steps) in the order they were taken
+        self.outcomes = {} # (rounds, steps) -> None while solving, True if satisfiable, False if ruled out
+        self.best = None # Index in order of the first satisfiable candidate found so far
+        self.result = None
+
+    # Returns the next candidate to solve, skipping those for which skip(rounds, steps) is true, or None if
+    # a candidate before all untaken ones is already satisfiable
+    def take(self, skip):
+        while self.best == None:
+            rounds, steps = next(self.candidates)
+            self.order.append((rounds, steps))
+            if skip(rounds, steps):
+                self.outcomes[(rounds, steps)] = False
+                continue
+            self.outcomes[(rounds, steps)] = None
+            return rounds, steps
+        return None
+
+    def satisfiable(self, rounds, steps, result):
+        self.outcomes[(rounds, steps)] = True
+        index = self.order.index((rounds, steps))
+        if self.best == None or index < self.best:
+            self.best = index
+            self.result = result
+
+    def ruled_out(self, rounds, steps):
+        self.outcomes[(rounds, steps)] = False
+
+    # Candidates taken after the best satisfiable one are no longer needed
+    def unneeded(self, rounds, steps):
+        return self.best != None and self.order.index((rounds, steps)) > self.best
+
+    def done(self):
+        for key in self.order:
+            outcome = self.outcomes[key]
+            if outcome != False:
+                return outcome == True
+        return False
+
+# Parallel version of solve_all_latency_bandwidth_tradeoffs. Up to jobs instances are solved at once, taken
+# round robin from the searches of the next jobs numbers of chunks. The rounds per chunk for which a number of
+# steps is unsatisfiable is shared with the searches of the same and higher numbers of chunks, like in the
+# sequential search: it skips candidates that have not been submitted yet and cancels running ones. Algorithms
+# are yielded in the order of their number of chunks as soon as they are proven to be the result for it.
+def _solve_all_tradeoffs_parallel(topology, collective, chunks_iter, rounds_per_chunk_lb, steps_lb, assume_monotonic_feasibility, base_instance, jobs, logging, symmetry_breaking):
+    step_rpc_lbs = defaultdict(dict) # steps -> chunks -> highest unsatisfiable rounds per chunk
+
+    # Instances solved out of order only bound those with at least as many chunks
+    def rpc_lb(chunks, steps):
+        return max((rpc for c, rpc in step_rpc_lbs[steps].items() if c <= chunks), default=Fraction(0))
+
+    def pruned(rounds, chunks, steps):
+        return assume_monotonic_feasibility and Fraction(rounds, chunks) < rpc_lb(chunks, steps)
+
+    searches = {} # chunks -> _TradeoffSearch, in increasing number of chunks
+    chunks_iter = iter(chunks_iter)
+    exhausted = False
+    with _Portfolio(topology, collective, logging, symmetry_breaking) as portfolio:
+        while True:
+            # Yield the results of the lowest numbers of chunks that are done
+            while searches:
+                search = next(iter(searches.values()))
+                if not search.done():
+                    break
+                del searches[search.chunks]
+                yield search.result
+                rpc = Fraction(search.result.instance.rounds(), search.chunks)
+                # Check if a bandwidth optimal algorithm has been found
+                if rpc <= rounds_per_chunk_lb:
+                    assert rpc == rounds_per_chunk_lb, 'Rounds per chunk lower bound did not hold.'
+                    if logging:
+                        print(f'Bandwidth optimal algorithm found!')
+                    return
+            while not exhausted and len(searches) < jobs:
+                chunks = next(chunks_iter, None)
+                if chunks == None:
+                    exhausted = True
+                else:
+                    searches[chunks] = _TradeoffSearch(chunks, math.ceil(rounds_per_chunk_lb * chunks), steps_lb)
+            if not searches:
+                if logging:
+                    print(f'Reached the limit for chunks.')
+                return
+
+            # Fill the free jobs round robin over the searches, lowest number of chunks first
+            taken = True
+            while taken and len(portfolio.running) < jobs:
+                taken = False
+                for search in searches.values():
+                    if len(portfolio.running) >= jobs:
+                        break
+                    candidate = search.take(lambda rounds, steps: pruned(rounds, search.chunks, steps))
+                    if candidate != None:
+                        rounds, steps = candidate
+                        portfolio.submit(base_instance.set(steps=steps, extra_rounds=rounds - steps, chunks=search.chunks))
+                        taken = True
+
+            instance, _, result = portfolio.next_result()
+            search = searches[instance.chunks]
+            steps, rounds = instance.steps, instance.rounds()
+            rpc = Fraction(rounds, instance.chunks)
+            if result != None:
+                # Unlike the sequential search, this may have learned bounds from instances solved out of order
+                assert not assume_monotonic_feasibility or rpc >= rpc_lb(instance.chunks, steps), 'Monotonic feasibility assumption would have been violated.'
+                search.satisfiable(rounds, steps, result)
+                portfolio.cancel_if(lambda other: other.chunks == search.chunks and search.unneeded(other.rounds(), other.steps))
+            else:
+                search.ruled_out(rounds, steps)
+                # Update the rounds per chunk for which this number of steps is not sufficient
+                if rpc > rpc_lb(instance.chunks, steps):
+                    if logging and assume_monotonic_feasibility:
+                        print(f'Assuming {steps} step algorithms need at least {rpc} rounds per chunk.')
+                if rpc > step_rpc_lbs[steps].get(instance.chunks, Fraction(0)):
+                    step_rpc_lbs[steps][instance.chunks] = rpc
+                if assume_monotonic_feasibility:
+                    def unsatisfiable(other):
+                        if pruned(other.rounds(), other.chunks, other.steps):
+                            searches[other.chunks].ruled_out(other.rounds(), other.steps)
+                            return True
+                        return False
+                    portfolio.cancel_if(unsatisfiable)
+
+def solve_all_latency_bandwidth_tradeoffs(topology, collective, min_chunks = 1, max_chunks = None, assume_rounds_per_chunk_lb = None, assume_monotonic_feasibility = False, base_instance = Instance(None), logging = False, jobs = 1, symmetry_breaking = False):
     if min_chunks < 1:
         raise ValueError('min_chunks must be strictly positive.')
     if max_chunks != None and max_chunks < min_chunks:
         raise ValueError('max_chunks must be greater or equal to min_chunks.')
     if assume_rounds_per_chunk_lb != None and assume_rounds_per_chunk_lb < 0:
         raise ValueError('assume_rounds_per_chunk_lb must be positive.')
+    if jobs < 1:
+        raise ValueError('jobs must be strictly positive.')
 
     # Lower bound the number of steps required
     steps_lb = lower_bound_steps(topology, collective)
@@ -93,14 +343,17 @@ def solve_all_latency_bandwidth_tradeoffs(topology, collective, min_chunks = 1,
         if logging:
             print(f'Algorithms need at least {rounds_per_chunk_lb} rounds per chunk.')
 
+    chunks_iter = range(min_chunks, max_chunks+1) if max_chunks != None else itertools.count(min_chunks)
+    if jobs > 1:
+        yield from _solve_all_tradeoffs_parallel(topology, collective, chunks_iter, rounds_per_chunk_lb, steps_lb, assume_monotonic_feasibility, base_instance, jobs, logging, symmetry_breaking)
+        return
+
     # Remember for which rounds per chunk fraction a given number of steps will be unsat
     step_rpc_lb = defaultdict(lambda: Fraction(0))
 
-    chunks_iter = range(min_chunks, max_chunks+1) if max_chunks != None else itertools.count(min_chunks)
-
     algorithms = []
     for chunks in chunks_iter:
-        encoding = PathEncoding(topology, collective)
+        encoding = PathEncoding(topology, collective, symmetry_breaking)
         rounds_lb = math.ceil(rounds_per_chunk_lb * chunks)
 
         rounds = rounds_lb - 1
@@ -143,17 +396,27 @@ def _steps(algo):
 def _rpc(algo):
     return Fraction(_steps(algo) + algo.extra_rounds(), algo.instance.chunks) 
 
+# Algorithm a dominates b if it is no worse in both steps and rounds per chunk and better in one of them
+def _dominates(a, b):
+    either_worse = _steps(b) > _steps(a) or _rpc(b) > _rpc(a)
+    neither_better = _steps(b) >= _steps(a) and _rpc(b) >= _rpc(a)
+    return either_worse and neither_better
+
+# The Pareto optimal algorithms among those added so far, in the order they were added
+class ParetoFrontier(object):
+    def __init__(self, algorithms = []):
+        self.algorithms = []
+        for algo in algorithms:
+            self.add(algo)
+
+    # Adds an algorithm and returns whether it is Pareto optimal among those added so far. Algorithms it
+    # dominates are removed.
+    def add(self, algo):
+        if any(_dominates(other, algo) for other in self.algorithms):
+            return False
+        self.algorithms = [other for other in self.algorithms if not _dominates(algo, other)]
+        self.algorithms.append(algo)
+        return True
+
 def prune_pareto_optimal(algorithms):
-    efficient_algorithms = []
-    for i, algo in enumerate(algorithms):
-        is_efficient = True
-        for j, other in enumerate(algorithms):
-            either_worse = _steps(algo) > _steps(other) or _rpc(algo) > _rpc(other)
-            neither_better = _steps(algo) >= _steps(other) and _rpc(algo) >= _rpc(other)
-            if either_worse and neither_better:
-                is_efficient = False
-                break
-        if is_efficient:
-            efficient_algorithms.append(algo)
-
-    return efficient_algorithms
+    return ParetoFrontier(algorithms).algorithms
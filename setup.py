@@ -22,6 +22,7 @@ setup(
         'lxml',
         'humanfriendly',
         'tabulate',
+        'numpy',
         'igraph'
     ],
     python_requires='>=3.6',
@@ -0,0 +1,9 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import pytest
+
+# Keep plans compiled by tests out of the user's compile cache and tests independent of it
+@pytest.fixture(autouse=True)
+def compile_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('MSCCL_CACHE_DIR', str(tmp_path / 'msccl_cache'))
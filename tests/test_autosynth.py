@@ -4,7 +4,14 @@
 import pytest
 import msccl
 import os
-from msccl.autosynth.registry import register_synthesis_plan
+import time
+import multiprocessing
+from msccl.autosynth.registry import register_synthesis_plan, register_msccl_program, synthesis_plans
+from msccl.autosynth import cache as cache_module
+from msccl.autosynth.cache import CompileCache, program_key
+from msccl.topologies import fully_connected
+from msccl.language import *
+from msccl.language.routines import *
 
 
 def test_msccl_init(capsys):
@@ -43,3 +50,80 @@ def test_register_plan():
     @register_synthesis_plan('allgather', ['m1', 'm2'], sizes=[(0, '4MB'), ('1GiB', None)])
     def dummy_plan(m, s):
         pass
+
+
+def test_compile_cache(tmp_path):
+    cache = CompileCache(str(tmp_path), max_size=10)
+    assert cache.get('a') is None
+    path = cache.put('a', lambda f: f.write('<algo/>'))
+    assert cache.get('a') == path and open(path).read() == '<algo/>'
+    # Over the size bound, the least recently used entry is evicted once it is old enough
+    os.utime(path, (0, 0))
+    cache.put('b', lambda f: f.write('<algo/>'))
+    assert cache.get('a') is None and cache.get('b') is not None
+    # Recently used entries are kept
+    cache.put('c', lambda f: f.write('<algo/>'))
+    assert cache.get('b') is not None and cache.get('c') is not None
+    # Builders lock files from a fixed pool, so the directory only grows with its entries
+    for key in 'abcdefgh' * 20:
+        cache.get_or_put(key, lambda f: f.write('<algo/>'))
+    locks = [name for name in os.listdir(tmp_path) if not name.endswith('.xml')]
+    assert 0 < len(locks) <= 8 and all(name.startswith('.lock') for name in locks)
+
+
+
+def test_compile_cache_read_only(tmp_path, monkeypatch):
+    cache = CompileCache(str(tmp_path), max_size=10)
+    path = cache.put('a', lambda f: f.write('<algo/>'))
+    def utime(path, times=None):
+        raise PermissionError(path)
+    monkeypatch.setattr(os, 'utime', utime)
+    # Entries are still returned when their access time cannot be updated
+    assert cache.get('a') == path
+    assert cache.get('b') is None
+
+
+def test_program_key_source(monkeypatch):
+    def fun(prog):
+        pass
+    key = program_key(fun, machines=1)
+    assert key == program_key(fun, machines=1) and key != program_key(fun, machines=2)
+    # Entries built by other sources of the compiler are not reused
+    monkeypatch.setattr(cache_module, '_msccl_digest', 'other')
+    assert program_key(fun, machines=1) != key
+
+def test_register_msccl_program_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv('MSCCL_CACHE_DIR', str(tmp_path))
+    calls = []
+    @register_msccl_program(fully_connected(2), 'allgather', 'cached_machine', inplace=True)
+    def cached_allgather(prog, machines):
+        calls.append(machines)
+        allgather_ring_inplace(2 * machines)
+    plan = synthesis_plans[('allgather', 'cached_machine')][0][1]
+    path = plan(1)
+    assert os.path.dirname(path) == str(tmp_path)
+    assert plan(1) == path and calls == [1]
+    assert plan(2) != path and calls == [1, 2]
+
+
+def test_single_flight_plan(tmp_path, monkeypatch):
+    monkeypatch.setenv('MSCCL_CACHE_DIR', str(tmp_path / 'cache'))
+    log = tmp_path / 'builds'
+    @register_synthesis_plan('allgather', 'single_flight_machine')
+    def slow_plan(machines):
+        with open(log, 'a') as f:
+            f.write('build\n')
+        time.sleep(0.5)
+        return '<algo/>'
+    plan = synthesis_plans[('allgather', 'single_flight_machine')][0][1]
+    ctx = multiprocessing.get_context('fork')
+    procs = [ctx.Process(target=plan, args=(1,)) for _ in range(4)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+        assert proc.exitcode == 0
+    # Only one process builds the plan, the others wait and reuse it
+    assert log.read_text() == 'build\n'
+    assert open(plan(1)).read() == '<algo/>'
+    assert log.read_text() == 'build\n'
@@ -50,6 +50,9 @@ def test_extra_memory():
 def test_solve_least_steps():
     assert 0 == os.system('msccl solve least-steps Ring Allgather --nodes 2')
     assert 0 == os.system('msccl solve least-steps Ring Allgather --nodes 2 --initial-steps 2')
+    assert 0 == os.system('msccl solve least-steps Ring Allgather --nodes 4 --jobs 2')
+    assert 0 == os.system('msccl solve least-steps Ring Allgather --nodes 4 --jobs 2 --seeds 1 2')
+    assert 0 == os.system('msccl solve least-steps Ring Allgather --nodes 4 --symmetry-breaking')
 
 def test_solve_pareto_optimal():
     with in_tempdir():
@@ -58,8 +61,12 @@ def test_solve_pareto_optimal():
     with in_tempdir():
         assert 0 == os.system('msccl solve pareto-optimal Ring Allgather --nodes 4 -d . --save-eagerly')
         assert len(os.listdir('.')) == 2
+    with in_tempdir():
+        assert 0 == os.system('msccl solve pareto-optimal Ring Allgather --nodes 4 -d . --jobs 2')
+        assert len(os.listdir('.')) == 1
     assert 0 == os.system('msccl solve pareto-optimal Ring Alltoall --nodes 2 --assume-rpc-bound 1/1')
     assert 0 == os.system('msccl solve pareto-optimal Ring Alltoall --nodes 2 --no-monotonic-feasibility')
+    assert 0 == os.system('msccl solve pareto-optimal Ring Allgather --nodes 4 --max-chunks 2 --jobs 2 --symmetry-breaking')
 
 def test_ncclize():
     with in_tempdir():
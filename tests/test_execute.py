@@ -0,0 +1,92 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import numpy as np
+import pytest
+from msccl.language import *
+from msccl.language.routines import *
+from msccl.language.collectives import *
+from msccl.topologies import fully_connected
+from msccl.execute import *
+
+
+def _allreduce_ring(num_gpus, instances):
+    prgm = MSCCLProgram("allreduce_ring", fully_connected(num_gpus), AllReduce(num_gpus, num_gpus, True), instances)
+    with prgm:
+        allreduce_ring_inplace(num_gpus)
+    return prgm.lower()
+
+
+def _allgather_ring(num_gpus):
+    prgm = MSCCLProgram("allgather_ring", fully_connected(num_gpus), AllGather(num_gpus, 1, True), 1)
+    with prgm:
+        allgather_ring_inplace(num_gpus)
+    return prgm.lower()
+
+
+def _reducescatter():
+    prgm = MSCCLProgram("reducescatter", fully_connected(2), ReduceScatter(2, 1, False), 1)
+    with prgm:
+        chunk(1, Buffer.input, 1).reduce(chunk(0, Buffer.input, 1)).copy(1, Buffer.output, 0)
+        chunk(0, Buffer.input, 0).reduce(chunk(1, Buffer.input, 0)).copy(0, Buffer.output, 0)
+    return prgm.lower()
+
+
+def _alltoall():
+    prgm = MSCCLProgram("alltoall", fully_connected(2), AllToAll(2, 1, False), 2)
+    with prgm:
+        for r in range(2):
+            for i in range(2):
+                chunk(r, Buffer.input, i).copy(i, Buffer.output, r)
+    return prgm.lower()
+
+
+def _fused_allreduce():
+    prgm = MSCCLProgram("allreduce", fully_connected(3), AllReduce(3, 3, True), 1, threadblock_policy=ThreadblockPolicy.manual)
+    with prgm:
+        c01 = chunk(1, Buffer.input, 0, 3).reduce(chunk(0, Buffer.input, 0, 3), sendtb=0, recvtb=0, ch=0)
+        c012 = chunk(2, Buffer.input, 0, 3).reduce(c01, sendtb=0, recvtb=0, ch=0)
+        c012.copy(0, Buffer.input, 0, sendtb=0, recvtb=0, ch=0).copy(1, Buffer.input, 0, sendtb=0, recvtb=0, ch=0)
+    return prgm.lower()
+
+
+@pytest.mark.parametrize('program', [lambda: _allreduce_ring(4, 2), lambda: _allgather_ring(4), _reducescatter, _alltoall, _fused_allreduce])
+def test_execute_program(program):
+    program = program()
+    result = execute(program)
+    assert result.correct, result.errors
+    assert result.time > 0
+    # The XML runs the same and integer dtypes work too
+    assert execute(ir_to_xml(program), chunk_size=3, dtype=np.int64).correct
+
+
+def test_execute_lowering_bug():
+    # A receive that drops the reduction is only visible in the data
+    xml = ir_to_xml(_fused_allreduce())
+    assert 'type="rrcs"' in xml
+    result = execute(xml.replace('type="rrcs"', 'type="rcs"'))
+    assert not result.correct and result.stuck == []
+    assert result.errors[0].startswith('Rank 0 chunk 0 is incorrect')
+    # Received chunks must fit the buffer
+    result = execute(xml.replace('dstoff="0"', 'dstoff="2"'))
+    assert any('accesses chunks 2 to 5 of buffer i of 3 chunks' in error for error in result.errors)
+
+
+def _algo_xml(steps0, steps1):
+    def tb(steps):
+        return ''.join(f'<step s="{s}" type="{t}" srcbuf="i" srcoff="0" dstbuf="o" dstoff="0" cnt="{cnt}" depid="-1" deps="-1" hasdep="0"/>' for s, (t, cnt) in enumerate(steps))
+    return f'<algo name="test" proto="Simple" nchannels="1" nchunksperloop="2" ngpus="2" coll="custom" inplace="0">' \
+           f'<gpu id="0" i_chunks="2" o_chunks="2" s_chunks="0"><tb id="0" send="1" recv="1" chan="0">{tb(steps0)}</tb></gpu>' \
+           f'<gpu id="1" i_chunks="2" o_chunks="2" s_chunks="0"><tb id="0" send="0" recv="0" chan="0">{tb(steps1)}</tb></gpu></algo>'
+
+
+def test_execute_failures():
+    # Both ranks receive before sending
+    result = execute(_algo_xml([('r', 1), ('s', 1)], [('r', 1), ('s', 1)]))
+    assert result.stuck == [(0, 0, 0), (1, 0, 0)] and not result.correct
+    # Custom collectives are not checked
+    assert execute(_algo_xml([('s', 1), ('r', 1)], [('s', 1), ('r', 1)])).correct
+    result = execute(_algo_xml([('s', 2), ('r', 1)], [('s', 1), ('r', 1)]))
+    assert result.errors == ['Rank 1 threadblock 0: step 1 receives 1 chunks but rank 0 sent 2']
+    with pytest.raises(ValueError):
+        execute(_algo_xml([('r', 1)], [('s', 1)]).replace('send="0"', 'send="-1"'))
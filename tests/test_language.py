@@ -6,6 +6,8 @@ from msccl.topologies import line, fully_connected
 from msccl.language import *
 from msccl.language.routines import *
 from msccl.language.collectives import *
+from collections import defaultdict
+import json
 import os
 import pytest
 
@@ -287,4 +289,417 @@ def test_routines_allreduce_nodes():
             c.reduce(chunk(r, Buffer.output, exchange_index, 4))
             c = c.copy(r, Buffer.output, exchange_index)
         XML()
-        assert Check()
\ No newline at end of file
+        assert Check()
+
+
+def test_multicount_dependencies():
+    num_gpus = 3
+    topology = fully_connected(num_gpus)
+    collective = AllReduce(num_gpus, 4, inplace=True)
+    prgm = MSCCLProgram("multicount", topology, collective, 1)
+    with prgm:
+        chunk(0, Buffer.input, 0, 4).copy(1, 'scratch', 0)
+        # Partially overlapping reads of the received chunks all depend on the same receive
+        chunk(1, 'scratch', 1, 2).copy(2, 'scratch', 0)
+        chunk(1, 'scratch', 2, 2).copy(2, 'scratch', 2)
+        # Overwriting part of the received chunks must wait for both readers
+        chunk(1, Buffer.input, 0, 2).copy(1, 'scratch', 2)
+    dag = prgm.instr_dag
+    recv = dag.operations[(1, 'scratch', 0)]
+    assert recv.inst == Instruction.recv
+    # The first write of a range is found from its first slot only
+    assert all((1, 'scratch', i) not in dag.operations for i in range(1, 4))
+    sends = list(recv.next)
+    assert len(sends) == 2 and all(op.inst == Instruction.send for op in sends)
+    local_copies = [op for send in sends for op in send.next if op.inst == Instruction.copy]
+    assert len(local_copies) == 2 and local_copies[0] is local_copies[1]
+    assert local_copies[0].prev.issuperset(sends)
+
+def test_chunk_buffer():
+    buf = ChunkBuffer.from_chunks([Chunk(0, 0, 1, 2), None, Chunk(0, 2)])
+    assert len(buf) == 3
+    assert buf[0] == Chunk(0, 0) and buf[0].dst_rank == 1 and buf[0].dst_index == 2
+    assert buf[1] is None
+    with pytest.raises(IndexError):
+        buf[3] = Chunk(0, 3)
+
+    scratch = BufferSlice(Buffer.scratch, 'scratch')
+    scratch.copy_from(2, buf, 0, 3)
+    assert scratch.instance_size() == 5
+    assert scratch[0] is None and scratch[2] == Chunk(0, 0) and scratch[4] == Chunk(0, 2)
+
+    other = ChunkBuffer.from_chunks([Chunk(1, 0), Chunk(1, 1), Chunk(1, 2)])
+    buf.reduce_from(0, 0, other, 0, 1)
+    assert buf[0] == Chunk(0, 0).reduce(0, Chunk(1, 0))
+    scratch.copy_from(0, buf, 0, 1)
+    assert scratch[0] == buf[0]
+    # Overwriting a reduced chunk with a copy replaces the reduction
+    buf.copy_from(0, other, 0, 2)
+    assert buf[0] == Chunk(1, 0) and buf[1] == Chunk(1, 1)
+
+def test_reduce_chunk_bitset():
+    c = ReduceChunk(-1, [Chunk(2, 1), Chunk(0, 1)])
+    assert c == Chunk(0, 1).reduce(-1, Chunk(2, 1))
+    assert hash(c) == hash(ReduceChunk(3, [Chunk(0, 1), Chunk(2, 1)]))
+    assert c.chunks == [Chunk(0, 1), Chunk(2, 1)]
+    c = c.reduce(-1, ReduceChunk(-1, [Chunk(1, 0), Chunk(1, 1)]))
+    assert c.chunks == [Chunk(0, 1), Chunk(1, 0), Chunk(1, 1), Chunk(2, 1)]
+    assert not c.duplicates
+    # Reducing a chunk twice is not the same as reducing it once
+    twice = c.reduce(-1, Chunk(0, 1))
+    assert twice.duplicates and twice != c
+    assert twice.chunks == [Chunk(0, 1), Chunk(0, 1), Chunk(1, 0), Chunk(1, 1), Chunk(2, 1)]
+    # The number of times each chunk is reduced matters
+    a, b = Chunk(0, 0), Chunk(1, 0)
+    assert ReduceChunk(-1, [a, a, b]) != ReduceChunk(-1, [a, b, b])
+    assert ReduceChunk(-1, [a, a, b]) != ReduceChunk(-1, [a, a, a, b])
+    assert ReduceChunk(-1, [a, b]).reduce(-1, ReduceChunk(-1, [b, a])) == ReduceChunk(-1, [b, b, a, a])
+
+def test_allreduce_duplicate_reduction():
+    topology = fully_connected(2)
+    collective = AllReduce(2, 1, True)
+    with MSCCLProgram("allreduce", topology, collective, 1):
+        chunk(1, Buffer.input, 0).reduce(chunk(0, Buffer.input, 0)).copy(0, Buffer.input, 0)
+        chunk(1, Buffer.input, 0).reduce(chunk(0, Buffer.input, 0))
+        assert not Check()
+
+def test_traversal_visits_ops_once():
+    num_gpus = 8
+    topology = fully_connected(num_gpus)
+    collective = AllReduce(num_gpus, num_gpus, True)
+    prgm = MSCCLProgram("allreduce_ring", topology, collective, 1)
+    with prgm:
+        allreduce_ring_inplace(num_gpus)
+    dag = prgm.instr_dag
+    dag.convert_set_list()
+    roots = list(dag.operations.values())
+    bfs = list(bfs_ops(roots))
+    assert len(bfs) == len(set(bfs))
+    # Ring paths share ops, every op is still yielded once and after its predecessors
+    topo = list(topo_ops(roots))
+    assert set(topo) == set(bfs)
+    position = {op: i for i, op in enumerate(topo)}
+    assert all(position[op] < position[o] for op in topo for o in op.next)
+
+@pytest.mark.parametrize('depth, width', [(20, 2), (1000, 2), (100, 16)])
+def test_traversal_diamonds(depth, width):
+    # A chain of diamonds has width**depth paths from the root, each op is still reached once
+    class Node:
+        def __init__(self):
+            self.next = []
+    root = top = Node()
+    nodes = [root]
+    for _ in range(depth):
+        sides, bottom = [Node() for _ in range(width)], Node()
+        top.next = sides
+        for side in sides:
+            side.next = [bottom]
+        nodes += sides + [bottom]
+        top = bottom
+    visits = defaultdict(int)
+    def successors(op):
+        visits[op] += 1
+        return op.next
+
+    bfs = list(bfs_ops([root], successors))
+    assert len(bfs) == len(nodes) == (width + 1) * depth + 1
+    assert all(visits[op] == 1 for op in nodes)
+    visits.clear()
+    # Twice while counting the edges into every op and once when it is yielded
+    topo = list(topo_ops([root, root], successors))
+    assert topo[0] is root and topo[-1] is top and set(topo) == set(nodes) and len(topo) == len(nodes)
+    assert all(visits[op] == 3 for op in nodes)
+    position = {op: i for i, op in enumerate(topo)}
+    assert all(position[op] < position[o] for op in nodes for o in op.next)
+
+def test_metadata_long_chain():
+    num_gpus = 4
+    hops = 1000
+    topology = fully_connected(num_gpus)
+    collective = AllReduce(num_gpus, 1, True)
+    prgm = MSCCLProgram("long_chain", topology, collective, 1)
+    with prgm:
+        c = chunk(0, Buffer.input, 0)
+        for hop in range(1, hops+1):
+            c = c.copy(hop % num_gpus, 'scratch', 0)
+    dag = prgm.instr_dag
+    dag.convert_set_list()
+    # Deeper than the recursion limit
+    dag._complete_metadata()
+    start = dag.operations[(0, Buffer.input, 0)]
+    assert start.chunk_step == -1 and start.priority == 2 * hops
+    # The last recv is reached through every slot that was overwritten on its rank
+    op = dag.operations[(hops % num_gpus, 'scratch', 0)]
+    while len(op.next) > 0:
+        op = op.next[0]
+    assert op.inst == Instruction.recv
+    assert op.priority == 0 and op.chunk_step == 2 * hops - 1
+
+def test_dependency_cycle_error():
+    ref = ChunkRef(0, Buffer.input, 0, 1)
+    tb0 = Threadblock(ops=[Op(Instruction.copy, 0, ref, ref, tb=0, step=0), Op(Instruction.copy, 0, ref, ref, tb=0, step=1)])
+    tb1 = Threadblock(ops=[Op(Instruction.copy, 0, ref, ref, tb=1, step=0)])
+    tb1.ops[0].depends = [tb0.ops[1]]
+    check_dependency_cycles([{0: tb0, 1: tb1}])
+    # tb0 waits on tb1 before its second op which tb1 waits on
+    tb0.ops[0].depends = [tb1.ops[0]]
+    with pytest.raises(DependencyCycleError) as e:
+        check_dependency_cycles([{0: tb0, 1: tb1}])
+    cycle = e.value.cycle
+    assert set(cycle) == {tb0.ops[0], tb0.ops[1], tb1.ops[0]}
+
+def test_write_xml(tmp_path):
+    num_gpus = 4
+    topology = fully_connected(num_gpus)
+    collective = AllReduce(num_gpus, num_gpus, True)
+    prgm = MSCCLProgram("allreduce_ring", topology, collective, 1)
+    with prgm:
+        allreduce_ring_inplace(num_gpus)
+    program = prgm.lower()
+    xml = ir_to_xml(program)
+    # Same as building and pretty printing the whole tree
+    tree = ET.fromstring(xml)
+    ET.indent(tree, space='  ')
+    assert xml == ET.tostring(tree, encoding='unicode')
+    assert ir_to_xml(program, pretty_print=False) == ET.tostring(ET.fromstring(xml, ET.XMLParser(remove_blank_text=True)), encoding='unicode')
+    path = tmp_path / 'allreduce_ring.xml'
+    write_xml(program, path)
+    assert path.read_text() == xml
+
+def test_xml_redundant_dependencies():
+    ref = ChunkRef(0, Buffer.input, 0, 1)
+    tb0 = Threadblock(recv=1, channel=0, ops=[Op(Instruction.copy, 0, ref, ref) for _ in range(3)])
+    tb1 = Threadblock(send=1, channel=0, ops=[Op(Instruction.copy, 0, ref, ref) for _ in range(3)])
+    a0, a1, a2 = tb0.ops
+    b0, b1, b2 = tb1.ops
+    b0.depends = [a0, a1] # Only a1 needs to be waited on
+    b1.depends = [a0] # Satisfied by waiting on a1
+    b2.depends = [a1, a2]
+    program = Program('deps', 'custom', False, 'Simple', [Gpu(0, [tb0, tb1])])
+    xml = ET.fromstring(ir_to_xml(program))
+    steps = xml.findall('./gpu/tb[@id="1"]/step')
+    assert [step.get('type') for step in steps] == ['cpy'] * 3
+    assert [(step.get('depid'), step.get('deps')) for step in steps] == [('0', '1'), ('-1', '-1'), ('0', '2')]
+
+def test_read_xml(tmp_path):
+    topology = fully_connected(3)
+    prgm = MSCCLProgram("allreduce", topology, AllReduce(3, 3, True), 2, threadblock_policy=ThreadblockPolicy.manual)
+    with prgm:
+        c01 = chunk(1, Buffer.input, 0, 3).reduce(chunk(0, Buffer.input, 0, 3), sendtb=0, recvtb=0, ch=0)
+        c012 = chunk(2, Buffer.input, 0, 3).reduce(c01, sendtb=0, recvtb=0, ch=0)
+        c012.copy(0, Buffer.input, 0, sendtb=0, recvtb=0, ch=0).copy(1, Buffer.input, 0, sendtb=0, recvtb=0, ch=0)
+        chunk(0, Buffer.input, 0, 3).copy(0, Buffer.scratch, 0, sendtb=1, ch=0)
+    xml = ir_to_xml(prgm.lower())
+    path = tmp_path / 'allreduce.xml'
+    path.write_text(xml)
+    program = read_xml(path)
+    assert ir_to_xml(program) == xml
+    assert (program.name, program.collective, program.inplace, program.protocol) == ('allreduce', 'allreduce', True, 'Simple')
+    assert program.nchunksperloop == 6
+    gpu = program.gpus[0]
+    assert (gpu.input_chunks, gpu.output_chunks, gpu.scratch_size()) == (6, 0, 6)
+    send, rcs = gpu.threadblocks[2].ops
+    assert (send.inst, rcs.inst) == (Instruction.send, Instruction.recv_copy_send)
+    assert send.src == ChunkRef(0, Buffer.input, 0, 3) and send.dst.rank == 1
+    # Dependencies and matching sends and receives are linked
+    assert send.recv_match.rank == 1 and send.recv_match.send_match is send
+    assert rcs.send_match.rank == 2 and rcs.recv_match.rank == 1
+    # Threadblock 0 depends on a later threadblock
+    cpy, = gpu.threadblocks[0].ops
+    assert cpy.depends == [rcs]
+    # The new format only has the local buffer
+    new_xml = ir_to_xml(program, old_format=False)
+    program = xml_to_ir(new_xml)
+    assert ir_to_xml(program, old_format=False) == new_xml
+    send = program.gpus[0].threadblocks[2].ops[0]
+    assert send.src == ChunkRef(0, Buffer.input, 0, 3) and send.dst == ChunkRef(1, None, -1, 3)
+    # Steps without buffer attributes keep their count
+    program = xml_to_ir('<algo name="minimal" proto="Simple" nchannels="1" ngpus="1" coll="custom" inplace="0">'
+                        '<gpu id="0" i_chunks="2" o_chunks="2" s_chunks="0"><tb id="0" send="-1" recv="-1" chan="0">'
+                        '<step s="0" type="cpy" cnt="2" depid="-1" deps="-1" hasdep="0"/></tb></gpu></algo>')
+    cpy, = program.gpus[0].threadblocks[0].ops
+    assert cpy.cnt() == 2 and cpy.src.buffer is None and program.nchunksperloop is None
+    with pytest.raises(ValueError):
+        xml_to_ir(xml.replace('deps="1"', 'deps="9"'))
+
+
+def test_lower_profile(tmp_path, monkeypatch):
+    num_gpus = 4
+    prgm = MSCCLProgram("allreduce_ring", fully_connected(num_gpus), AllReduce(num_gpus, num_gpus, True), 2, profile=True)
+    with prgm:
+        allreduce_ring_inplace(num_gpus)
+    prgm.lower()
+    report = prgm.lowering_profile
+    assert [p.name for p in report.passes] == ['convert_set_list', 'optimize', 'complete_metadata', 'auto_assign_tbs',
+        'lower_pt1', 'lower_pt2', 'check_dependency_cycles', 'check_threadblock_ordering']
+    assert all(p.time >= 0 and p.peak_memory is None and p.nodes is None for p in report.passes)
+    assert report.time == pytest.approx(sum(p.time for p in report.passes))
+
+    # Memory is profiled instead of time
+    prgm = MSCCLProgram("allreduce_ring", fully_connected(num_gpus), AllReduce(num_gpus, num_gpus, True), 2,
+        profile_memory=True)
+    with prgm:
+        allreduce_ring_inplace(num_gpus)
+    prgm.lower()
+    report = prgm.lowering_profile
+    assert all(p.time is None and p.peak_memory >= 0 for p in report.passes)
+    assert report.time is None
+    # Fusion shrinks the DAG and replication doubles it
+    fused = report.pass_profile('optimize')
+    assert fused.nodes < report.pass_profile('convert_set_list').nodes
+    assert report.pass_profile('lower_pt2').nodes == 2 * fused.nodes
+
+    # The environment enables profiling and appends a line of JSON per lowering
+    path = tmp_path / 'profile.json'
+    monkeypatch.setenv('MSCCL_PROFILE', str(path))
+    for name in ['allgather_ring', 'allgather_ring2']:
+        prgm = MSCCLProgram(name, fully_connected(num_gpus), AllGather(num_gpus, 1, True), 1)
+        with prgm:
+            allgather_ring_inplace(num_gpus)
+        prgm.lower()
+    with open(path) as f:
+        data = [json.loads(line) for line in f]
+    assert [d['program'] for d in data] == ['allgather_ring', 'allgather_ring2']
+    assert data[1]['num_ranks'] == num_gpus
+    assert [p['name'] for p in data[1]['passes']] == [p.name for p in prgm.lowering_profile.passes]
+    monkeypatch.setenv('MSCCL_PROFILE', '0')
+    prgm = MSCCLProgram("allgather_ring", fully_connected(num_gpus), AllGather(num_gpus, 1, True), 1)
+    with prgm:
+        allgather_ring_inplace(num_gpus)
+    prgm.lower()
+    assert prgm.lowering_profile is None
+    monkeypatch.setenv('MSCCL_PROFILE_MEMORY', '1')
+    prgm = MSCCLProgram("allgather_ring", fully_connected(num_gpus), AllGather(num_gpus, 1, True), 1)
+    with prgm:
+        allgather_ring_inplace(num_gpus)
+    prgm.lower()
+    assert all(p.nodes > 0 for p in prgm.lowering_profile.passes)
+
+
+def test_lazy_replication():
+    from msccl.programs.allreduce_allpairs import allreduce_allpairs
+    num_gpus = 4
+    instances = 3
+    prgm = MSCCLProgram("allreduce_allpairs", fully_connected(num_gpus), AllReduce(num_gpus, num_gpus * num_gpus, True),
+        instances, interleaved_replication=False)
+    with prgm:
+        allreduce_allpairs(num_gpus)
+    program = prgm.lower()
+    xml = ir_to_xml(program)
+    # The XML is written from the base threadblocks without creating the ops of the instances
+    tbs = [tb for gpu in program.gpus for tb in gpu.threadblocks]
+    assert all(isinstance(tb, InstanceThreadblock) and tb._ops is None for tb in tbs)
+    assert len(tbs) == instances * sum(len(rank_tbs) for rank_tbs in prgm.instr_dag.tbs)
+
+    # Created ops index their instance of the buffers and depend on the same instance
+    for tb in tbs:
+        for op, base_op in zip(tb.ops, tb.base.ops):
+            if op.inst != Instruction.nop:
+                src, _ = tb.replication.instance_refs(base_op, 0)
+                assert op.src.buffer == src.buffer and op.src.index >= src.index
+            for dep in op.depends:
+                assert any(dep in other.ops for other in tbs if other.instance == tb.instance)
+    materialized = Program(program.name, program.collective, program.inplace, program.protocol,
+        [Gpu(gpu.rank, [Threadblock(tb.channel, tb.send, tb.recv, tb.ops) for tb in gpu.threadblocks]) for gpu in program.gpus])
+    assert ir_to_xml(materialized) == xml
+
+
+def test_lower_twice():
+    from msccl.programs.allreduce_allpairs import allreduce_allpairs
+    num_gpus = 4
+    instances = 2
+    prgm = MSCCLProgram("allreduce_ring", fully_connected(num_gpus), AllReduce(num_gpus, num_gpus, True), instances,
+        interleaved_replication=True)
+    with prgm:
+        allreduce_ring_inplace(num_gpus)
+    xml = ir_to_xml(prgm.lower())
+    # The base ops keep their refs, so writing the XML again gives the same XML
+    refs = [(op.src, op.dst) for rank_tbs in prgm.instr_dag.tbs for tb in rank_tbs.values() for op in tb.ops]
+    assert ir_to_xml(prgm.lower()) == xml
+    assert f'nchunksperloop="{num_gpus * instances}"' in xml
+    assert [(op.src, op.dst) for rank_tbs in prgm.instr_dag.tbs for tb in rank_tbs.values() for op in tb.ops] == refs
+    assert all(src.index < num_gpus for src, _ in refs)
+
+    # Dependencies expanded into nops are not added to the base threadblocks
+    prgm = MSCCLProgram("allreduce_allpairs", fully_connected(num_gpus), AllReduce(num_gpus, num_gpus * num_gpus, True),
+        instances, interleaved_replication=False, dependence_nop=True)
+    with prgm:
+        allreduce_allpairs(num_gpus)
+    xml = ir_to_xml(prgm.lower(), dependence_nop=True)
+    assert 'type="nop"' in xml
+    assert ir_to_xml(prgm.lower(), dependence_nop=True) == xml
+    assert prgm.generate_xml() == xml
+
+
+def test_auto_assign_tbs():
+    num_gpus = 6
+    prgm = MSCCLProgram("alltoall", fully_connected(num_gpus), AllToAll(num_gpus, 1, False), 1)
+    with prgm:
+        for r in range(num_gpus):
+            for i in range(num_gpus):
+                chunk(r, Buffer.input, i).copy(i, Buffer.output, r)
+    prgm.lower()
+    for rank_tbs in prgm.instr_dag.tbs:
+        # One threadblock per peer and direction on a channel, local copies share the first threadblock
+        sends = [(tb.send, tb.channel) for tb in rank_tbs.values() if tb.send != -1]
+        recvs = [(tb.recv, tb.channel) for tb in rank_tbs.values() if tb.recv != -1]
+        assert len(sends) == len(set(sends)) == num_gpus - 1
+        assert len(recvs) == len(set(recvs)) == num_gpus - 1
+        copies = [tbid for tbid, tb in rank_tbs.items() for op in tb.ops if op.inst == Instruction.copy]
+        assert copies == [0]
+        for tbid, tb in rank_tbs.items():
+            assert all(op.tb == tbid and op.step == step for step, op in enumerate(tb.ops))
+
+
+def test_channel_assignment():
+    num_gpus = 3
+    prgm = MSCCLProgram("reorder", fully_connected(num_gpus), AllToAll(num_gpus, 2, False), 1)
+    with prgm:
+        chunk(2, Buffer.input, 0).copy(1, Buffer.scratch, 0)
+        chunk(1, Buffer.scratch, 0).copy(2, Buffer.scratch, 1)
+        chunk(2, Buffer.scratch, 1).copy(1, Buffer.scratch, 0)
+        # The first receive from rank 0 waits for rank 1 to forward scratch 0, so the second one is received first
+        chunk(0, Buffer.input, 0).copy(1, Buffer.scratch, 0)
+        chunk(0, Buffer.input, 1).copy(1, Buffer.scratch, 1)
+    prgm.lower()
+    assert prgm.instr_dag.pair_channels == {(0, 1): 2, (1, 2): 1, (2, 1): 1}
+    # Sends and receives between a pair are in the same order on each channel
+    for sender, receiver in prgm.instr_dag.pair_channels:
+        sends = [tb for tb in prgm.instr_dag.tbs[sender].values() if tb.send == receiver]
+        recvs = [tb for tb in prgm.instr_dag.tbs[receiver].values() if tb.recv == sender]
+        assert sorted(tb.channel for tb in sends) == sorted(tb.channel for tb in recvs)
+        for send_tb in sends:
+            recv_tb, = [tb for tb in recvs if tb.channel == send_tb.channel]
+            recv_ops = [op for op in recv_tb.ops if op.is_recv()]
+            assert [op.recv_match for op in send_tb.ops if op.is_send()] == recv_ops
+
+
+def _check_topo_order(instrs):
+    position = {op: i for i, op in enumerate(instrs)}
+    for op in instrs:
+        assert all(position[p] < position[op] for p in op.prev if p.inst != Instruction.start)
+        if op.is_recv():
+            assert position[op.send_match] < position[op]
+
+
+def test_schedule_policies():
+    num_gpus = 4
+    for policy in SchedulePolicy:
+        prgm = MSCCLProgram("allreduce", fully_connected(num_gpus), AllReduce(num_gpus, num_gpus, True), 2,
+            schedule_policy=policy)
+        with prgm:
+            allreduce_ring_inplace(num_gpus)
+            assert Check()
+            XML()
+        _check_topo_order(topo_sort_instrs(prgm.instr_dag, policy))
+
+    # Priority functions can be passed directly, here the ops of the highest rank first
+    prgm = MSCCLProgram("allreduce", fully_connected(num_gpus), AllReduce(num_gpus, num_gpus, True), 1)
+    with prgm:
+        allreduce_ring_inplace(num_gpus)
+        prgm.instr_dag.convert_set_list()
+        prgm.instr_dag._complete_metadata()
+        instrs = topo_sort_instrs(prgm.instr_dag, lambda dag: lambda op: (-op.rank, op.chunk_step))
+    _check_topo_order(instrs)
+    assert instrs[0].rank == num_gpus - 1
+    assert len(instrs) == 2 * num_gpus * (num_gpus - 1) * 2
@@ -2,9 +2,11 @@
 # Licensed under the MIT License.
 
 from msccl.path_encoding import PathEncoding
-from msccl.topologies import fully_connected, line, dgx1
+from msccl.topologies import fully_connected, line, ring, hub_and_spoke, dgx1
 from msccl.collectives import *
 from msccl.instance import Instance
+from msccl.isomorphisms import find_automorphisms
+from msccl.strategies import *
 
 def test_fc_noncombining():
     num_nodes = 2
@@ -24,6 +26,14 @@ def test_fc_combining_nonreducible():
     assert enc.solve(Instance(1, chunks=2)) == None
     assert enc.solve(Instance(2, chunks=2)) != None
 
+def test_ring_combining_chunked():
+    # Pieces of a chunk are reduced at their own addresses
+    topo = ring(4)
+    enc = PathEncoding(topo, allreduce(topo.num_nodes()))
+    assert enc.solve(Instance(3, chunks=4)) == None
+    algo = enc.solve(Instance(4, chunks=4))
+    assert algo != None and algo.instance.chunks == 4
+
 def test_dgx1_noncombining():
     topo = dgx1()
     enc = PathEncoding(topo, allgather(topo.num_nodes()))
@@ -47,3 +57,53 @@ def test_memory_constraint():
     enc = PathEncoding(topo, alltoall(topo.num_nodes()))
     assert enc.solve(Instance(2, extra_memory=0)) == None
     assert enc.solve(Instance(2, extra_memory=1)) != None
+
+def test_least_steps_portfolio():
+    topo = line(3)
+    instance = Instance(None, extra_memory=0)
+    algo = solve_least_steps(topo, alltoall(topo.num_nodes()), base_instance=instance, jobs=3)
+    assert algo.instance.steps == 3
+    # Searches down from a satisfiable first guess
+    algo = solve_least_steps(topo, alltoall(topo.num_nodes()), initial_steps=5, base_instance=instance, jobs=2, seeds=[1, 2])
+    assert algo.instance.steps == 3
+
+def test_pareto_optimal_parallel():
+    topo = ring(4)
+    coll = allgather(topo.num_nodes())
+    sequential = list(solve_all_latency_bandwidth_tradeoffs(topo, coll, max_chunks=3, assume_monotonic_feasibility=True))
+    parallel = list(solve_all_latency_bandwidth_tradeoffs(topo, coll, max_chunks=3, assume_monotonic_feasibility=True, jobs=3))
+    assert [a.instance for a in parallel] == [a.instance for a in sequential]
+    # Each algorithm is optimal when found, the 2 chunk one dominates the 1 chunk one
+    frontier = ParetoFrontier()
+    assert all(frontier.add(algo) for algo in parallel)
+    assert frontier.algorithms == parallel[1:]
+    dominated = solve_instance(topo, coll, Instance(steps=3, extra_rounds=0, chunks=1))
+    assert not frontier.add(dominated)
+    assert frontier.algorithms == prune_pareto_optimal(parallel + [dominated])
+
+def test_incremental_solving():
+    # Instances solved on the same encoding share their step independent constraints
+    topo = line(3)
+    enc = PathEncoding(topo, alltoall(topo.num_nodes()))
+    assert enc.solve(Instance(2, extra_memory=1)) != None
+    assert enc.solve(Instance(2, extra_memory=0)) == None
+    assert enc.solve(Instance(3, extra_memory=0)) != None
+    assert enc.solve(Instance(1)) == None
+    assert enc.solve(Instance(2)) != None
+    assert enc.solve(Instance(2, chunks=2)) == None
+    assert enc.solve(Instance(2, extra_rounds=2, chunks=2)) != None
+
+def test_symmetry_breaking():
+    # Rotations and reflections of the ring map the chunks of allgather onto each other
+    automorphisms = find_automorphisms(ring(4), allgather(4))
+    assert len(automorphisms) == 8
+    assert all(a.chunks == a.nodes for a in automorphisms)
+    # Gathers can only be mapped onto themselves by permutations fixing the root
+    assert all(a.nodes[0] == 0 for a in find_automorphisms(fully_connected(4), gather(4, 0)))
+    assert len(find_automorphisms(fully_connected(4), alltoall(4), limit=5)) == 5
+
+    for topo, coll in [(hub_and_spoke(4), allgather(4)), (ring(4), alltoall(4)), (fully_connected(3), allreduce(3))]:
+        enc = PathEncoding(topo, coll)
+        symmetric = PathEncoding(topo, coll, symmetry_breaking=True)
+        for instance in [Instance(1), Instance(2), Instance(2, chunks=2), Instance(3, extra_memory=0)]:
+            assert (enc.solve(instance) == None) == (symmetric.solve(instance) == None)
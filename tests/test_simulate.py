@@ -0,0 +1,128 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import math
+import pytest
+from msccl.language import *
+from msccl.language.routines import *
+from msccl.language.collectives import *
+from msccl.topologies import fully_connected, Topology
+from msccl.simulate import *
+
+
+def _send_xml(num_sends, chans=(0,)):
+    tbs = []
+    for i, chan in enumerate(chans):
+        steps = ''.join(f'<step s="{s}" type="s" srcbuf="i" srcoff="{s}" dstbuf="o" dstoff="{s}" cnt="1" depid="-1" deps="-1" hasdep="0"/>' for s in range(num_sends))
+        tbs.append(f'<tb id="{i}" send="1" recv="-1" chan="{chan}">{steps}</tb>')
+    send = ''.join(tbs)
+    recvs = []
+    for i, chan in enumerate(chans):
+        steps = ''.join(f'<step s="{s}" type="r" srcbuf="i" srcoff="{s}" dstbuf="o" dstoff="{s}" cnt="1" depid="-1" deps="-1" hasdep="0"/>' for s in range(num_sends))
+        recvs.append(f'<tb id="{i}" send="-1" recv="0" chan="{chan}">{steps}</tb>')
+    recv = ''.join(recvs)
+    return f'<algo name="send" proto="Simple" nchannels="{len(chans)}" nchunksperloop="{num_sends}" ngpus="2" coll="custom" inplace="0">' \
+           f'<gpu id="0" i_chunks="{num_sends}" o_chunks="0" s_chunks="0">{send}</gpu>' \
+           f'<gpu id="1" i_chunks="0" o_chunks="{num_sends}" s_chunks="0">{recv}</gpu></algo>'
+
+
+def test_simulate_send():
+    model = CostModel(alpha=1e-6, beta=1e-9, local_beta=0)
+    result, = simulate(_send_xml(2), sizes=[2000], protocols=['Simple'], model=model)
+    # Two sends of 1000 bytes serialized on the link
+    assert result.time == pytest.approx(2 * (1e-6 + protocol_models['Simple'].latency + 1000 * 1e-9))
+    assert result.busbw == result.algbw == pytest.approx(2000 / result.time)
+    ll, = simulate(_send_xml(2), sizes=[2000], protocols=['LL'], model=model)
+    assert ll.time == pytest.approx(2 * (1e-6 + protocol_models['LL'].latency + 2000 * 1e-9))
+    # Chunks are sized by the nchunksperloop of the XML, not by the buffer sizes of the gpus
+    halved, = simulate(_send_xml(2).replace('nchunksperloop="2"', 'nchunksperloop="4"'), sizes=[2000], protocols=['Simple'], model=model)
+    assert halved.time == pytest.approx(2 * (1e-6 + protocol_models['Simple'].latency + 500 * 1e-9))
+
+
+def test_simulate_switch():
+    # Two channels share a link, but a switch of higher bandwidth does not limit them further
+    links = [[0, 2], [2, 0]]
+    model = CostModel(Topology('pair', links, [([0], [1], 4, 'switch')]), alpha=0, beta=1e-9, local_beta=0)
+    result, = simulate(_send_xml(1, chans=(0, 1)), sizes=[1000], protocols=['Simple'], model=model)
+    assert result.time == pytest.approx(2 * (protocol_models['Simple'].latency + 1000 * 1e-9 / 2))
+    with pytest.raises(ValueError):
+        simulate(_send_xml(1), sizes=[2000], model=CostModel(Topology('none', [[0, 0], [0, 0]])))
+
+
+def test_simulate_program(tmp_path):
+    num_gpus = 4
+    topology = fully_connected(num_gpus)
+    prgm = MSCCLProgram("allreduce_ring", topology, AllReduce(num_gpus, num_gpus, True), 1)
+    with prgm:
+        allreduce_ring_inplace(num_gpus)
+    program = prgm.lower()
+    path = tmp_path / 'allreduce_ring.xml'
+    write_xml(program, path)
+    results = simulate(path, topology, sizes=[2**10, 2**20, 2**30])
+    assert [(r.protocol, r.size) for r in results] == [(p, s) for p in ['Simple', 'LL', 'LL128'] for s in [2**10, 2**20, 2**30]]
+    assert all(r.stuck == [] and r.time > 0 for r in results)
+    simple = [r for r in results if r.protocol == 'Simple']
+    assert simple[0].busbw < simple[1].busbw < simple[2].busbw
+    assert simple[2].busbw == pytest.approx(simple[2].algbw * 2 * (num_gpus - 1) / num_gpus)
+    # A lowered program gives the same result as its XML
+    assert simulate(program, topology, sizes=[2**20]) == [r for r in results if r.size == 2**20]
+
+
+def test_simulate_deadlock():
+    # Both ranks receive from each other before sending
+    xml = '<algo name="deadlock" proto="Simple" nchannels="1" nchunksperloop="1" ngpus="2" coll="custom" inplace="0">' \
+          '<gpu id="0" i_chunks="1" o_chunks="1" s_chunks="0"><tb id="0" send="1" recv="1" chan="0">' \
+          '<step s="0" type="r" cnt="1" depid="-1" deps="-1" hasdep="0"/><step s="1" type="s" cnt="1" depid="-1" deps="-1" hasdep="0"/></tb></gpu>' \
+          '<gpu id="1" i_chunks="1" o_chunks="1" s_chunks="0"><tb id="0" send="0" recv="0" chan="0">' \
+          '<step s="0" type="r" cnt="1" depid="-1" deps="-1" hasdep="0"/><step s="1" type="s" cnt="1" depid="-1" deps="-1" hasdep="0"/></tb></gpu></algo>'
+    result, = simulate(xml, sizes=[1024], protocols=['Simple'])
+    assert result.time == math.inf and result.busbw == 0
+    assert result.stuck == [(0, 0, 0), (1, 0, 0)]
+
+
+# XML of an algorithm from {rank: [(send, recv, chan, [(type, cnt, depid, deps)])]}
+def _algo_xml(gpus, nchunksperloop=1):
+    gpu_elems = []
+    for rank, tbs in gpus.items():
+        tb_elems = []
+        for tbid, (send, recv, chan, steps) in enumerate(tbs):
+            step_elems = ''.join(f'<step s="{s}" type="{t}" cnt="{cnt}" depid="{depid}" deps="{deps}" hasdep="0"/>' for s, (t, cnt, depid, deps) in enumerate(steps))
+            tb_elems.append(f'<tb id="{tbid}" send="{send}" recv="{recv}" chan="{chan}">{step_elems}</tb>')
+        gpu_elems.append(f'<gpu id="{rank}" i_chunks="1" o_chunks="1" s_chunks="0">{"".join(tb_elems)}</gpu>')
+    return f'<algo name="test" proto="Simple" nchannels="1" nchunksperloop="{nchunksperloop}" ngpus="{len(gpus)}" coll="custom" inplace="0">{"".join(gpu_elems)}</algo>'
+
+
+def test_connection_stalls():
+    # Rank 1 only starts receiving after a long local copy
+    xml = _algo_xml({
+        0: [(1, -1, 0, [('s', 1, -1, -1)] * 4)],
+        1: [(-1, -1, 0, [('cpy', 100000, -1, -1)]), (-1, 0, 0, [('r', 1, 0, 0)] + [('r', 1, -1, -1)] * 3)],
+    })
+    report = analyze_connections(xml, slots=2, size=1024)
+    assert not report.deadlocked and report.stalled == [(0, 0)]
+    assert report.tbs[(0, 0)].stalls == 1 and report.tbs[(0, 0)].stalled > 0
+    for stats in report.tbs.values():
+        assert stats.busy + stats.idle == pytest.approx(report.time)
+    report = analyze_connections(xml, slots=4, size=1024)
+    assert report.stalled == []
+    # Per connection slots
+    assert analyze_connections(xml, slots={(0, 1, 0): 2}, size=1024).stalled == [(0, 0)]
+    # Stalls slow down the simulated program
+    slow, = simulate(xml, sizes=[1024], protocols=['Simple'], connections=ConnectionModel(1))
+    fast, = simulate(xml, sizes=[1024], protocols=['Simple'])
+    assert slow.time > fast.time
+
+
+def test_connection_deadlock():
+    # Both ranks send three messages before receiving
+    steps = [('s', 1, -1, -1)] * 3 + [('r', 1, -1, -1)] * 3
+    xml = _algo_xml({0: [(1, 1, 0, steps)], 1: [(0, 0, 0, steps)]})
+    report = analyze_connections(xml, slots=2, size=1024)
+    assert report.deadlocked and report.stuck == {(0, 0, 2): 'send', (1, 0, 2): 'send'}
+    assert not analyze_connections(xml, slots=3, size=1024).deadlocked
+    # Chunks larger than a slot are split in loop iterations and take one slot each
+    assert not analyze_connections(xml, size=4 * 1024, connections=ConnectionModel(3, {'Simple': 1024})).deadlocked
+    steps = [('s', 2, -1, -1)] * 2 + [('r', 2, -1, -1)] * 2
+    xml = _algo_xml({0: [(1, 1, 0, steps)], 1: [(0, 0, 0, steps)]})
+    report = analyze_connections(xml, size=4 * 1024, connections=ConnectionModel(3, {'Simple': 1024}))
+    assert report.deadlocked and report.stuck == {(0, 0, 1): 'send', (1, 0, 1): 'send'}